@@ -0,0 +1,4 @@
+"""
+Timing scripts for userdocker's hot paths, run from the repo root, e.g.:
+``python -m benchmarks.identity``. Not part of the installed package.
+"""
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Group resolution via getgrouplist vs. grp.getgrall().
+
+Usage: ``python -m benchmarks.identity [groups] [repeat]`` as root. Needs
+unshare: a synthetic group database is bind mounted over /etc/group in a
+private mount namespace.
+"""
+
+import argparse
+import grp
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from userdocker.config import identity
+
+
+def write_group_db(fn, n_groups, user_name, primary_gid, n_member=20):
+    """Writes an /etc/group with n_groups groups, user_name is member of
+    n_member of them (spread over the file)."""
+    with open(fn, 'w') as f:
+        f.write('primary:x:%d:\n' % primary_gid)
+        step = max(1, n_groups // n_member)
+        for i in range(n_groups):
+            gid = 100000 + i
+            members = ['user%d' % (i + j) for j in range(3)]
+            if i % step == 0:
+                members.append(user_name)
+            f.write('group%d:x:%d:%s\n' % (i, gid, ','.join(members)))
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        res = func()
+    return (time.perf_counter() - start) / repeat, res
+
+
+def run_in_namespace(n_groups, repeat):
+    """Re-runs this script with a synthetic /etc/group."""
+    if os.geteuid() != 0 or not shutil.which('unshare'):
+        sys.exit('the benchmark needs root and unshare')
+    user = pwd.getpwuid(os.getuid())
+    tmp_dir = tempfile.mkdtemp(prefix='userdocker_')
+    fn = os.path.join(tmp_dir, 'group')
+    write_group_db(fn, n_groups, user.pw_name, user.pw_gid)
+    try:
+        subprocess.check_call(
+            ['unshare', '--mount', 'sh', '-c',
+             'mount --bind "$0" /etc/group && exec "$@"', fn,
+             sys.executable, '-m', __spec__.name,
+             str(n_groups), str(repeat)],
+            env=dict(os.environ, USERDOCKER_SYNTHETIC_GROUPS=fn),
+        )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmark(n_groups, repeat):
+    """Compares grp.getgrall() to the uncached and cached member_groups."""
+    identity.IDENTITY_CACHE_DIR = tempfile.mkdtemp(prefix='userdocker_') + '/'
+    user = pwd.getpwuid(os.getuid())
+    user_name, primary_gid = user.pw_name, user.pw_gid
+
+    def getgrall():
+        return [
+            (g.gr_name, g.gr_gid) for g in grp.getgrall()
+            if user_name in g.gr_mem
+        ]
+
+    def uncached():
+        return identity.resolve_member_groups(user_name, primary_gid)
+
+    def cached():
+        return identity.member_groups(os.getuid(), user_name, primary_gid)
+
+    print('%d groups, ms per lookup:' % n_groups)
+    t_all, all_groups = timed(getgrall, max(1, repeat // 10))
+    print('  grp.getgrall():          %9.3f' % (t_all * 1000))
+    t_uncached, groups = timed(uncached, repeat)
+    print('  member_groups, uncached: %9.3f' % (t_uncached * 1000))
+    cached()
+    t_cached, cached_groups = timed(cached, repeat * 100)
+    print('  member_groups, cached:   %9.3f (%.0fx faster than getgrall)' % (
+        t_cached * 1000, t_all / t_cached))
+    if not sorted(groups) == sorted(all_groups) == sorted(cached_groups):
+        sys.exit('group lookups differ')
+    shutil.rmtree(identity.IDENTITY_CACHE_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('groups', type=int, nargs='?', default=50000)
+    parser.add_argument('repeat', type=int, nargs='?', default=20)
+    args = parser.parse_args()
+    if 'USERDOCKER_SYNTHETIC_GROUPS' in os.environ:
+        benchmark(args.groups, args.repeat)
+    else:
+        run_in_namespace(args.groups, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of load's archive validation on generated image archives.
+
+Usage: ``python -m benchmarks.image_archive [MiB]``
+
+Compressed archives have to be decompressed for validation (as docker does
+anyway), so decompression alone is shown as well.
+"""
+
+import argparse
+import bz2
+import io
+import json
+import lzma
+import os
+import sys
+import tarfile
+import time
+import zlib
+
+from userdocker.helpers.image_archive import CHUNK_SIZE
+from userdocker.helpers.image_archive import ImageArchiveValidator
+from userdocker.helpers.image_archive import _Decompressor
+
+
+def image_archive(layer_sizes, tags):
+    """Returns a docker save like archive with layers of the given sizes."""
+    buf = io.BytesIO()
+
+    def add(tar, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        layers = []
+        for i, size in enumerate(layer_sizes):
+            # half random (incompressible), half repetitive data
+            data = os.urandom(size // 2) + b'layer data ' * (size // 22)
+            layers.append('%064x/layer.tar' % i)
+            add(tar, layers[-1], data)
+        add(tar, '%064x.json' % 0, b'{}')
+        add(tar, 'manifest.json', json.dumps([{
+            'Config': '%064x.json' % 0, 'RepoTags': tags, 'Layers': layers,
+        }]).encode())
+        add(tar, 'repositories', json.dumps({
+            t.rpartition(':')[0]: {t.rpartition(':')[2]: '%064x' % 0}
+            for t in tags
+        }).encode())
+    return buf.getvalue()
+
+
+def benchmark(size, chunk_size=CHUNK_SIZE):
+    """Compares forwarding archives with and without validation."""
+    raw = image_archive([size // 4] * 4, ['library/image:latest'])
+    gzip = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    archives = [
+        ('tar', None, raw),
+        ('tar.gz', 'gzip', gzip.compress(raw) + gzip.flush()),
+        ('tar.bz2', 'bzip2', bz2.compress(raw, 1)),
+        ('tar.xz', 'xz', lzma.compress(raw, preset=0)),
+    ]
+    mb = len(raw) / 2**20
+    print('%d MiB archives, MiB/s (uncompressed):' % mb)
+    null = open(os.devnull, 'wb')
+    for name, kind, archive in archives:
+        chunks = [
+            archive[i:i + chunk_size]
+            for i in range(0, len(archive), chunk_size)
+        ]
+        start = time.perf_counter()
+        for chunk in chunks:
+            null.write(chunk)
+        forward = time.perf_counter() - start
+
+        decompress = None
+        if kind:
+            decompressor = _Decompressor(kind)
+            start = time.perf_counter()
+            for chunk in chunks:
+                for _ in decompressor.pieces(chunk):
+                    pass
+            decompress = time.perf_counter() - start
+
+        validator = ImageArchiveValidator(lambda tag: None)
+        start = time.perf_counter()
+        for chunk in chunks:
+            validator.feed(chunk)
+            null.write(chunk)
+        validator.close()
+        validate = time.perf_counter() - start
+        if validator.tags != ['library/image:latest'] * 2:
+            sys.exit('unexpected tags: %s' % validator.tags)
+
+        print('  %-7s forward %7.0f, %s, validate + forward %7.0f' % (
+            name, mb / forward,
+            'decompress %7.0f' % (mb / decompress) if decompress else
+            '%18s' % '', mb / validate))
+    null.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('size', type=int, nargs='?', default=256,
+                        help='uncompressed archive size in MiB')
+    args = parser.parse_args()
+    benchmark(args.size << 20)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Image existence checks of an array job: image index snapshot vs. docker CLI.
+
+Usage: ``python -m benchmarks.image_index [docker] [tasks] [images]`` as root
+(the snapshot is root only). Each task checks the same image.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from userdocker.helpers.image_index import ImageIndex
+from userdocker.helpers.image_index import image_db_mtime
+
+
+def benchmark(docker, n_tasks, n_images):
+    tmp_dir = tempfile.mkdtemp(prefix='userdocker_')
+    fn = os.path.join(tmp_dir, 'image_index.json')
+    index = ImageIndex()
+    index.time, index.db_mtime = time.time(), image_db_mtime()
+    index.images = {
+        'registry.example.com/group/image%d:latest' % i: {
+            'id': 'sha256:%064x' % i, 'digest': None, 'size': 10**9,
+            'created': 0,
+        } for i in range(n_images)
+    }
+    index.save(fn)
+    image = 'registry.example.com/group/image%d:latest' % (n_images - 1)
+
+    start = time.perf_counter()
+    for _ in range(n_tasks):
+        # each task loads the snapshot and checks it's current (is_current)
+        task_index = ImageIndex.load(fn)
+        if image_db_mtime() != task_index.db_mtime \
+                or task_index.lookup(image) is None:
+            sys.exit('image index snapshot not usable (not running as root?)')
+    cached = time.perf_counter() - start
+    shutil.rmtree(tmp_dir)
+    print('%d tasks, index of %d images: %8.3f s (%.3f ms per task)' % (
+        n_tasks, n_images, cached, cached * 1000 / n_tasks))
+
+    if not shutil.which(docker):
+        print('%s not found, skipping CLI benchmark' % docker)
+        return
+    start = time.perf_counter()
+    for _ in range(n_tasks):
+        subprocess.call(
+            [docker, 'images', '-q', image], stdout=subprocess.DEVNULL)
+    cli = time.perf_counter() - start
+    print('%d tasks, %s images -q:  %8.3f s (%.3f ms per task)' % (
+        n_tasks, docker, cli, cli * 1000 / n_tasks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('docker', nargs='?', default='docker')
+    parser.add_argument('tasks', type=int, nargs='?', default=500)
+    parser.add_argument('images', type=int, nargs='?', default=200)
+    args = parser.parse_args()
+    benchmark(args.docker, args.tasks, args.images)
+
+
+if __name__ == '__main__':
+    main()
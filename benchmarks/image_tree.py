@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Building and rendering the image tree of generated images.
+
+Usage: ``python -m benchmarks.image_tree [count] [repeat]``
+"""
+
+import argparse
+import time
+
+from userdocker.helpers.image_tree import _image
+from userdocker.helpers.image_tree import build_tree
+from userdocker.helpers.image_tree import dumps_tree_json
+from userdocker.helpers.image_tree import render_tree
+
+
+def generated_images(count, base_images=20, layers=8):
+    """Returns count images on base_images bases with varying layer chains."""
+    images = []
+    for i in range(count):
+        base = i % base_images
+        chain = ['sha256:base%d-%d' % (base, n) for n in range(layers)]
+        chain += ['sha256:img%d-%d' % (i, n) for n in range(i % 5)]
+        images.append(_image(
+            'sha256:%064x' % i, None,
+            ['group%d/image%d:latest' % (base, i)] if i % 3 else [],
+            10**8 + i, chain))
+    return images
+
+
+def benchmark(count, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        images = generated_images(count)
+        lines = render_tree(build_tree(images))
+        dumps_tree_json(build_tree(images))
+    print('%d images: build + render + json %.1f ms (%d lines)' % (
+        count, (time.perf_counter() - start) * 1000 / repeat, len(lines)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('count', type=int, nargs='?', default=2000)
+    parser.add_argument('repeat', type=int, nargs='?', default=5)
+    args = parser.parse_args()
+    benchmark(args.count, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
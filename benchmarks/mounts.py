@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Sequential vs. concurrent probing of fake slow mounts (some hanging).
+
+Usage: ``python -m benchmarks.mounts [mounts] [delay] [hanging] [timeout]``,
+the dead mounts cache part needs root.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from userdocker.helpers.exceptions import UserDockerException
+from userdocker.helpers.mounts import probe_mounts
+from userdocker.helpers.mounts import remember_dead_mounts
+
+
+def benchmark(n_mounts, delay, hanging, timeout):
+    """Each fake probe blocks for delay seconds (like a cold automount),
+    hanging of them block forever (like a dead NFS server)."""
+    never = threading.Event()
+
+    def slow_probe(path):
+        if path.startswith('/hanging'):
+            never.wait()
+        time.sleep(delay)
+        return True
+
+    ok_paths = ['/mount%d' % i for i in range(n_mounts)]
+    hanging_paths = ['/hanging%d' % i for i in range(hanging)]
+
+    start = time.time()
+    for path in ok_paths:
+        slow_probe(path)
+    print('sequential, %d mounts: %.2fs (each hanging one: forever)' % (
+        n_mounts, time.time() - start))
+
+    start = time.time()
+    probe_mounts(ok_paths, timeout, slow_probe, None)
+    print('concurrent, %d mounts: %.2fs' % (n_mounts, time.time() - start))
+
+    start = time.time()
+    try:
+        probe_mounts(ok_paths + hanging_paths, timeout, slow_probe, None)
+    except UserDockerException as e:
+        print(e)
+    print('concurrent, %d mounts + %d hanging: %.2fs' % (
+        n_mounts, hanging, time.time() - start))
+
+    if os.geteuid() != 0:
+        return
+    # the dead mounts cache makes the next attempt fail fast
+    tmp_dir = tempfile.mkdtemp(prefix='userdocker_')
+    fn = os.path.join(tmp_dir, 'dead_mounts.json')
+    remember_dead_mounts(hanging_paths, fn)
+    start = time.time()
+    try:
+        probe_mounts(ok_paths + hanging_paths, timeout, slow_probe, fn)
+    except UserDockerException as e:
+        print(e)
+    print('concurrent, cached dead mount: %.2fs' % (time.time() - start))
+    shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('mounts', type=int, nargs='?', default=16)
+    parser.add_argument('delay', type=float, nargs='?', default=0.5)
+    parser.add_argument('hanging', type=int, nargs='?', default=1)
+    parser.add_argument('timeout', type=float, nargs='?', default=2)
+    args = parser.parse_args()
+    benchmark(args.mounts, args.delay, args.hanging, args.timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Rejection rates and fragmentation of the GPU placement policies.
+
+Usage: ``python -m benchmarks.placement [jobs] [seed]``
+
+Replays a synthetic trace of container arrivals and departures on several
+node layouts for each policy of NV_PLACEMENT_POLICY.
+"""
+
+import argparse
+import heapq
+import random
+
+from userdocker.helpers.placement import PLACEMENT_POLICIES
+from userdocker.helpers.placement import gpu_domains
+
+
+def synthetic_topology(sockets, gpus_per_socket):
+    """Returns the topology of a PCIe node: GPU pairs share a switch (PIX),
+    GPUs of a socket its host bridges (NODE), sockets are linked by SYS."""
+    n_gpus = sockets * gpus_per_socket
+    topology = {}
+    for a in range(n_gpus):
+        topology[a] = {}
+        for b in range(n_gpus):
+            if a == b:
+                continue
+            if a // gpus_per_socket != b // gpus_per_socket:
+                link = 'SYS'
+            elif a // 2 == b // 2:
+                link = 'PIX'
+            else:
+                link = 'NODE'
+            topology[a][b] = link
+    return topology
+
+
+# node layouts of the simulation: (sockets, GPUs per socket)
+SIMULATED_NODES = {
+    '2x4': (2, 4),
+    '4x2': (4, 2),
+    '2x8': (2, 8),
+}
+# GPU counts of simulated containers with their weights
+SIMULATED_GPU_COUNTS = ((1, 8), (2, 4), (4, 2), (8, 1))
+
+
+def synthetic_trace(n_jobs, n_gpus, seed=0, load=0.9):
+    """Returns [(arrival time, duration, GPU count)] of n_jobs containers.
+
+    Poisson arrivals with exponential durations (mean 1), arrival rate such
+    that load of the node's GPUs are requested on average.
+    """
+    rng = random.Random(seed)
+    counts = [c for c, _ in SIMULATED_GPU_COUNTS if c <= n_gpus]
+    weights = [w for c, w in SIMULATED_GPU_COUNTS if c <= n_gpus]
+    mean_count = sum(c * w for c, w in zip(counts, weights)) / sum(weights)
+    rate = load * n_gpus / mean_count
+    trace, t = [], 0.
+    for _ in range(n_jobs):
+        t += rng.expovariate(rate)
+        count = rng.choices(counts, weights)[0]
+        trace.append((t, rng.expovariate(1.), count))
+    return trace
+
+
+def simulate(policy, topology, trace, connected=False):
+    """Replays trace on a node with topology, returns a dict of
+    - rejected: fraction of containers rejected
+    - split: fraction of multi GPU containers spanning domains
+    - fragmentation: mean share of free GPUs outside the domain with most
+      free GPUs (at arrivals)
+    With connected, multi GPU containers spanning domains are rejected.
+    """
+    gpus = sorted(topology)
+    domains = gpu_domains(gpus, topology)
+    domain_of = {g: i for i, d in enumerate(domains) for g in d}
+    free = set(gpus)
+    running = []
+    rejected = split = multi = 0
+    fragmentation = []
+    for arrival, duration, count in trace:
+        while running and running[0][0] <= arrival:
+            free.update(heapq.heappop(running)[1])
+        if free:
+            largest = max(
+                sum(1 for g in d if g in free) for d in domains)
+            fragmentation.append(1 - largest / len(free))
+        placed = PLACEMENT_POLICIES[policy](
+            sorted(free), count, domains, topology)
+        spans = len(set(domain_of[g] for g in placed)) > 1
+        if len(placed) < count or (connected and spans):
+            rejected += 1
+            continue
+        if count > 1:
+            multi += 1
+            split += spans
+        free.difference_update(placed)
+        heapq.heappush(running, (arrival + duration, placed))
+    return {
+        'rejected': rejected / len(trace),
+        'split': split / multi if multi else 0.,
+        'fragmentation': (
+            sum(fragmentation) / len(fragmentation) if fragmentation else 0.),
+    }
+
+
+def simulate_policies(n_jobs, seed):
+    """Prints the simulation results of all policies per node layout."""
+    print('%-5s %-9s %9s %18s %7s %14s' % (
+        'node', 'policy', 'rejected', 'rejected (conn.)', 'split',
+        'fragmentation'))
+    for node, (sockets, per_socket) in sorted(SIMULATED_NODES.items()):
+        topology = synthetic_topology(sockets, per_socket)
+        trace = synthetic_trace(n_jobs, len(topology), seed)
+        for policy in sorted(PLACEMENT_POLICIES):
+            res = simulate(policy, topology, trace)
+            res_connected = simulate(policy, topology, trace, connected=True)
+            print('%-5s %-9s %8.1f%% %17.1f%% %6.1f%% %13.1f%%' % (
+                node, policy, res['rejected'] * 100,
+                res_connected['rejected'] * 100, res['split'] * 100,
+                res['fragmentation'] * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('jobs', type=int, nargs='?', default=5000)
+    parser.add_argument('seed', type=int, nargs='?', default=0)
+    args = parser.parse_args()
+    simulate_policies(args.jobs, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Policy checks vs. checking each image / port regexp and mount in turn.
+
+Usage: ``python -m benchmarks.policy [patterns] [repeat]``
+"""
+
+import argparse
+import re
+import time
+
+from userdocker.helpers.policy import Policy
+
+
+def legacy_authorize(image_regexps, port_regexps, mounts_available, image,
+                     port_mapping, user_mount):
+    """The checks of run as done before the Policy."""
+    for regexps, s in ((image_regexps, image), (port_regexps, port_mapping)):
+        for r in regexps:
+            if re.match(r, s):
+                break
+    if user_mount not in mounts_available:
+        return user_mount.split(':')[0] + ':' in mounts_available
+    return True
+
+
+def benchmark(n, repeat):
+    image_regexps = [
+        r'^registry\.example\.com/group%d/.*' % i for i in range(n)]
+    port_regexps = [
+        r'^127\.0\.0\.1:%d:[0-9]+$' % (10000 + i) for i in range(n)]
+    mounts = ['/data/project%d:/data/project%d:ro' % (i, i) for i in range(n)]
+    # worst case for the previous checks: last pattern / mount matches
+    image = 'registry.example.com/group%d/image:latest' % (n - 1)
+    port_mapping = '127.0.0.1:%d:80' % (10000 + n - 1)
+    user_mount = mounts[-1]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        legacy_authorize(image_regexps, port_regexps, mounts, image,
+                         port_mapping, user_mount)
+    legacy = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    p = Policy(image_regexps, port_regexps, [], [], mounts)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        p.authorize_image(image)
+        p.authorize_port_mappings([port_mapping])
+        p.authorize_mounts([user_mount], False)
+    check = (time.perf_counter() - start) / repeat
+
+    print('%d patterns / mounts each:' % n)
+    print('  previous checks:  %8.3f ms per run' % (legacy * 1000))
+    print('  Policy: build %8.3f ms once, check %8.3f ms per run' % (
+        build * 1000, check * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('patterns', type=int, nargs='?', default=1000)
+    parser.add_argument('repeat', type=int, nargs='?', default=100)
+    args = parser.parse_args()
+    benchmark(args.patterns, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
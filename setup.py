@@ -44,9 +44,13 @@ setup(
         'Topic :: Utilities',
     ],
     keywords='docker user limit admin hpc cluster computing permissions',
-    packages=find_packages(),
+    packages=find_packages(
+        exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
     include_package_data=True,
     data_files=[('/etc/userdocker/', ['userdocker/config/default.py'])],
-    entry_points={'console_scripts': ['userdocker=userdocker.userdocker:main']},
+    entry_points={'console_scripts': [
+        'userdocker=userdocker.userdocker:main',
+        'userdockerd=userdocker.userdockerd:main',
+    ]},
     zip_safe=True,
 )
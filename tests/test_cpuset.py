@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from userdocker.helpers import cpuset
+from userdocker.helpers import topology
+from userdocker.helpers.cpuset import format_cpulist
+from userdocker.helpers.cpuset import gpu_cpuset
+from userdocker.helpers.cpuset import gpu_numa_nodes
+from userdocker.helpers.cpuset import nvidia_cpuset_args
+from userdocker.helpers.cpuset import parse_cpulist
+
+
+# 2 sockets with 8 cores (hyper-threads: cpu + 16) each, 4 GPUs per socket
+# and a GPU without NUMA affinity (numa_node -1)
+NODE_CPUS = {0: '0-7,16-23', 1: '8-15,24-31'}
+PCI_BUS_IDS = {
+    gpu: '00000000:%02X:00.0' % bus for gpu, bus in enumerate(
+        [0x1a, 0x1c, 0x3b, 0x3d, 0x88, 0x8a, 0xb1, 0xb3, 0xda])
+}
+GPU_NUMA_NODES = {gpu: gpu // 4 for gpu in range(8)}
+GPU_NUMA_NODES[8] = -1
+ALL_CPUS = set(range(32))
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content + '\n')
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    """Fake /sys with the NUMA nodes, CPUs and GPUs above."""
+    root = str(tmp_path / 'sys')
+    for node, cpulist in NODE_CPUS.items():
+        write(os.path.join(
+            root, 'devices/system/node/node%d/cpulist' % node), cpulist)
+        for cpu in parse_cpulist(cpulist):
+            core = cpu % 16
+            write(os.path.join(
+                root, 'devices/system/cpu/cpu%d' % cpu,
+                'topology/thread_siblings_list'),
+                '%d,%d' % (core, core + 16))
+    for gpu, bus_id in PCI_BUS_IDS.items():
+        write(os.path.join(
+            root, 'bus/pci/devices', cpuset.sysfs_pci_bus_id(bus_id),
+            'numa_node'), str(GPU_NUMA_NODES[gpu]))
+    return root
+
+
+@pytest.fixture
+def numa_nodes(sysfs):
+    return gpu_numa_nodes(PCI_BUS_IDS, sysfs)
+
+
+def test_cpulists():
+    assert parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpulist('') == []
+    assert format_cpulist([11, 0, 1, 2, 3, 8, 10, 3]) == '0-3,8,10-11'
+    assert cpuset.sysfs_pci_bus_id('00000000:3B:00.0') == '0000:3b:00.0'
+
+
+def test_gpu_numa_nodes(numa_nodes, sysfs):
+    assert numa_nodes == {
+        gpu: node if node >= 0 else None
+        for gpu, node in GPU_NUMA_NODES.items()}
+    # missing in sysfs
+    assert gpu_numa_nodes({9: '00000000:FF:00.0'}, sysfs) == {9: None}
+
+
+@pytest.mark.parametrize('gpu,cpus', [
+    (0, [0, 1, 16, 17]),
+    (1, [2, 3, 18, 19]),
+    (3, [6, 7, 22, 23]),
+    (4, [8, 9, 24, 25]),
+])
+def test_cores_are_split_evenly_between_gpus(numa_nodes, sysfs, gpu, cpus):
+    assert gpu_cpuset([gpu], numa_nodes, ALL_CPUS, sysfs_root=sysfs) == \
+        (cpus, [GPU_NUMA_NODES[gpu]])
+
+
+def test_uneven_splits_are_disjoint(sysfs):
+    # 3 GPUs on 8 cores
+    numa_nodes = {0: 0, 1: 0, 2: 0}
+    shares = [
+        gpu_cpuset([gpu], numa_nodes, ALL_CPUS, sysfs_root=sysfs)[0]
+        for gpu in range(3)
+    ]
+    assert sorted(len(s) for s in shares) == [4, 6, 6]
+    assert sorted(c for s in shares for c in s) == parse_cpulist('0-7,16-23')
+
+
+def test_gpus_of_several_nodes(numa_nodes, sysfs):
+    assert gpu_cpuset([3, 4], numa_nodes, ALL_CPUS, sysfs_root=sysfs) == \
+        ([6, 7, 8, 9, 22, 23, 24, 25], [0, 1])
+
+
+def test_slurm_cpuset_restriction(numa_nodes, sysfs):
+    # the job's share of socket 0 is used as is
+    allowed = {0, 1, 2, 16, 17, 18}
+    assert gpu_cpuset([1], numa_nodes, allowed, [0], sysfs) == \
+        ([0, 1, 2, 16, 17, 18], [0])
+    # no allowed CPUs on the GPU's node: don't pin CPUs
+    allowed = set(parse_cpulist(NODE_CPUS[1]))
+    assert gpu_cpuset([0], numa_nodes, allowed, [1], sysfs) == \
+        (sorted(allowed), [1])
+
+
+def test_unknown_numa_node(numa_nodes, sysfs):
+    assert gpu_cpuset([8], numa_nodes, ALL_CPUS, sysfs_root=sysfs) == \
+        (None, None)
+    assert gpu_cpuset([0, 8], numa_nodes, ALL_CPUS, sysfs_root=sysfs) == \
+        (None, None)
+
+
+@pytest.fixture
+def proc(tmp_path):
+    root = str(tmp_path / 'proc')
+    write(os.path.join(root, 'self/status'),
+          'Name:\tpython\nCpus_allowed_list:\t0-31\n'
+          'Mems_allowed_list:\t0-1\n')
+    return root
+
+
+@pytest.fixture
+def node(monkeypatch):
+    monkeypatch.setattr(topology, 'NV_GPU_QUERY_BACKEND', 'fake')
+    monkeypatch.setattr(
+        cpuset, 'query_gpu_pci_bus_ids', lambda nvidia_smi: PCI_BUS_IDS)
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: ALL_CPUS)
+
+
+@pytest.mark.parametrize('gpus,args', [
+    ([5], ['--cpuset-cpus=10-11,26-27', '--cpuset-mems=1']),
+    ([2, 3], ['--cpuset-cpus=4-7,20-23', '--cpuset-mems=0']),
+    ([8], []),
+])
+def test_nvidia_cpuset_args(node, sysfs, proc, gpus, args):
+    assert nvidia_cpuset_args(gpus, sysfs_root=sysfs, proc_root=proc) == args
+
+
+def test_nvidia_cpuset_args_without_sysfs(node, tmp_path, proc):
+    assert nvidia_cpuset_args(
+        [0], sysfs_root=str(tmp_path / 'nonexistent'), proc_root=proc) == []
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler
+import json
+import os
+import socketserver
+import threading
+
+import pytest
+
+from userdocker.helpers import dockerapi
+from userdocker.helpers.dockerapi import DockerAPIUnavailable
+from userdocker.helpers.dockerapi import api_path
+from userdocker.helpers.exceptions import UserDockerException
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    """Answers GETs with the canned responses of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(FakeEngineHandler, self).setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        status, body = self.server.responses.get(
+            self.path, (404, {'message': 'page not found'}))
+        if isinstance(body, FakeStream):
+            body.serve(self)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if self.path in self.server.drop_after:
+            # close the keep-alive connection without telling the client
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStream:
+    """Chunked json stream (like /events), optionally cut off mid-object."""
+
+    def __init__(self, objects, cut_off=False):
+        self.objects = objects
+        self.cut_off = cut_off
+
+    def serve(self, handler):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+        for obj in self.objects:
+            data = json.dumps(obj).encode() + b'\n'
+            handler.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        if self.cut_off:
+            # half a chunk, then the connection is gone
+            handler.wfile.write(b'40\r\n{"Type": "contai')
+        else:
+            handler.wfile.write(b'0\r\n\r\n')
+        handler.wfile.flush()
+        handler.close_connection = True
+
+
+class FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super(FakeEngine, self).__init__(socket_path, FakeEngineHandler)
+        self.responses = {}
+        self.drop_after = set()
+        self.requests = []
+        self.connections = 0
+
+
+@pytest.fixture(autouse=True)
+def api_state():
+    dockerapi.reset_api()
+    dockerapi.close_connections()
+    yield
+    dockerapi.reset_api()
+    dockerapi.close_connections()
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / 'docker.sock')
+    monkeypatch.setattr(dockerapi, 'DOCKER_SOCKET', socket_path)
+    return socket_path
+
+
+def serve(socket_path):
+    """Returns a FakeEngine on socket_path, serving in a thread."""
+    server = FakeEngine(socket_path)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def engine(socket_path):
+    server = serve(socket_path)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def docker(tmp_path):
+    """Fake docker CLI printing canned output per subcommand."""
+    fn = str(tmp_path / 'docker')
+    with open(fn, 'w') as f:
+        f.write('#!/bin/sh\n'
+                'echo "$*" >> "$0.log"\n'
+                'cat "$0.$1" 2>/dev/null\n')
+    os.chmod(fn, 0o755)
+    return fn
+
+
+def cli_calls(docker):
+    try:
+        with open(docker + '.log') as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def test_api_path():
+    assert api_path('images', 'library/image:1', 'json') == \
+        '/images/library%2Fimage%3A1/json'
+    assert api_path('containers', 'json', all=1,
+                    filters={'label': ['a=b']}) == \
+        '/containers/json?all=1&filters=%7B%22label%22%3A+%5B%22a%3Db%22%5D%7D'
+    assert api_path('events', since=None) == '/events'
+
+
+def test_keep_alive_connections_are_reused(engine):
+    engine.responses['/info'] = (200, {'ID': 'node'})
+    for _ in range(5):
+        assert dockerapi.api_get('/info') == {'ID': 'node'}
+    assert engine.requests == ['/info'] * 5
+    assert engine.connections == 1
+
+
+def test_closed_idle_connections_are_retried(engine):
+    engine.responses['/info'] = (200, {'ID': 'node'})
+    engine.drop_after.add('/info')
+    for _ in range(3):
+        assert dockerapi.api_get('/info') == {'ID': 'node'}
+    assert engine.connections == 3
+    assert dockerapi._api_usable
+
+
+def test_concurrent_requests_keep_their_order(engine):
+    paths = ['/containers/%d/json' % i for i in range(20)]
+    for i, path in enumerate(paths):
+        engine.responses[path] = (200, {'Id': i})
+    assert dockerapi.api_get_many(paths) == [{'Id': i} for i in range(20)]
+    assert engine.connections <= dockerapi.API_POOL_SIZE + 1
+
+
+def test_http_errors(engine):
+    assert dockerapi.api_get('/images/missing/json') is None
+    engine.responses['/info'] = (500, {'message': 'daemon on fire'})
+    with pytest.raises(UserDockerException, match=r'\(500\): daemon on fire'):
+        dockerapi.api_get('/info')
+    # errors are answers, the API stays usable
+    assert dockerapi._api_usable
+
+
+def test_stream(engine):
+    events = [{'Type': 'container', 'Action': 'start', 'id': i}
+              for i in range(3)]
+    engine.responses['/events'] = (200, FakeStream(events))
+    assert list(dockerapi.api_stream('/events')) == events
+
+
+def test_stream_http_error(engine):
+    engine.responses['/events?since=x'] = (400, {'message': 'bad since'})
+    with pytest.raises(UserDockerException, match='bad since'):
+        list(dockerapi.api_stream('/events?since=x'))
+
+
+def test_stream_disconnected_mid_stream(engine):
+    events = [{'Type': 'container', 'Action': 'die', 'id': i}
+              for i in range(2)]
+    engine.responses['/events'] = (200, FakeStream(events, cut_off=True))
+    received = []
+    with pytest.raises(DockerAPIUnavailable):
+        for event in dockerapi.api_stream('/events'):
+            received.append(event)
+    assert received == events
+
+
+def test_queries_via_api(engine, docker):
+    engine.responses[api_path('images', 'library/image', 'json')] = (200, {
+        'Id': 'sha256:1234',
+        'RepoDigests': ['other/image@sha256:0', 'library/image@sha256:5678'],
+    })
+    engine.responses[api_path('containers', 'json', filters={
+        'label': ['userdocker.uid=1000']})] = (200, [{
+            'Id': 'c1', 'Names': ['/job'], 'Created': 1500000000,
+            'Labels': {'userdocker.uid': '1000'},
+        }])
+    assert dockerapi.image_exists(docker, 'library/image')
+    assert not dockerapi.image_exists(docker, 'library/other')
+    assert dockerapi.image_digest(docker, 'library/image') == \
+        ('sha256:1234', 'library/image@sha256:5678')
+    assert dockerapi.containers_labels(
+        docker, ['userdocker.uid', 'userdocker.gpu'],
+        {'label': ['userdocker.uid=1000']}) == [
+        ('c1', '/job', {'userdocker.uid': '1000', 'userdocker.gpu': None},
+         1500000000)]
+    assert cli_calls(docker) == []
+
+
+def test_cli_fallback(socket_path, docker):
+    with open(docker + '.images', 'w') as f:
+        f.write('sha256:1234 library/image@sha256:5678\n')
+    with open(docker + '.ps', 'w') as f:
+        f.write('c1\tjob\t2017-07-14 02:40:00 +0000 UTC\t1000\t\n')
+    assert dockerapi.image_exists(docker, 'library/image')
+    assert not dockerapi._api_usable
+    assert dockerapi.image_digest(docker, 'library/image') == \
+        ('sha256:1234', 'library/image@sha256:5678')
+    assert dockerapi.containers_labels(
+        docker, ['userdocker.uid', 'userdocker.gpu'],
+        {'label': ['userdocker.uid=1000']}) == [
+        ('c1', '/job', {'userdocker.uid': '1000', 'userdocker.gpu': None},
+         1500000000)]
+    assert cli_calls(docker)[-1].startswith('ps --no-trunc --format ')
+    assert cli_calls(docker)[-1].endswith('--filter label=userdocker.uid=1000')
+    assert len(cli_calls(docker)) == 3
+
+
+def test_failed_api_isnt_retried_until_reset(socket_path, docker):
+    with pytest.raises(DockerAPIUnavailable):
+        dockerapi.api_get('/info')
+    server = serve(socket_path)
+    try:
+        server.responses['/info'] = (200, {'ID': 'node'})
+        with pytest.raises(DockerAPIUnavailable):
+            dockerapi.api_get('/info')
+        with pytest.raises(DockerAPIUnavailable):
+            next(dockerapi.api_stream('/events'))
+        assert server.requests == []
+        dockerapi.reset_api()
+        assert dockerapi.api_get('/info') == {'ID': 'node'}
+    finally:
+        server.shutdown()
+        server.server_close()
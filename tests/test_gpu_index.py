@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+import os
+import random
+import time
+
+import pytest
+
+from userdocker.helpers import gpu_index
+from userdocker.helpers.gpu_index import ContainerGPUIndex
+from userdocker.helpers.gpu_index import DOCKER_EVENTS_BUFFER
+from userdocker.helpers.labels import container_owner
+from userdocker.helpers.labels import userdocker_labels
+
+
+class FakeDocker:
+    """Running containers and events of a fake docker daemon.
+
+    Most containers are labeled, some are unlabeled ones of older versions
+    (only found by inspecting them) or weren't started by userdocker.
+    """
+
+    def __init__(self, seed=0, n_gpus=8):
+        self.rng = random.Random(seed)
+        self.n_gpus = n_gpus
+        self.details = {}
+        self.events = []
+        self.n_started = 0
+        self.inspections = 0
+
+    def inspect(self, docker, container):
+        self.inspections += 1
+        return self.details.get(container)
+
+    def _event(self, event_type, action, actor_id, attributes):
+        now = int(time.time() * 10**9)
+        if self.events:
+            now = max(now, self.events[-1]['timeNano'] + 1)
+        self.events.append({
+            'Type': event_type, 'Action': action, 'time': now // 10**9,
+            'timeNano': now,
+            'Actor': {'ID': actor_id, 'Attributes': attributes},
+        })
+
+    def _start(self):
+        container = '%064x' % self.n_started
+        name = 'container%d' % self.n_started
+        self.n_started += 1
+        gpus = self.rng.sample(
+            range(self.n_gpus), self.rng.choice((0, 1, 1, 2)))
+        gpu_str = ','.join(str(g) for g in gpus)
+        kind = self.rng.choice(('labeled',) * 6 + ('env', 'foreign'))
+        labels, env = {}, []
+        if kind == 'labeled':
+            labels = userdocker_labels('user', 1000, gpu_str)
+        elif kind == 'env':
+            env = ['USERDOCKER_USER=user', 'USERDOCKER_UID=1000']
+            if gpus:
+                env.append('USERDOCKER_NV_GPU=%s' % gpu_str)
+        self.details[container] = {
+            'Id': container, 'Name': '/' + name,
+            'Config': {'Labels': labels, 'Env': env},
+            'State': {'StartedAt': time.strftime(
+                '%Y-%m-%dT%H:%M:%S.000000000Z', time.gmtime())},
+        }
+        self._event('container', 'start', container,
+                    dict(labels, name=name, image='image'))
+
+    def step(self):
+        """Adds a random event (start, die + destroy or noise)."""
+        r = self.rng.random()
+        if r < 0.4 or not self.details:
+            self._start()
+        elif r < 0.7:
+            container = self.rng.choice(sorted(self.details))
+            del self.details[container]
+            self._event('container', 'die', container, {'exitCode': '0'})
+            self._event('container', 'destroy', container, {})
+        else:
+            self._event(
+                self.rng.choice(('network', 'image', 'volume')),
+                self.rng.choice(('connect', 'pull', 'mount')), 'x', {})
+
+    def steps(self, n):
+        """Adds at least n events, returns the index of the first new one."""
+        first = len(self.events)
+        while len(self.events) - first < n:
+            self.step()
+        return first
+
+    def events_since(self, since):
+        """Returns the events since since (timeNano) docker still buffers."""
+        events = [e for e in self.events if e['timeNano'] >= since]
+        return iter(events[-DOCKER_EVENTS_BUFFER:])
+
+    def gpus_used(self):
+        """Returns {gpu: sorted containers} of the running containers."""
+        used = defaultdict(list)
+        for container, details in sorted(self.details.items()):
+            _, uid, gpus = container_owner(details)
+            unlabeled = not details['Config']['Labels']
+            if uid is None or (
+                    unlabeled and not gpu_index.CONTAINER_LABELS_ENV_FALLBACK):
+                continue
+            for gpu in gpus:
+                used[gpu].append(container)
+        return dict(used)
+
+
+class FakeDockerIndex(ContainerGPUIndex):
+    """Index rebuilding from the running containers of a FakeDocker."""
+
+    rebuilds = 0
+
+    def rebuild(self, docker):
+        since = int(time.time() * 10**9)
+        with self._lock:
+            self.containers.clear()
+            self._by_gpu.clear()
+            self.started.clear()
+            for details in docker.details.values():
+                if details['Config']['Labels'] \
+                        or gpu_index.CONTAINER_LABELS_ENV_FALLBACK:
+                    self.add(details)
+            self.since = since
+        self.rebuilds += 1
+
+
+def index_gpus_used(index):
+    return {
+        gpu: sorted(c for c, _, _, _ in info)
+        for gpu, info in index.gpus_used().items()
+    }
+
+
+@pytest.fixture(params=[True, False], ids=['env_fallback', 'labels_only'])
+def docker(request, monkeypatch):
+    monkeypatch.setattr(
+        gpu_index, 'CONTAINER_LABELS_ENV_FALLBACK', request.param)
+    return FakeDocker(seed=len(request.node.name))
+
+
+@pytest.fixture
+def index(docker):
+    index = FakeDockerIndex(docker.inspect)
+    index.rebuild(docker)
+    return index
+
+
+def test_follow_events(docker, index):
+    docker.steps(1000)
+    assert index.apply_events(docker, iter(docker.events)) == \
+        len(docker.events)
+    assert index_gpus_used(index) == docker.gpus_used()
+    assert index.rebuilds == 1
+    # only unlabeled containers are inspected
+    unlabeled = sum(
+        1 for e in docker.events if e['Action'] == 'start'
+        and 'userdocker.uid' not in e['Actor']['Attributes'])
+    if gpu_index.CONTAINER_LABELS_ENV_FALLBACK:
+        assert docker.inspections == unlabeled
+    else:
+        assert docker.inspections == 0
+
+
+def test_catch_up_within_buffer(docker, index):
+    index.apply_events(docker, iter(docker.events))
+    docker.steps(DOCKER_EVENTS_BUFFER // 2)
+    index.catch_up(docker, docker.events_since(index.since))
+    assert index_gpus_used(index) == docker.gpus_used()
+    assert index.rebuilds == 1
+
+
+def test_catch_up_after_buffer_overflow_rebuilds(docker, index):
+    docker.steps(100)
+    index.apply_events(docker, iter(docker.events))
+    since = index.since
+    # older events are lost, applying the buffered ones isn't enough
+    docker.steps(2 * DOCKER_EVENTS_BUFFER)
+    index.catch_up(docker, docker.events_since(since))
+    assert index_gpus_used(index) == docker.gpus_used()
+    assert index.rebuilds == 2
+
+
+def test_catch_up_rebuilds_old_index(docker, index, monkeypatch):
+    monkeypatch.setattr(gpu_index, 'NV_CONTAINER_GPU_INDEX_MAX_AGE', 0)
+    docker.steps(10)
+    index.catch_up(docker, iter(docker.events))
+    assert index_gpus_used(index) == docker.gpus_used()
+    assert index.rebuilds == 2
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='snapshots are root only')
+def test_snapshot_round_trip(docker, index, tmp_path):
+    docker.steps(200)
+    index.apply_events(docker, iter(docker.events))
+    fn = str(tmp_path / 'gpu_index.json')
+    index.save(fn)
+    loaded = ContainerGPUIndex.load(fn)
+    assert index_gpus_used(loaded) == index_gpus_used(index)
+    assert loaded.started_times() == index.started_times()
+    assert loaded.since == index.since
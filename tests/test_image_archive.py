@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import bz2
+import gzip
+import io
+import json
+import lzma
+import tarfile
+
+import pytest
+
+from userdocker.helpers.exceptions import UserDockerException
+from userdocker.helpers.image_archive import ImageArchiveRejected
+from userdocker.helpers.image_archive import ImageArchiveValidator
+
+
+def tar_archive(members, fmt=tarfile.GNU_FORMAT):
+    """Returns a tar archive of members (name, type, link target or content).
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=fmt) as tar:
+        for name, member_type, data in members:
+            info = tarfile.TarInfo(name)
+            info.type = member_type
+            if member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = data
+                data = ''
+            info.size = len(data.encode())
+            tar.addfile(info, io.BytesIO(data.encode()))
+    return buf.getvalue()
+
+
+def image_archive(tags, fmt=tarfile.GNU_FORMAT):
+    """Returns a small docker save like archive of an image with tags."""
+    return tar_archive([
+        ('%064x/layer.tar' % 1, tarfile.REGTYPE, 'layer data ' * 1000),
+        ('%064x.json' % 2, tarfile.REGTYPE, '{}'),
+        ('manifest.json', tarfile.REGTYPE, json.dumps([{
+            'Config': '%064x.json' % 2, 'RepoTags': tags,
+            'Layers': ['%064x/layer.tar' % 1],
+        }])),
+    ], fmt)
+
+
+def validated_tags(archive, chunk_size=None, authorize=lambda tag: None):
+    """Returns the tags of archive or None if it's rejected."""
+    validator = ImageArchiveValidator(authorize)
+    chunk_size = chunk_size or len(archive)
+    try:
+        for i in range(0, len(archive), chunk_size):
+            validator.feed(archive[i:i + chunk_size])
+        validator.close()
+    except ImageArchiveRejected:
+        return None
+    return validator.tags
+
+
+LINK_CASES = [
+    # symlinked parent directories
+    ([('a', tarfile.SYMTYPE, '.'), ('a/manifest.json', tarfile.REGTYPE, '')],
+     None),
+    ([('d', tarfile.DIRTYPE, ''), ('d/x', tarfile.SYMTYPE, '..'),
+      ('d/x/manifest.json', tarfile.REGTYPE, '')], None),
+    ([('d/x', tarfile.SYMTYPE, '..'), ('d/x/y/../manifest.json',
+                                       tarfile.REGTYPE, '')], None),
+    ([('h', tarfile.LNKTYPE, 'd'), ('h/repositories', tarfile.REGTYPE, '')],
+     None),
+    # metadata after a link to a directory
+    ([('a', tarfile.SYMTYPE, '.'), ('manifest.json', tarfile.REGTYPE, '')],
+     None),
+    ([('d', tarfile.DIRTYPE, ''), ('x', tarfile.SYMTYPE, 'd'),
+      ('manifest.json', tarfile.REGTYPE, '')], None),
+    ([('x', tarfile.SYMTYPE, '/'), ('index.json', tarfile.REGTYPE, '')], None),
+    ([('d/x', tarfile.SYMTYPE, '../..'),
+      ('manifest.json', tarfile.REGTYPE, '')], None),
+    # links named like metadata files
+    ([('manifest.json', tarfile.SYMTYPE, 'x.json')], None),
+    # legacy docker save: layers linking to identical layers
+    ([('1/layer.tar', tarfile.REGTYPE, ''),
+      ('2/layer.tar', tarfile.SYMTYPE, '../1/layer.tar'),
+      ('3/layer.tar', tarfile.SYMTYPE, '../4/layer.tar'),
+      ('4/layer.tar', tarfile.REGTYPE, ''),
+      ('manifest.json', tarfile.REGTYPE,
+       '[{"RepoTags": ["library/image:latest"]}]')],
+     ['library/image:latest']),
+]
+
+
+@pytest.mark.parametrize('members,expected', LINK_CASES)
+def test_links(members, expected):
+    assert validated_tags(tar_archive(members)) == expected
+
+
+@pytest.mark.parametrize('fmt', [
+    tarfile.GNU_FORMAT, tarfile.PAX_FORMAT, tarfile.USTAR_FORMAT])
+@pytest.mark.parametrize('chunk_size', [None, 1, 511, 4096])
+def test_tags_in_any_chunks(fmt, chunk_size):
+    archive = image_archive(['library/a:1', 'library/b:latest'], fmt)
+    assert validated_tags(archive, chunk_size) == \
+        ['library/a:1', 'library/b:latest']
+
+
+@pytest.mark.parametrize('compress', [
+    lambda data: gzip.compress(data, 1),
+    lambda data: bz2.compress(data, 1),
+    lambda data: lzma.compress(data, preset=0),
+], ids=['gzip', 'bzip2', 'xz'])
+def test_compressed_archives(compress):
+    archive = compress(image_archive(['library/a:1']))
+    assert validated_tags(archive, 100) == ['library/a:1']
+
+
+def test_zstd_is_rejected():
+    archive = b'\x28\xb5\x2f\xfd' + b'\0' * 100
+    assert validated_tags(archive) is None
+
+
+def test_corrupt_archive_is_rejected():
+    archive = bytearray(image_archive(['library/a:1']))
+    # header checksum
+    archive[150] ^= 0xff
+    assert validated_tags(bytes(archive)) is None
+
+
+def test_disallowed_tag_stops_before_the_rest():
+    def authorize(tag):
+        if tag != 'library/a:1':
+            raise UserDockerException('ERROR: %s not allowed' % tag)
+
+    archive = image_archive(['library/a:1', 'library/evil:1'])
+    validator = ImageArchiveValidator(authorize)
+    with pytest.raises(UserDockerException, match='evil'):
+        validator.feed(archive)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from userdocker.helpers.image_tree import _image
+from userdocker.helpers.image_tree import build_tree
+from userdocker.helpers.image_tree import dumps_tree_json
+from userdocker.helpers.image_tree import render_tree
+from userdocker.helpers.image_tree import tree_json
+
+
+def chain(depth):
+    """depth intermediate images (classic builder), each the parent of the
+    next one, the last one tagged."""
+    return [
+        _image('sha256:%064x' % i, 'sha256:%064x' % (i - 1) if i else None,
+               ['app:latest'] if i == depth - 1 else [], 1000 * i)
+        for i in range(depth)
+    ]
+
+
+def small_tree():
+    return [
+        _image('sha256:a', None, ['base:1'], 10, ['l1']),
+        _image('sha256:b', None, ['app:1', 'app:latest'], 20, ['l1', 'l2']),
+        _image('sha256:c', 'sha256:a', [], 2000, ['l1', 'l3']),
+        _image('sha256:d', None, None, 5, ['x']),
+    ]
+
+
+def test_tree_json():
+    roots = build_tree(small_tree())
+    assert tree_json(roots) == [
+        {'id': 'sha256:d', 'tags': [], 'size': 5, 'children': []},
+        {'id': 'sha256:a', 'tags': ['base:1'], 'size': 10, 'children': [
+            {'id': 'sha256:c', 'tags': [], 'size': 2000, 'children': []},
+            {'id': 'sha256:b', 'tags': ['app:1', 'app:latest'], 'size': 20,
+             'children': []},
+        ]},
+    ]
+
+
+@pytest.mark.parametrize('images', [[], small_tree(), chain(50)])
+def test_dumps_tree_json_like_json_dumps(images):
+    roots = build_tree(images)
+    assert dumps_tree_json(roots) == json.dumps(tree_json(roots), indent=2)
+
+
+def test_deep_chain():
+    depth = 5000
+    roots = build_tree(chain(depth))
+    assert len(render_tree(roots)) == depth
+
+    node, n = tree_json(roots)[0], 1
+    while node['children']:
+        node, n = node['children'][0], n + 1
+    assert n == depth and node['tags'] == ['app:latest']
+
+    # (json.loads can't parse it either)
+    text = dumps_tree_json(roots)
+    assert text.count('"id": ') == depth
+    assert '\n%s"children": []' % (' ' * 4 * depth) in text
+    assert text.endswith('\n    ]\n  }\n]')
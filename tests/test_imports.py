@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Startup costs of the subcommands (measured in fresh interpreters)."""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs userdocker <subcommand> --help, prints seconds and imported modules
+# (counted via sys.modules, -X importtime doesn't report import_module calls)
+PROBE = '''
+import contextlib, io, json, sys, time
+start = time.perf_counter()
+before = set(sys.modules)
+sys.argv = ['userdocker', sys.argv[1], '--help']
+from userdocker.userdocker import main
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        main()
+except SystemExit:
+    pass
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'modules': sorted(set(sys.modules) - before),
+}))
+'''
+
+# subcommand: (max imported modules, max seconds), the module caps are ~20 %
+# above the current counts, the time caps ~5x the current times to not fail on
+# busy machines
+STARTUP_CAPS = {
+    'attach': (125, 0.5),
+    'dockviz': (125, 0.5),
+    'images': (70, 0.25),
+    'load': (130, 0.5),
+    'network': (125, 0.5),
+    'ps': (150, 0.6),
+    'pull': (140, 0.5),
+    'run': (160, 0.6),
+    'version': (70, 0.25),
+}
+
+# other subcommand modules a subcommand imports names from
+RELATED_SUBCOMMANDS = {
+    'run': {'network'},
+}
+
+
+def probe(scmd):
+    out = subprocess.check_output(
+        [sys.executable, '-c', PROBE, scmd], cwd=REPO_DIR,
+        env=dict(os.environ, PYTHONPATH=REPO_DIR, SUDO_UID='1000',
+                 SUDO_GID='1000', SUDO_USER='nobody'),
+    )
+    return json.loads(out.decode())
+
+
+@pytest.mark.parametrize('scmd', sorted(STARTUP_CAPS))
+def test_startup_caps(scmd):
+    max_modules, max_seconds = STARTUP_CAPS[scmd]
+    res = probe(scmd)
+    assert len(res['modules']) <= max_modules, res['modules']
+    assert res['seconds'] <= max_seconds
+
+
+@pytest.mark.parametrize('scmd', sorted(STARTUP_CAPS))
+def test_only_requested_subcommand_imported(scmd):
+    package = 'userdocker.subcommands.'
+    imported = {
+        m[len(package):] for m in probe(scmd)['modules']
+        if m.startswith(package)
+    }
+    assert imported == {scmd} | RELATED_SUBCOMMANDS.get(scmd, set())
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import pytest
+
+from userdocker.helpers import pinning
+
+
+pytestmark = pytest.mark.skipif(
+    os.geteuid() != 0, reason='job pins are root only')
+
+
+class Registry(object):
+    """Fake image_digest, tags can be moved, nodes have local images."""
+
+    def __init__(self):
+        self.tags = {'img:latest': 'sha256:aaaa'}
+        self.pulled = []
+
+    def image_digest(self, docker, image):
+        if '@' in image:
+            if docker == 'node2' and image not in self.pulled:
+                return None
+            return 'id', image
+        return 'id', 'img@' + self.tags[image]
+
+    def pull(self, image):
+        self.pulled.append(image)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    os.chmod(str(tmp_path), 0o755)
+    shared = str(tmp_path / 'shared') + '/'
+    monkeypatch.setattr(pinning, 'SLURM_PIN_DIR', shared)
+    monkeypatch.setattr(pinning, 'PINS_DIR', shared)
+    monkeypatch.setattr(pinning, 'SLURM_PIN_TIMEOUT', 2)
+    monkeypatch.setattr(pinning, 'PIN_POLL_INTERVAL', 0.05)
+    r = Registry()
+    monkeypatch.setattr(pinning, 'image_digest', r.image_digest)
+    return r
+
+
+def on_node(monkeypatch, tmp_path, node):
+    monkeypatch.setattr(
+        pinning, 'JOBS_DIR', str(tmp_path / node / 'jobs') + '/')
+
+
+def test_nodes_share_the_pin(registry, tmp_path, monkeypatch):
+    on_node(monkeypatch, tmp_path, 'node1')
+    assert pinning.pin_job_image(
+        'node1', '42', 'img:latest', registry.pull, procid='0'
+    ) == 'img@sha256:aaaa'
+    registry.tags['img:latest'] = 'sha256:bbbb'  # tag moves
+    on_node(monkeypatch, tmp_path, 'node2')
+    assert pinning.pin_job_image(
+        'node2', '42', 'img:latest', registry.pull, procid='1'
+    ) == 'img@sha256:aaaa'
+    # node2 lacked the pinned image and pulled it by digest
+    assert registry.pulled == ['img@sha256:aaaa']
+
+
+def test_tasks_wait_for_procid_0(registry, tmp_path, monkeypatch):
+    on_node(monkeypatch, tmp_path, 'node1')
+    res = []
+    t = threading.Thread(target=lambda: res.append(pinning.pin_job_image(
+        'node1', '42', 'img:latest', procid='1')))
+    t.start()
+    time.sleep(0.2)
+    registry.tags['img:latest'] = 'sha256:bbbb'
+    pinning.save_pin('42', 'img:latest', 'img@sha256:aaaa')
+    t.join()
+    assert res == ['img@sha256:aaaa']
+
+
+def test_missing_pin_times_out(registry, tmp_path, monkeypatch):
+    on_node(monkeypatch, tmp_path, 'node1')
+    monkeypatch.setattr(pinning, 'SLURM_PIN_TIMEOUT', 0.2)
+    assert pinning.pin_job_image(
+        'node1', '42', 'img:latest', procid='3') == 'img@sha256:aaaa'
+
+
+def test_node_local_pins(registry, tmp_path, monkeypatch):
+    on_node(monkeypatch, tmp_path, 'node1')
+    monkeypatch.setattr(pinning, 'SLURM_PIN_DIR', None)
+    monkeypatch.setattr(pinning, 'PINS_DIR', pinning.JOBS_DIR)
+    # without a shared dir any task may resolve, no waiting
+    assert pinning.pin_job_image(
+        'node1', '42', 'img:latest', procid='5') == 'img@sha256:aaaa'
+    registry.tags['img:latest'] = 'sha256:bbbb'
+    assert pinning.pin_job_image(
+        'node1', '42', 'img:latest', procid='0') == 'img@sha256:aaaa'
+
+
+def test_prune_pins(registry, tmp_path, monkeypatch):
+    on_node(monkeypatch, tmp_path, 'node1')
+    pinning.pin_job_image('node1', 'old', 'img:latest', procid='0')
+    old = [pinning._lock_fn('old'), pinning._pin_fn('old', 'img:latest')]
+    for fn in old:
+        os.utime(fn, (0, 0))
+    pinning.pin_job_image('node1', 'new', 'img:latest', procid='0')
+    assert not any(os.path.exists(fn) for fn in old)
+    assert pinning.load_pin('new', 'img:latest') == 'img@sha256:aaaa'
+    assert os.path.exists(pinning._lock_fn('new'))
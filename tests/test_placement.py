@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from userdocker.helpers.placement import gpu_domains
+from userdocker.helpers.placement import place_gpus
+
+
+def pcie_topology(sockets, gpus_per_socket):
+    """GPU pairs share a PCIe switch (PIX), GPUs of a socket its host bridges
+    (NODE), sockets are linked by SYS."""
+    n_gpus = sockets * gpus_per_socket
+    return {
+        a: {
+            b: 'SYS' if a // gpus_per_socket != b // gpus_per_socket
+            else 'PIX' if a // 2 == b // 2 else 'NODE'
+            for b in range(n_gpus) if b != a
+        } for a in range(n_gpus)
+    }
+
+
+TOPOLOGY = pcie_topology(2, 4)
+
+
+def test_gpu_domains():
+    assert gpu_domains(range(8), TOPOLOGY) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    # GPUs without topology are domains of their own
+    assert gpu_domains([0, 4, 9], TOPOLOGY) == [[0], [4], [9]]
+
+
+@pytest.mark.parametrize('policy,free,count,expected', [
+    ('default', [5, 1, 0, 4], 2, [5, 1]),
+    ('topology', [0, 2, 4, 5], 2, [4, 5]),
+    # socket 0 has 1 GPU in use
+    ('pack', [1, 2, 3, 4, 5, 6, 7], 2, [2, 3]),
+    ('spread', [1, 2, 3, 4, 5, 6, 7], 2, [4, 5]),
+    ('best_fit', [2, 3, 4, 5, 6, 7], 2, [2, 3]),
+    ('best_fit', [0, 1, 2, 4, 5], 3, [0, 1, 2]),
+    # no domain with enough free GPUs: span the fewest domains
+    ('best_fit', [0, 1, 2, 5, 6], 4, [0, 1, 2, 5]),
+    ('pack', [0, 4, 5, 6], 4, [0, 4, 5, 6]),
+    # not enough free GPUs
+    ('spread', [0, 4], 3, [0, 4]),
+])
+def test_place_gpus(policy, free, count, expected):
+    assert sorted(place_gpus(policy, free, count, TOPOLOGY, range(8))) == \
+        sorted(expected)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from userdocker.helpers import policy as policy_module
+from userdocker.helpers.exceptions import UserDockerException
+from userdocker.helpers.policy import Policy
+from userdocker.helpers.policy import resolve_untrusted_path
+
+
+# neither owning nor in the group of the test dirs
+OTHER_UID = 54321
+OTHER_GID = 54321
+
+
+@pytest.fixture
+def data(tmp_path):
+    """tmp_path/data with alice/results in it (like a /data/* grant)."""
+    data = tmp_path / 'data'
+    (data / 'alice' / 'results').mkdir(parents=True)
+    os.symlink('/etc', str(data / 'alice' / 'evil'))
+    return data
+
+
+def test_resolves_normalized_path(data):
+    path = str(data) + '//alice/./results/'
+    assert resolve_untrusted_path(path, OTHER_UID) == \
+        str(data / 'alice' / 'results')
+
+
+@pytest.mark.parametrize('path', [
+    'nonexist/../alice/evil',
+    'alice/../alice/results',
+    'alice/results/..',
+])
+def test_rejects_dotdot(data, path):
+    with pytest.raises(UserDockerException, match=r'\.\.'):
+        resolve_untrusted_path(str(data / path), OTHER_UID)
+
+
+@pytest.mark.parametrize('path', ['nonexist', 'alice/nonexist/results'])
+def test_rejects_missing_components(data, path):
+    with pytest.raises(UserDockerException, match="can't access"):
+        resolve_untrusted_path(str(data / path), OTHER_UID)
+
+
+def test_rejects_relative_path(data):
+    with pytest.raises(UserDockerException):
+        resolve_untrusted_path('data/alice', OTHER_UID)
+
+
+@pytest.mark.parametrize('path', ['alice/evil', 'alice/link/results'])
+def test_rejects_symlink_components(data, path):
+    os.symlink('.', str(data / 'alice' / 'link'))
+    with pytest.raises(UserDockerException, match='symlink'):
+        resolve_untrusted_path(str(data / path), OTHER_UID)
+
+
+def test_rejects_world_writable_components(data):
+    os.chmod(str(data / 'alice'), 0o777)
+    with pytest.raises(UserDockerException, match='may write'):
+        resolve_untrusted_path(str(data / 'alice' / 'results'), OTHER_UID)
+
+
+def test_allows_sticky_world_writable_components(data):
+    os.chmod(str(data / 'alice'), 0o1777)
+    assert resolve_untrusted_path(
+        str(data / 'alice' / 'results'), OTHER_UID) == \
+        str(data / 'alice' / 'results')
+
+
+def test_rejects_group_writable_components_of_members(data):
+    path = str(data / 'alice' / 'results')
+    os.chmod(str(data / 'alice'), 0o775)
+    group = os.stat(str(data / 'alice')).st_gid
+    assert resolve_untrusted_path(path, OTHER_UID, [OTHER_GID]) == path
+    with pytest.raises(UserDockerException, match='may write'):
+        resolve_untrusted_path(path, OTHER_UID, [OTHER_GID, group])
+
+
+def test_rejects_owned_components(data):
+    path = str(data / 'alice' / 'results')
+    owner = os.stat(str(data / 'alice')).st_uid
+    with pytest.raises(UserDockerException, match='own'):
+        resolve_untrusted_path(path, owner)
+
+
+def test_prefix_grant_mounts_resolved_path(data, monkeypatch):
+    monkeypatch.setattr(policy_module, 'uid', OTHER_UID)
+    monkeypatch.setattr(policy_module, 'gid', OTHER_GID)
+    monkeypatch.setattr(policy_module, 'gids', [])
+    p = Policy(mounts_always=[], mounts_default=[],
+               mounts_available=[str(data) + '/*::ro'])
+    assert p.authorize_mounts(
+        [str(data) + '/alice//results/.:/results'], False) == \
+        [str(data / 'alice' / 'results') + ':/results:ro']
+
+
+@pytest.mark.parametrize('path', [
+    'nonexist/../alice/evil', 'alice/evil', 'alice/nonexist'])
+def test_prefix_grant_rejects_unsafe_paths(data, monkeypatch, path):
+    monkeypatch.setattr(policy_module, 'uid', OTHER_UID)
+    monkeypatch.setattr(policy_module, 'gid', OTHER_GID)
+    monkeypatch.setattr(policy_module, 'gids', [])
+    p = Policy(mounts_always=[], mounts_default=[],
+               mounts_available=[str(data) + '/*'])
+    with pytest.raises(UserDockerException):
+        p.authorize_mounts([str(data / path) + ':/mnt'], False)
+
+
+def test_paths_outside_grants_are_not_checked(data):
+    p = Policy(mounts_always=[], mounts_default=[],
+               mounts_available=[str(data) + '/*'])
+    with pytest.raises(UserDockerException, match='not allowed'):
+        p.authorize_mounts(['/nonexist/../etc:/mnt'], False)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import os
+
+import pytest
+
+from userdocker.helpers import pulls
+
+
+needs_root = pytest.mark.skipif(
+    os.geteuid() != 0, reason='pull records are root only')
+
+# logs its args, pulls take a second
+FAKE_DOCKER = """#!/bin/sh
+echo "$*" >> "$0.log"
+[ "$1" = pull ] && sleep 1
+exit 0
+"""
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    """Fake docker executable, pulls recorded in tmp_path."""
+    monkeypatch.setattr(pulls, 'PULLS_DIR', str(tmp_path / 'pulls') + '/')
+    monkeypatch.setattr(pulls, 'PULL_LOCK_POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(
+        pulls, 'image_digest',
+        lambda docker, image: ('sha256:1234', image + '@sha256:5678'))
+    fn = str(tmp_path / 'docker')
+    with open(fn, 'w') as f:
+        f.write(FAKE_DOCKER)
+    os.chmod(fn, 0o755)
+    return fn
+
+
+def docker_pulls(docker):
+    try:
+        with open(docker + '.log') as f:
+            return [line.split() for line in f if line.startswith('pull ')]
+    except FileNotFoundError:
+        return []
+
+
+@pytest.mark.parametrize('image,pull_args,key', [
+    ('library/image', (), 'library/image:latest'),
+    ('library/image:1.0', (), 'library/image:1.0'),
+    ('registry:5000/image', (), 'registry:5000/image:latest'),
+    ('library/image@sha256:ab', (), 'library/image@sha256:ab'),
+    ('library/image', ('-q',), '-q library/image:latest'),
+])
+def test_pull_key(image, pull_args, key):
+    assert pulls.pull_key(image, pull_args) == key
+
+
+@needs_root
+def test_concurrent_pulls_pull_once(docker):
+    # with and without :latest (same pull key), in processes like concurrent
+    # invocations
+    ctx = multiprocessing.get_context('fork')
+    procs = [
+        ctx.Process(target=pulls.pull_image, args=(docker, image),
+                    kwargs={'loglvl': logging.DEBUG})
+        for image in ['library/image', 'library/image:latest'] * 4
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert [proc.exitcode for proc in procs] == [0] * len(procs)
+    # by whichever process got the lock first
+    assert docker_pulls(docker) in (
+        [['pull', '--', 'library/image']],
+        [['pull', '--', 'library/image:latest']],
+    )
+
+
+@needs_root
+def test_fresh_pulls_are_skipped(docker):
+    # implicit pulls (run) with max_age = PULL_FRESHNESS
+    assert pulls.pull_image(docker, 'library/image', max_age=60) == 0
+    assert pulls.pull_image(docker, 'library/image:latest', max_age=60) == 0
+    assert len(docker_pulls(docker)) == 1
+    assert pulls.last_pull('library/image:latest')['digest'] == \
+        'library/image@sha256:5678'
+    # other pull args, other key
+    assert pulls.pull_image(docker, 'library/image', ['-q'], max_age=60) == 0
+    assert len(docker_pulls(docker)) == 2
+
+
+@needs_root
+def test_explicit_pulls_always_pull(docker):
+    # e.g., the tag was just pushed again
+    assert pulls.pull_image(docker, 'library/image') == 0
+    assert pulls.pull_image(docker, 'library/image') == 0
+    assert len(docker_pulls(docker)) == 2
+
+
+@needs_root
+def test_hung_pull_times_out(docker, monkeypatch):
+    monkeypatch.setattr(pulls, 'PULL_LOCK_TIMEOUT', 0.2)
+    # a concurrent pull holding the lock forever
+    with pulls.pull_lock('library/image:latest'):
+        assert pulls.pull_image(docker, 'library/image') == 0
+    assert docker_pulls(docker) == [['pull', '--', 'library/image']]
+
+
+def test_dry_run_doesnt_pull(docker):
+    pulls.pull_image(docker, 'library/image', dry_run=True)
+    assert docker_pulls(docker) == []
+
+
+@needs_root
+def test_pull_images_pulls_each_image_once(docker):
+    statuses = pulls.pull_images(
+        docker, ['library/a', 'library/bb', 'library/a'])
+    assert statuses == {'library/a': 0, 'library/bb': 0}
+    assert sorted(args[-1] for args in docker_pulls(docker)) == \
+        ['library/a', 'library/bb']
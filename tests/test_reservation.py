@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+import multiprocessing
+import os
+import stat
+
+import pytest
+
+from userdocker import config
+
+
+needs_root = pytest.mark.skipif(
+    os.geteuid() != 0, reason='the GPU reservation ledger is root only')
+
+
+def _config_overrides(runtime_dir, n_gpus, gpus_per_run):
+    """Config of a node with n_gpus idle fake GPUs, no containers / images."""
+    fake_docker = runtime_dir + 'docker'
+    with open(fake_docker, 'w') as f:
+        f.write('#!/bin/sh\nexit 0\n')
+    os.chmod(fake_docker, stat.S_IRWXU)
+    return {
+        'RUNTIME_DIR': runtime_dir,
+        'USERDOCKERD_SOCKET': runtime_dir + 'userdockerd.sock',
+        'DOCKER_SOCKET': runtime_dir + 'docker.sock',
+        'EXECUTORS': {'docker': fake_docker, 'nvidia-docker': fake_docker},
+        'ALLOWED_SUBCOMMANDS': ['run'],
+        'ALLOWED_IMAGE_REGEXPS': ['^library/image:latest$'],
+        'VOLUME_MOUNTS_ALWAYS': [],
+        'VOLUME_MOUNTS_DEFAULT': [],
+        'RUN_PULL': 'default',
+        'NV_GPU_QUERY_BACKEND': 'fake',
+        'NV_FAKE_GPU_STATS': {gpu: (0, 0) for gpu in range(n_gpus)},
+        'NV_GPU_SAMPLE_COUNT': 1,
+        'NV_ALLOWED_GPUS': 'ALL',
+        'NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED': 0,
+        'NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION': -1,
+        'NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION': True,
+        'NV_DEFAULT_GPU_COUNT_RESERVATION': gpus_per_run,
+        'NV_CONTAINER_GPU_INDEX': False,
+        'NV_PLACEMENT_POLICY': 'default',
+        'NV_CPU_NUMA_PINNING': False,
+    }
+
+
+def _dry_run(overrides, results, barrier):
+    """Runs userdocker run --dry-run in a fresh (spawned) interpreter.
+
+    The modules binding the config values aren't imported yet, so they see
+    the overrides.
+    """
+    import sys
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    for key in ('NV_GPU', 'CUDA_VISIBLE_DEVICES', 'SLURM_JOBID'):
+        os.environ.pop(key, None)
+    from userdocker.helpers.exceptions import UserDockerException
+    from userdocker.userdocker import parse_and_exec_cmd
+    sys.argv = ['userdocker', '-q', '--dry-run', '--executor',
+                'nvidia-docker', 'run', 'library/image']
+    try:
+        parse_and_exec_cmd()
+    except SystemExit:
+        # dry run exits after printing the docker command
+        pass
+    except UserDockerException:
+        os.environ.pop('NV_GPU', None)
+    gpus = os.environ.get('NV_GPU')
+    results.put([int(g) for g in gpus.split(',')] if gpus else None)
+    # keep the reservation alive until all runs are done
+    barrier.wait()
+
+
+@needs_root
+@pytest.mark.parametrize('n_runs,n_gpus,gpus_per_run', [
+    (16, 8, 1),
+    (6, 8, 3),
+])
+def test_concurrent_runs_get_disjoint_gpus(
+        tmp_path, n_runs, n_gpus, gpus_per_run):
+    overrides = _config_overrides(str(tmp_path) + '/', n_gpus, gpus_per_run)
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    barrier = ctx.Barrier(n_runs)
+    procs = [
+        ctx.Process(target=_dry_run, args=(overrides, results, barrier))
+        for _ in range(n_runs)
+    ]
+    for proc in procs:
+        proc.start()
+    granted = [gpus for gpus in (results.get(timeout=60) for _ in procs)
+               if gpus]
+    for proc in procs:
+        proc.join()
+
+    all_gpus = [gpu for gpus in granted for gpu in gpus]
+    assert len(all_gpus) == len(set(all_gpus)), granted
+    assert len(granted) == min(n_runs, n_gpus // gpus_per_run)
+    assert all(len(gpus) == gpus_per_run for gpus in granted)
+
+
+@needs_root
+def test_reservations_count_as_used(tmp_path, monkeypatch):
+    from userdocker.helpers import reservation
+    monkeypatch.setattr(
+        reservation, 'LEDGER_FN', str(tmp_path / 'gpu_reservations.json'))
+    reservation.reserve_gpus('job_1', [0, 2], 'alice_job_1')
+    reservation.reserve_gpus('job_1', [5], 'alice_job_1')
+    assert reservation.reserved_gpus('job_1') == [0, 2]
+    assert reservation.reserved_gpus('job_2') is None
+
+    used = defaultdict(list)
+    used[2].append(('c1', '/alice_job_1_0', 'alice', 1000))
+    reservation.add_reservations_to_gpus_used(used)
+    assert used[0] == [('', 'alice_job_1*', reservation.user_name,
+                        reservation.uid)]
+    assert len(used[2]) == 1
+
+
+@needs_root
+def test_reservations_of_dead_processes_expire(tmp_path, monkeypatch):
+    from userdocker.helpers import reservation
+    monkeypatch.setattr(
+        reservation, 'LEDGER_FN', str(tmp_path / 'gpu_reservations.json'))
+    with monkeypatch.context() as m:
+        # above the maximal pid_max
+        m.setattr(os, 'getpid', lambda: 2 ** 22 + 1)
+        reservation.reserve_gpus('job_1', [0], 'alice_job_1')
+    assert reservation.load_reservations() == []
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from userdocker.helpers import gpu_query
+from userdocker.helpers import topology
+from userdocker.helpers.gpu_query import parse_nvidia_smi_topology
+from userdocker.helpers.gpu_query import query_gpu_topology
+from userdocker.helpers.topology import select_best_connected
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture_fn(node):
+    return os.path.join(FIXTURES_DIR, 'topo_%s.txt' % node)
+
+
+def load_topology(node):
+    with open(fixture_fn(node)) as f:
+        return parse_nvidia_smi_topology(f.read())
+
+
+@pytest.fixture
+def greedy_calls(monkeypatch):
+    """Counts the selections built greedily (above MAX_SUBSETS)."""
+    calls = []
+    greedy_subsets = topology._greedy_subsets
+
+    def counting_greedy_subsets(*args):
+        calls.append(args)
+        return greedy_subsets(*args)
+
+    monkeypatch.setattr(topology, '_greedy_subsets', counting_greedy_subsets)
+    return calls
+
+
+@pytest.mark.parametrize('node,n_gpus,links', [
+    ('dgx1', 8, {(0, 3): 'NV2', (0, 1): 'NV1', (0, 5): 'SYS', (6, 7): 'NV2'}),
+    ('dgx2', 16, {(0, 15): 'NV6', (3, 9): 'NV6'}),
+    ('pcie', 8, {(0, 1): 'PIX', (0, 2): 'PXB', (4, 6): 'NODE', (3, 4): 'SYS'}),
+])
+def test_parse_fixtures(node, n_gpus, links):
+    topo = load_topology(node)
+    assert sorted(topo) == list(range(n_gpus))
+    for gpu, others in topo.items():
+        assert sorted(others) == [g for g in range(n_gpus) if g != gpu]
+        assert all(topo[other][gpu] == link for other, link in others.items())
+    for (a, b), link in links.items():
+        assert topo[a][b] == link
+
+
+def test_fake_backend_reads_recorded_topology(monkeypatch):
+    monkeypatch.setattr(gpu_query, 'NV_FAKE_GPU_TOPOLOGY', fixture_fn('dgx1'))
+    assert query_gpu_topology(backend='fake') == load_topology('dgx1')
+
+
+# (node, free GPUs in order of preference, count, expected selection)
+SELECTIONS = [
+    # NV2 pairs, the most preferred one
+    ('dgx1', list(range(8)), 2, [0, 3]),
+    ('dgx1', [0, 1, 2, 5, 6, 7], 2, [1, 2]),
+    ('dgx1', [5, 6, 0, 1, 2, 3, 4, 7], 2, [5, 6]),
+    # the fully NVLinked quads of the cube-mesh
+    ('dgx1', list(range(8)), 4, [0, 1, 2, 3]),
+    ('dgx1', [4, 5, 6, 7, 0, 1, 2, 3], 4, [4, 5, 6, 7]),
+    ('dgx1', list(range(8)), 3, [0, 2, 3]),
+    # no NVLinked quad left: SYS links either way, then the most NVLinks
+    ('dgx1', [0, 1, 2, 4, 5, 6], 4, [1, 2, 5, 6]),
+    ('pcie', list(range(8)), 2, [0, 1]),
+    ('pcie', [0, 2, 4, 5], 2, [4, 5]),
+    # PXB beats NODE
+    ('pcie', list(range(8)), 4, [0, 1, 2, 3]),
+    ('pcie', [0, 2, 3, 4, 5, 6, 7], 3, [0, 2, 3]),
+    ('pcie', [4, 5, 6, 7, 0, 1, 2], 4, [4, 5, 6, 7]),
+    # all links equal: the most preferred GPUs
+    ('dgx2', list(range(16)), 4, [0, 1, 2, 3]),
+    ('dgx2', list(reversed(range(16))), 2, [15, 14]),
+]
+
+
+@pytest.mark.parametrize('node,free,count,expected', SELECTIONS)
+def test_select_exhaustively(node, free, count, expected, greedy_calls):
+    assert select_best_connected(free, count, load_topology(node)) == \
+        expected
+    assert not greedy_calls
+
+
+@pytest.mark.parametrize('node,free,count,expected', SELECTIONS)
+def test_select_greedily(
+        node, free, count, expected, greedy_calls, monkeypatch):
+    monkeypatch.setattr(topology, 'MAX_SUBSETS', 0)
+    assert select_best_connected(free, count, load_topology(node)) == \
+        expected
+    assert greedy_calls
+
+
+@pytest.mark.parametrize('free,count,expected', [
+    # C(16, 8) = 12870 candidate subsets
+    (list(range(16)), 8, list(range(8))),
+    (list(reversed(range(16))), 8, list(reversed(range(8, 16)))),
+    (list(range(1, 16, 2)) + list(range(0, 16, 2)), 8,
+     list(range(1, 16, 2))),
+])
+def test_select_greedily_above_max_subsets(
+        free, count, expected, greedy_calls):
+    assert select_best_connected(free, count, load_topology('dgx2')) == \
+        expected
+    assert greedy_calls
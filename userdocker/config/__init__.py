@@ -2,8 +2,14 @@
 
 from glob import glob
 import grp
+import marshal
 import os
 import pwd
+import sys
+
+from .cache import is_trusted as _is_trusted
+from .cache import write_atomic as _write_atomic
+from .identity import member_groups as _member_groups
 
 
 uid = os.getuid()
@@ -14,15 +20,46 @@ user_pwd = pwd.getpwuid(uid)
 user_name = user_pwd.pw_name
 user_home = user_pwd.pw_dir
 group_name = grp.getgrgid(gid).gr_name
-group_names = []
-gids = []
-for _g in grp.getgrall():
-    if user_name in _g.gr_mem:
-        group_names.append(_g.gr_name)
-        gids.append(_g.gr_gid)
+# groups listing the user as member (see identity.py)
+_groups = _member_groups(uid, user_name, user_pwd.pw_gid)
+group_names = [_gn for _gn, _ in _groups]
+gids = [_gid for _, _gid in _groups]
 del user_pwd
 
 
+# Compiled config files are cached in a root owned dir (one file per uid).
+# The cache is keyed on the uid/gid set and the stat info of all config files
+# to load, so any change to a config layer invalidates it.
+_cache_dir = '/var/cache/userdocker/'
+
+
+def _compile_configs(cfns):
+    """Returns the compiled code objects for cfns and the cache status."""
+    key = (sys.implementation.cache_tag, uid, tuple(gids), user_name, tuple(
+        (cfn, st.st_mtime_ns, st.st_size, st.st_ino)
+        for cfn, st in ((cfn, os.stat(cfn)) for cfn in cfns)
+    ))
+    cache_fn = _cache_dir + 'config_uid_%d.marshal' % uid
+    try:
+        if _is_trusted(cache_fn):
+            with open(cache_fn, 'rb') as cf:
+                cached_key, codes = marshal.load(cf)
+            if cached_key == key:
+                return codes, 'hit'
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    codes = []
+    for cfn in cfns:
+        with open(cfn) as cf:
+            codes.append(compile(cf.read(), cfn, 'exec'))
+    try:
+        _write_atomic(cache_fn, marshal.dumps((key, tuple(codes))))
+    except OSError as e:
+        return codes, 'miss (not cached: %s)' % e
+    return codes, 'miss'
+
+
 # see default.py for explanation on config load order
 from .default import *
 configs_loaded = ['default']
@@ -38,17 +75,18 @@ _cfns = (
     + glob(_cd + 'user/config_%s.py' % user_name)
     + glob(_cd + 'uid/config_%d.py' % uid)
 )
-for _cfn in _cfns:
-    with open(_cfn) as _cf:
-        exec(_cf.read())
-        configs_loaded.append(_cfn)
+_codes, configs_cache = _compile_configs(_cfns)
+for _cfn, _code in zip(_cfns, _codes):
+    exec(_code)
+    configs_loaded.append(_cfn)
 
 
 # helpers to show final config
 def items():
     masked = (
         # imports:
-        'default', 'glob', 'grp', 'os', 'pwd',
+        'arguments', 'cache', 'default', 'glob', 'grp', 'identity', 'marshal',
+        'os', 'pwd', 'sys',
         # methods:
         'items', 'path',
     )
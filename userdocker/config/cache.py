@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for root owned cache files.
+
+Cached data influences which permissions a user gets, so it's only trusted if
+nobody but root could have written it.
+"""
+
+import os
+
+
+def is_trusted(fn):
+    """Checks that fn and its dir are owned by root and not writable by others.
+    """
+    for _fn in (os.path.dirname(fn), fn):
+        st = os.stat(_fn)
+        if st.st_uid != 0 or st.st_mode & 0o022:
+            return False
+    return True
+
+
+def write_atomic(fn, data, mode=0o644):
+    """Atomically replaces fn with data (bytes), creates its dir if needed.
+
+    Raises OSError (e.g., PermissionError if not running as root).
+    """
+    if os.geteuid() != 0:
+        raise PermissionError('only root may write caches: %s' % fn)
+    os.makedirs(os.path.dirname(fn), mode=0o755, exist_ok=True)
+    tmp_fn = '%s.%d' % (fn, os.getpid())
+    fd = os.open(tmp_fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.fchmod(fd, mode)  # independent of umask
+        with open(fd, 'wb', closefd=False) as f:
+            f.write(data)
+    finally:
+        os.close(fd)
+    os.replace(tmp_fn, fn)
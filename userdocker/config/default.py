@@ -54,6 +54,25 @@ EXECUTORS = {
 }
 EXECUTOR_DEFAULT = 'docker'
 
+# Pass-through commands (e.g., attach, images, load, version) replace the
+# userdocker process with the executor (exec) instead of waiting for it as a
+# child process. This saves a process per session and passes signals and tty
+# directly. Set to False to always keep userdocker as the parent process. pull
+# never execs: it waits for docker pull to coalesce it with concurrent pulls
+# and record it.
+EXEC_REPLACE_PROCESS = True
+
+# Read-only queries (e.g., listing and inspecting containers for GPU arbitration
+# or the attach permission check) are sent directly to the docker engine API via
+# the following unix socket. This avoids forking the docker CLI for each query.
+# If the socket can't be used, userdocker falls back to the executors above.
+# Set this to None to always use the docker CLI.
+DOCKER_SOCKET = '/var/run/docker.sock'
+
+# Root owned dir for node local runtime state (e.g., locks and sockets). Should be
+# on a tmpfs, so it's cleared on reboot.
+RUNTIME_DIR = '/run/userdocker/'
+
 # The following allows you to specify which docker top level commands a user can
 # run at all (still restricted by the following settings):
 ALLOWED_SUBCOMMANDS = [
@@ -81,7 +100,20 @@ ALLOWED_SUBCOMMANDS = [
 #   on the overlay network. Must be separate from SLURM_NETWORK_SUBNET.
 # - SLURM_NETWORK_ADDRESS_OFFSET is added to the last part of the container IP
 #   address to avoid "X.Y.Z.0" for SLURM_PROCID 0.
+# - SLURM_PIN_IMAGE_DIGEST: the image is resolved to its digest once per job,
+#   all tasks of the job run image@sha256:... (even if the tag moves meanwhile).
+# - SLURM_PIN_DIR: a directory shared by all nodes (e.g., on NFS, writable by
+#   root on all nodes, not writable by others). The task with SLURM_PROCID 0
+#   publishes the digest there, the other tasks wait up to SLURM_PIN_TIMEOUT
+#   seconds for it (and pull it if needed). If None, the first task of a job
+#   on each node resolves the image for that node (in RUNTIME_DIR).
+# - SLURM_PIN_MAX_AGE: pin and lock files of jobs unused for this many seconds
+#   are removed.
 SLURM_BIND_GPU = True
+SLURM_PIN_IMAGE_DIGEST = True
+SLURM_PIN_DIR = None
+SLURM_PIN_TIMEOUT = 120
+SLURM_PIN_MAX_AGE = 7 * 24 * 3600
 SLURM_NETWORK_SUBNET = '10.0.0.0/16'
 SLURM_NETWORK_IPRANGE = '10.0.255.0/24'
 SLURM_NETWORK_ADDRESS_OFFSET = 10
@@ -160,8 +192,16 @@ ADDITIONAL_ARGS = []
 #   "host_path:container_path[:flags]" form. If container_path is empty, the
 #   user may select one. If you don't specify a flag, the user can append a
 #   "ro" to guard herself (for any allowed mount).
+# - A host_path ending in "/*" in VOLUME_MOUNTS_AVAILABLE grants the dir and
+#   all its sub-dirs. The container_path must then be empty or also end in
+#   "/*" (sub-dirs are mounted at the same relative path). docker only mounts
+#   the path after the check, so paths the user could change meanwhile are
+#   refused: paths with ".." or symlinks, missing paths and paths with a
+#   component owned or writable by the user (e.g., their own dirs in
+#   "/projects/*", grant those literally or via VOLUME_MOUNTS_DEFAULT).
 # Example:
-# VOLUME_MOUNTS_AVAILABLE = ['/scratch:/scratch', '/data:/input:ro', '/foo:']
+# VOLUME_MOUNTS_AVAILABLE = ['/scratch:/scratch', '/data:/input:ro', '/foo:',
+#                            '/projects/*:/projects/*', '/datasets/*::ro']
 VOLUME_MOUNTS_ALWAYS = []
 VOLUME_MOUNTS_AVAILABLE = []
 VOLUME_MOUNTS_DEFAULT = [
@@ -180,6 +220,12 @@ VOLUME_MOUNTS_DEFAULT = [
 # This setting issues a listdir for used host dirs in mounts.
 # Useful for server-side auto-mounts.
 PROBE_USED_MOUNTS = True
+# Mount host paths are probed concurrently. If a probe takes longer than
+# PROBE_MOUNTS_TIMEOUT seconds (e.g., hanging NFS server) or fails, run fails
+# and the mount is regarded as dead for PROBE_MOUNTS_DEAD_CACHE_TTL seconds
+# (subsequent runs using it fail immediately).
+PROBE_MOUNTS_TIMEOUT = 10
+PROBE_MOUNTS_DEAD_CACHE_TTL = 60
 
 
 # User is allowed to run an image if any of the following regexps match it
@@ -193,6 +239,41 @@ ALLOWED_IMAGE_REGEXPS = [
 # restrict load command if desired!).
 RUN_PULL = 'default'
 
+# Pulls (run with RUN_PULL = 'always' and the pull command) are coalesced per
+# node: concurrent pulls of the same image wait for a single docker pull (at
+# most PULL_LOCK_TIMEOUT seconds, then they pull anyway). Implicit pulls by run
+# of an image that was successfully pulled less than PULL_FRESHNESS seconds ago
+# are skipped (0 to disable), the pull command always pulls. The pull command
+# pulls multiple images with at most PULL_CONCURRENCY concurrent pulls.
+PULL_FRESHNESS = 60
+PULL_LOCK_TIMEOUT = 600
+PULL_CONCURRENCY = 4
+
+# With IMAGE_INDEX, local images are looked up in a node local index in
+# RUNTIME_DIR (e.g., for RUN_PULL = 'never') instead of asking the docker
+# daemon. The index is valid while the mtime of docker's reference store
+# (DOCKER_IMAGE_DB/*/repositories.json) is unchanged (image events since the
+# last refresh otherwise). userdockerd refreshes it on image events.
+IMAGE_INDEX = True
+DOCKER_IMAGE_DB = '/var/lib/docker/image'
+
+# On SIGINT or SIGTERM userdocker can explicitly stop the started container
+# (docker stop). This is important for slurm jobs, as slurm signals userdocker
+# and not the container. Possible values are [True, False, 'slurm'], where
+# 'slurm' only stops containers started from slurm jobs. Without the signal
+# handler, run replaces the userdocker process (see EXEC_REPLACE_PROCESS) and
+# the docker client forwards signals to the container itself.
+RUN_STOP_CONTAINER_ON_SIGNAL = 'slurm'
+
+
+# run labels containers with their owner and GPUs (userdocker.user,
+# userdocker.uid, userdocker.gpu), which are used to find the containers of a
+# user / using GPUs. Containers started by older versions only have the
+# USERDOCKER_* env vars and are inspected if CONTAINER_LABELS_ENV_FALLBACK is
+# set. Disable it once all such containers are gone, then only containers with
+# a GPU label are listed by the docker daemon.
+CONTAINER_LABELS_ENV_FALLBACK = True
+
 
 # If set, the user will run with his uid and gid in the container.
 # Changing this to false is probably a really bad idea, especially when combined
@@ -263,15 +344,94 @@ ENV_VARS_EXT = {
 # - GPUs on which more than NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED MB of memory is
 #   used will be marked as unavailable. This setting is userdocker independent.
 #   Setting this to -1 results in GPUs always being regarded as available.
+# - Likewise, GPUs with more than NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION percent
+#   utilization are unavailable (-1 to ignore utilization). Available GPUs are
+#   ranked by memory used, then utilization.
+# - Memory used and utilization are the peak values of NV_GPU_SAMPLE_COUNT
+#   queries NV_GPU_SAMPLE_INTERVAL seconds apart, so GPUs that are only briefly
+#   idle aren't regarded as free. Each sample is a query (see
+#   NV_GPU_QUERY_BACKEND below, 'nvml' is much cheaper than 'nvidia-smi'). With
+#   userdockerd, the peak values of its last USERDOCKERD_GPU_HISTORY refreshes
+#   are used instead.
 # - If NV_EXCLUSIVE_GPU_RESERVATION is set, any GPUs already used in any other
 #   container are regarded as unavailable for this container.
 # - NV_ALLOW_OWN_GPU_REUSE allows users to run multiple containers on GPUs they
 #   already use. This only happens when explicitly setting NV_GPU.
+# - GPUs selected by a run are reserved in a node local ledger (see RUNTIME_DIR)
+#   until its container is running, so concurrent runs (e.g., slurm tasks) get
+#   disjoint GPUs. Reservations end when the reserving process exits, but at
+#   the latest after NV_RESERVATION_TIMEOUT seconds.
+# - With run --wait, runs that don't find enough available GPUs wait for them in
+#   a node local queue (in RUNTIME_DIR, fair across users) instead of failing.
+#   The head of the queue retries whenever a container dies, but at least every
+#   NV_WAIT_RECHECK_INTERVAL seconds (e.g., for expired reservations).
+# - With NV_CONTAINER_GPU_INDEX, the GPUs used by containers are kept in an
+#   index in RUNTIME_DIR, which is updated incrementally from docker events
+#   (only newly started containers are inspected). It is rebuilt from all
+#   running containers if older than NV_CONTAINER_GPU_INDEX_MAX_AGE seconds.
+# - If NV_TOPOLOGY_AWARE_SELECTION is set and multiple GPUs are assigned by
+#   default, the best connected available GPUs (e.g., via NVLink or the same
+#   PCIe switch, see nvidia-smi topo -m) are selected instead of the ones with
+#   least memory used. The topology is cached in RUNTIME_DIR.
+# - NV_PLACEMENT_POLICY selects the GPUs assigned by default (None: 'topology'
+#   if NV_TOPOLOGY_AWARE_SELECTION is set, else 'default'):
+#   - 'default': the available GPUs with least memory used (see above)
+#   - 'topology': the best connected available GPUs (see above)
+#   - 'pack': fills up the most occupied CPU socket that has enough GPUs left,
+#     so whole sockets stay free for multi GPU containers
+#   - 'spread': uses the least occupied CPU socket (spreads load)
+#   - 'best_fit': uses the CPU socket with the fewest GPUs left that are still
+#     enough, otherwise spans the fewest sockets
+#   Like all settings, it can be overridden per group (e.g., 'spread' for a
+#   group running single GPU jobs with heavy host I/O). benchmarks/placement.py
+#   in the source repo simulates the policies.
+# - If NV_CPU_NUMA_PINNING is set, containers are pinned to the CPUs and memory
+#   of the NUMA nodes of their GPUs (--cpuset-cpus, --cpuset-mems, read from
+#   sysfs). The cores of a NUMA node are split evenly between its GPUs. If
+#   userdocker is restricted to a CPU subset (e.g., slurm cgroup cpuset), only
+#   those CPUs are used.
 NVIDIA_SMI = '/usr/bin/nvidia-smi'  # path to nvidia-smi
+# GPU memory used and utilization are queried via NV_GPU_QUERY_BACKEND:
+# - 'nvidia-smi' runs NVIDIA_SMI (can take up to a second to start)
+# - 'nvml' calls the NVIDIA management library (libnvidia-ml.so.1) in process,
+#   which is a lot faster. Falls back to nvidia-smi if the library is missing.
+# - 'fake' uses NV_FAKE_GPU_STATS = {gpu: (MiB used, % utilization)}, the
+#   recorded nvidia-smi topo -m output in NV_FAKE_GPU_TOPOLOGY and
+#   NV_FAKE_GPU_PCI_BUS_IDS (testing)
+NV_GPU_QUERY_BACKEND = 'nvidia-smi'
+NV_FAKE_GPU_STATS = {}
+NV_FAKE_GPU_TOPOLOGY = None  # path to recorded nvidia-smi topo -m output
+NV_FAKE_GPU_PCI_BUS_IDS = {}  # {gpu: PCI bus id}
 NV_ALLOWED_GPUS = 'ALL'  # otherwise a list like [1, 3]. [] for none.
 NV_DEFAULT_GPU_COUNT_RESERVATION = 1
 NV_MAX_GPU_COUNT_RESERVATION = -1
 NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED = 0
+NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION = -1
+NV_GPU_SAMPLE_COUNT = 1
+NV_GPU_SAMPLE_INTERVAL = 0.2
 NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION = True
 NV_ALLOW_OWN_GPU_REUSE = True
 NV_USE_CUDA_VISIBLE_DEVICES = True
+NV_RESERVATION_TIMEOUT = 300
+NV_WAIT_RECHECK_INTERVAL = 30
+NV_CONTAINER_GPU_INDEX = True
+NV_CONTAINER_GPU_INDEX_MAX_AGE = 300
+NV_TOPOLOGY_AWARE_SELECTION = True
+NV_PLACEMENT_POLICY = None
+NV_CPU_NUMA_PINNING = False
+
+
+# userdockerd is an optional node local daemon (run as root, e.g., via systemd)
+# that keeps the GPU usage state (memory used, GPU -> container map) in memory
+# and answers userdocker's queries via a root owned unix socket. Without it, each
+# userdocker invocation collects that state from nvidia-smi and docker itself.
+# - USERDOCKERD_SOCKET is the socket the daemon listens on (None disables).
+# - USERDOCKERD_REFRESH_INTERVAL is the time in seconds between state updates.
+# - USERDOCKERD_GPU_HISTORY is the number of refreshes the reported GPU memory
+#   used and utilization are the peak values of (see NV_GPU_SAMPLE_COUNT).
+# - userdocker ignores daemon state older than USERDOCKERD_MAX_STATE_AGE
+#   seconds (e.g., if the daemon hangs).
+USERDOCKERD_SOCKET = RUNTIME_DIR + 'userdockerd.sock'
+USERDOCKERD_REFRESH_INTERVAL = 2
+USERDOCKERD_GPU_HISTORY = 5
+USERDOCKERD_MAX_STATE_AGE = 10
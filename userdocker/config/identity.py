@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Resolution of the groups a user is a member of.
+
+Uses os.getgrouplist (the initgroups path of NSS) instead of enumerating the
+whole group database via grp.getgrall(), which can take seconds with LDAP or
+SSSD backends. Results are cached per uid for a short time in a root owned
+dir.
+"""
+
+import grp
+import json
+import os
+import time
+
+from .cache import is_trusted
+from .cache import write_atomic
+
+
+IDENTITY_CACHE_DIR = '/run/userdocker/identity/'
+IDENTITY_CACHE_TTL = 60  # seconds
+
+
+def resolve_member_groups(user_name, primary_gid):
+    """Returns [(group_name, gid), ...] of groups listing user as member.
+
+    Same semantics as filtering grp.getgrall() by gr_mem: the user's primary
+    group is only included if the user is also explicitly listed as member.
+    """
+    groups = []
+    for _gid in os.getgrouplist(user_name, primary_gid):
+        if any(_gid == g for _, g in groups):
+            continue
+        try:
+            _g = grp.getgrgid(_gid)
+        except KeyError:
+            # gid without group entry
+            continue
+        if _gid == primary_gid and user_name not in _g.gr_mem:
+            continue
+        groups.append((_g.gr_name, _gid))
+    return groups
+
+
+def member_groups(uid, user_name, primary_gid, ttl=IDENTITY_CACHE_TTL):
+    """Cached version of resolve_member_groups for the user with uid."""
+    cache_fn = IDENTITY_CACHE_DIR + 'uid_%d.json' % uid
+    now = time.time()
+    try:
+        if is_trusted(cache_fn):
+            with open(cache_fn) as f:
+                cached = json.load(f)
+            if (
+                    cached['user_name'] == user_name
+                    and cached['primary_gid'] == primary_gid
+                    and 0 <= now - cached['time'] < ttl):
+                return [tuple(g) for g in cached['groups']]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    groups = resolve_member_groups(user_name, primary_gid)
+    try:
+        write_atomic(cache_fn, json.dumps({
+            'user_name': user_name,
+            'primary_gid': primary_gid,
+            'time': now,
+            'groups': groups,
+        }).encode())
+    except OSError:
+        pass
+    return groups
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+CPU and NUMA pinning of containers matching their GPUs (NV_CPU_NUMA_PINNING).
+
+The NUMA nodes of the assigned GPUs are read from sysfs (via their PCI bus
+IDs). The CPUs of these nodes are split between all GPUs of the node (by
+physical core, keeping hyper-threads together), so containers sharing a
+socket get fair, disjoint shares without any coordination.
+
+If userdocker itself is restricted to a subset of CPUs (e.g., by the slurm
+cgroup cpuset), only those are used: they're already the job's share.
+
+sysfs_root and proc_root are parameters, so a fake tree can be used.
+"""
+
+import os
+
+from ..config import NVIDIA_SMI
+from ..config import RUNTIME_DIR
+from .exceptions import UserDockerException
+from .gpu_query import query_gpu_pci_bus_ids
+from .logger import logger
+from .topology import cached_gpu_info
+
+
+SYSFS_ROOT = '/sys'
+PROC_ROOT = '/proc'
+GPU_PCI_BUS_IDS_FN = RUNTIME_DIR + 'gpu_pci_bus_ids.json'
+
+
+def parse_cpulist(cpulist):
+    """Parses a kernel cpu / node list like '0-3,8,10-11' into a list."""
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def format_cpulist(cpus):
+    """Formats cpus as compact list for --cpuset-cpus (e.g., '0-3,8')."""
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(
+        str(first) if first == last else '%d-%d' % (first, last)
+        for first, last in ranges
+    )
+
+
+def _read(fn):
+    with open(fn) as f:
+        return f.read().strip()
+
+
+def sysfs_pci_bus_id(bus_id):
+    """Converts nvidia bus IDs (00000000:3B:00.0) to sysfs (0000:3b:00.0)."""
+    domain, _, rest = bus_id.strip().lower().partition(':')
+    return '%04x:%s' % (int(domain, 16), rest)
+
+
+def gpu_numa_nodes(pci_bus_ids, sysfs_root=SYSFS_ROOT):
+    """Returns {gpu: NUMA node} for {gpu: PCI bus id} (None if unknown)."""
+    nodes = {}
+    for gpu, bus_id in pci_bus_ids.items():
+        fn = os.path.join(
+            sysfs_root, 'bus/pci/devices', sysfs_pci_bus_id(bus_id),
+            'numa_node')
+        try:
+            node = int(_read(fn))
+        except (OSError, ValueError) as e:
+            logger.debug('NUMA node of GPU %d unknown: %s', gpu, e)
+            node = -1
+        nodes[gpu] = node if node >= 0 else None
+    return nodes
+
+
+def numa_node_cpus(node, sysfs_root=SYSFS_ROOT):
+    return parse_cpulist(_read(os.path.join(
+        sysfs_root, 'devices/system/node/node%d' % node, 'cpulist')))
+
+
+def physical_cores(cpus, sysfs_root=SYSFS_ROOT):
+    """Groups cpus by physical core (hyper-thread siblings), sorted."""
+    cores = {}
+    for cpu in cpus:
+        try:
+            siblings = parse_cpulist(_read(os.path.join(
+                sysfs_root, 'devices/system/cpu/cpu%d' % cpu,
+                'topology/thread_siblings_list')))
+        except (OSError, ValueError):
+            siblings = [cpu]
+        cores.setdefault(siblings[0], []).append(cpu)
+    return [cores[c] for c in sorted(cores)]
+
+
+def allowed_mems(proc_root=PROC_ROOT):
+    """Returns the NUMA nodes this process may allocate memory on."""
+    try:
+        with open(os.path.join(proc_root, 'self/status')) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'Mems_allowed_list':
+                    return parse_cpulist(value)
+    except (OSError, ValueError) as e:
+        logger.debug('could not read allowed NUMA nodes: %s', e)
+    return None
+
+
+def gpu_cpuset(gpus, numa_nodes, cpus_allowed, mems_allowed=None,
+               sysfs_root=SYSFS_ROOT):
+    """Returns (cpus, mems) to pin a container using gpus to.
+
+    numa_nodes is {gpu: NUMA node} for all GPUs of the node. cpus_allowed are
+    the CPUs userdocker may use (e.g., restricted by slurm). Returns
+    (None, None) if the NUMA nodes of gpus are unknown.
+    """
+    nodes = set(numa_nodes.get(g) for g in gpus)
+    if not nodes or None in nodes:
+        return None, None
+    nodes = sorted(nodes)
+    cpus_allowed = set(cpus_allowed)
+    cpus = []
+    for node in nodes:
+        node_cpus = numa_node_cpus(node, sysfs_root)
+        if not cpus_allowed.issuperset(node_cpus):
+            # restricted (e.g., slurm cgroup): use the restricted share
+            cpus.extend(c for c in node_cpus if c in cpus_allowed)
+            continue
+        # split the node's cores between all of its GPUs
+        cores = physical_cores(node_cpus, sysfs_root)
+        if not cores:
+            continue
+        node_gpus = sorted(g for g, n in numa_nodes.items() if n == node)
+        for gpu in gpus:
+            if gpu not in node_gpus:
+                continue
+            i, n = node_gpus.index(gpu), len(node_gpus)
+            share = cores[i * len(cores) // n:(i + 1) * len(cores) // n] \
+                or [cores[i * len(cores) // n]]
+            for core in share:
+                cpus.extend(core)
+    if not cpus:
+        # the GPUs' nodes aren't in our share at all, don't pin CPUs
+        cpus = sorted(cpus_allowed)
+    mems = nodes
+    if mems_allowed is not None:
+        mems = [m for m in nodes if m in mems_allowed] or sorted(mems_allowed)
+    return sorted(set(cpus)), mems
+
+
+def nvidia_cpuset_args(gpus, nvidia_smi=NVIDIA_SMI, sysfs_root=SYSFS_ROOT,
+                       proc_root=PROC_ROOT):
+    """Returns the docker run --cpuset-cpus/--cpuset-mems args for gpus."""
+    try:
+        pci_bus_ids = cached_gpu_info(
+            GPU_PCI_BUS_IDS_FN, query_gpu_pci_bus_ids, nvidia_smi)
+        numa_nodes = gpu_numa_nodes(pci_bus_ids, sysfs_root)
+        cpus, mems = gpu_cpuset(
+            gpus, numa_nodes, os.sched_getaffinity(0), allowed_mems(proc_root),
+            sysfs_root)
+    except (UserDockerException, OSError, ValueError) as e:
+        logger.warning('CPU / NUMA pinning failed, not pinning: %s', e)
+        return []
+    if cpus is None:
+        logger.warning('NUMA nodes of GPUs %r unknown, not pinning', gpus)
+        return []
+    args = [
+        '--cpuset-cpus=%s' % format_cpulist(cpus),
+        '--cpuset-mems=%s' % format_cpulist(mems),
+    ]
+    logger.debug('CPU / NUMA pinning for GPUs %r: %r', gpus, args)
+    return args
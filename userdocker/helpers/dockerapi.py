@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal docker engine API client for read-only queries.
+
+Talks HTTP to the docker daemon's unix socket (see DOCKER_SOCKET in config)
+and falls back to the docker CLI (executor) if the socket can't be used.
+Connections are kept alive and pooled for the whole invocation. Per request
+latencies are collected in request_stats and logged on exit with --debug.
+"""
+
+import atexit
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+import http.client
+import json
+import logging
+import socket
+import threading
+import time
+from urllib.parse import quote
+from urllib.parse import urlencode
+
+from ..config import DOCKER_SOCKET
+from .exceptions import UserDockerException
+from .execute import exec_cmd
+from .logger import logger
+
+
+API_TIMEOUT = 60
+API_POOL_SIZE = 4
+
+
+class DockerAPIUnavailable(Exception):
+    """Raised if the docker socket can't be used (triggers CLI fallback)."""
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection via a unix domain socket instead of TCP."""
+
+    def __init__(self, socket_path, timeout=API_TIMEOUT):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+# set to False after the first failed connection attempt to not retry for each
+# query of this invocation (long running processes call reset_api to retry)
+_api_usable = True
+
+# idle keep-alive connections, reused by subsequent requests
+_idle_connections = []
+_pool_lock = threading.Lock()
+
+# endpoint -> [request count, total seconds, max seconds]
+request_stats = defaultdict(lambda: [0, 0., 0.])
+connections_opened = 0
+
+
+def _stats_key(path):
+    # collapse object names/ids: /containers/<id>/json -> /containers/{}/json
+    parts = path.partition('?')[0].split('/')
+    if len(parts) > 2 and parts[2] != 'json':
+        parts[2] = '{}'
+    return '/'.join(parts)
+
+
+def record_request(key, seconds):
+    with _pool_lock:
+        stats = request_stats[key]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+
+@atexit.register
+def log_request_stats():
+    if not request_stats or not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug(
+        'docker query stats (%d API connections opened):', connections_opened)
+    for key, (count, total, max_) in sorted(request_stats.items()):
+        logger.debug(
+            '  %s: %d requests, %.1f ms total, %.2f ms avg, %.2f ms max',
+            key, count, total * 1000, total * 1000 / count, max_ * 1000
+        )
+
+
+def close_connections():
+    """Closes the idle API connections and logs the request stats.
+
+    For callers replacing the process (exec), which skips atexit handlers.
+    """
+    log_request_stats()
+    with _pool_lock:
+        request_stats.clear()
+        idle = list(_idle_connections)
+        del _idle_connections[:]
+    for conn in idle:
+        conn.close()
+
+
+def reset_api():
+    """Lets the next request try the API again if a previous one failed.
+
+    Also drops the idle connections then, which are stale if dockerd restarted.
+    """
+    global _api_usable
+    if _api_usable:
+        return
+    _api_usable = True
+    with _pool_lock:
+        idle = list(_idle_connections)
+        del _idle_connections[:]
+    for conn in idle:
+        conn.close()
+
+
+def _acquire_connection(socket_path):
+    global connections_opened
+    with _pool_lock:
+        for i, conn in enumerate(_idle_connections):
+            if conn.socket_path == socket_path:
+                return _idle_connections.pop(i), True
+        connections_opened += 1
+    return UnixHTTPConnection(socket_path), False
+
+
+def _release_connection(conn):
+    with _pool_lock:
+        if len(_idle_connections) < API_POOL_SIZE:
+            _idle_connections.append(conn)
+            return
+    conn.close()
+
+
+def _get(socket_path, path):
+    while True:
+        conn, reused = _acquire_connection(socket_path)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            conn.close()
+            if reused:
+                # daemon closed the idle keep-alive connection, just retry
+                continue
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            _release_connection(conn)
+        return response.status, body
+
+
+def api_path(*parts, **params):
+    """Builds a quoted API path from parts and (json encoded) query params."""
+    path = '/' + '/'.join(quote(str(p), safe='') for p in parts)
+    params = {
+        k: v if isinstance(v, str) else json.dumps(v)
+        for k, v in params.items() if v is not None
+    }
+    if params:
+        path += '?' + urlencode(sorted(params.items()))
+    return path
+
+
+def api_get(path, socket_path=None):
+    """GET path from the docker engine API (socket_path: DOCKER_SOCKET).
+
+    Returns the parsed json response or None if the daemon answered 404.
+    Raises DockerAPIUnavailable if the socket can't be used.
+    """
+    global _api_usable
+    socket_path = socket_path or DOCKER_SOCKET
+    if not socket_path or not _api_usable:
+        raise DockerAPIUnavailable(socket_path)
+
+    logger.debug('docker api request: GET %s', path)
+    start = time.perf_counter()
+    try:
+        status, body = _get(socket_path, path)
+    except (OSError, http.client.HTTPException) as e:
+        logger.debug(
+            'docker api unavailable via %s, falling back to CLI: %s',
+            socket_path, e)
+        _api_usable = False
+        raise DockerAPIUnavailable(socket_path) from e
+    record_request('GET ' + _stats_key(path), time.perf_counter() - start)
+
+    if status == 404:
+        return None
+    _check_status(path, status, body)
+    return json.loads(body.decode())
+
+
+def _check_status(path, status, body):
+    if status != 200:
+        try:
+            msg = json.loads(body.decode())['message']
+        except (ValueError, KeyError, TypeError):
+            msg = body.decode(errors='replace')
+        raise UserDockerException(
+            'ERROR: docker API request %s failed (%d): %s' % (
+                path, status, msg)
+        )
+
+
+def api_stream(path, socket_path=None, timeout=None):
+    """Yields the json objects streamed by GET path (e.g., /events).
+
+    Uses a dedicated connection (not pooled), as streams can stay open
+    indefinitely. Without timeout, blocks until the next object arrives
+    (raises socket.timeout). Raises DockerAPIUnavailable if the socket can't
+    be used or the stream breaks off (e.g., dockerd restarted).
+    """
+    socket_path = socket_path or DOCKER_SOCKET
+    if not socket_path or not _api_usable:
+        raise DockerAPIUnavailable(socket_path)
+
+    logger.debug('docker api stream: GET %s', path)
+    conn = UnixHTTPConnection(socket_path, timeout=timeout)
+    try:
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerAPIUnavailable(socket_path) from e
+        if response.status != 200:
+            _check_status(path, response.status, response.read())
+        try:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode())
+        except socket.timeout:
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerAPIUnavailable(socket_path) from e
+    finally:
+        conn.close()
+
+
+def api_get_many(paths, socket_path=None):
+    """Like api_get for several paths, concurrently via pooled connections.
+
+    Returns the results in order of paths.
+    """
+    paths = list(paths)
+    if len(paths) <= 1:
+        return [api_get(p, socket_path=socket_path) for p in paths]
+    # first request synchronously to fail fast if the socket can't be used
+    results = [api_get(paths[0], socket_path=socket_path)]
+    workers = min(API_POOL_SIZE, len(paths) - 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results.extend(executor.map(
+            partial(api_get, socket_path=socket_path), paths[1:]))
+    return results
+
+
+def _exec_query(cmd):
+    start = time.perf_counter()
+    res = exec_cmd(cmd, return_status=False, loglvl=logging.DEBUG)
+    record_request('CLI ' + ' '.join(cmd[1:2]), time.perf_counter() - start)
+    return res
+
+
+def _parse_created_at(created):
+    """Returns docker ps' CreatedAt (2017-01-02 03:04:05 +0000 UTC) as epoch
+    or None."""
+    try:
+        return datetime.strptime(
+            ' '.join(created.split()[:3]), '%Y-%m-%d %H:%M:%S %z').timestamp()
+    except ValueError:
+        return None
+
+
+def containers_labels(docker, labels, filters=None):
+    """Returns [(id, name, {label: value or None}, created), ...] of running
+    containers (created as epoch, None if unknown).
+
+    filters are docker ps filters, e.g., {'label': ['userdocker.uid=1000']}.
+    """
+    try:
+        return [
+            (c['Id'], (c.get('Names') or [''])[0],
+             {k: (c.get('Labels') or {}).get(k) or None for k in labels},
+             c.get('Created'))
+            for c in api_get(api_path('containers', 'json', filters=filters))
+        ]
+    except DockerAPIUnavailable:
+        pass
+    cmd = [docker, 'ps', '--no-trunc', '--format', '\t'.join(
+        ['{{.ID}}', '{{.Names}}', '{{.CreatedAt}}']
+        + ['{{.Label "%s"}}' % k for k in labels])]
+    for key, values in sorted((filters or {}).items()):
+        for value in values:
+            cmd += ['--filter', '%s=%s' % (key, value)]
+    res = []
+    for line in _exec_query(cmd).splitlines():
+        container, name, created, *values = line.split('\t')
+        res.append((container, '/' + name, {
+            k: v or None for k, v in zip(labels, values)},
+            _parse_created_at(created)))
+    return res
+
+
+def containers_inspect(docker, containers):
+    """Returns a list of docker inspect dicts for the given containers.
+
+    Containers that vanished in the meantime are skipped.
+    """
+    if not containers:
+        return []
+    try:
+        details = api_get_many(
+            api_path('containers', c, 'json') for c in containers)
+        return [d for d in details if d is not None]
+    except DockerAPIUnavailable:
+        out = _exec_query(
+            [docker, 'inspect', '--format', '{{json .}}'] + list(containers))
+        return [json.loads(line) for line in out.splitlines() if line]
+
+
+def container_inspect(docker, container):
+    """Returns the docker inspect dict for a container or None."""
+    details = containers_inspect(docker, [container])
+    return details[0] if details else None
+
+
+def image_exists(docker, image):
+    """Checks if the given image is locally available (docker images -q)."""
+    try:
+        return api_get(api_path('images', image, 'json')) is not None
+    except DockerAPIUnavailable:
+        return bool(_exec_query([docker, 'images', '-q', image]).strip())
+
+
+def images_list(docker):
+    """Returns [(id, tags, digests, size, created), ...] of local images."""
+    try:
+        return [
+            (i['Id'], i.get('RepoTags') or [], i.get('RepoDigests') or [],
+             i.get('Size'), i.get('Created'))
+            for i in api_get(api_path('images', 'json'))
+        ]
+    except DockerAPIUnavailable:
+        pass
+    out = _exec_query([
+        docker, 'images', '--no-trunc', '--digests', '--format',
+        '{{.ID}}\t{{.Repository}}\t{{.Tag}}\t{{.Digest}}\t{{.Size}}\t'
+        '{{.CreatedAt}}'])
+    images = []
+    for line in out.splitlines():
+        image_id, repo, tag, digest, size, created = line.split('\t')
+        images.append((
+            image_id,
+            ['%s:%s' % (repo, tag)] if tag != '<none>' else [],
+            ['%s@%s' % (repo, digest)] if digest != '<none>' else [],
+            size, created,
+        ))
+    return images
+
+
+def images_list_all(docker):
+    """Returns dicts with Id, ParentId, RepoTags and Size of all images
+    (including intermediate ones). The CLI fallback includes RootFS."""
+    try:
+        return api_get(api_path('images', 'json', all=1))
+    except DockerAPIUnavailable:
+        pass
+    ids = _exec_query([docker, 'images', '-aq', '--no-trunc']).split()
+    details = images_inspect(docker, list(dict.fromkeys(ids)))
+    for d in details:
+        d['ParentId'] = d.get('Parent')
+    return details
+
+
+def images_inspect(docker, images):
+    """Returns a list of docker image inspect dicts for the given images.
+
+    Images that vanished in the meantime are skipped.
+    """
+    if not images:
+        return []
+    try:
+        details = api_get_many(api_path('images', i, 'json') for i in images)
+        return [d for d in details if d is not None]
+    except DockerAPIUnavailable:
+        out = _exec_query([
+            docker, 'image', 'inspect', '--format', '{{json .}}'
+        ] + list(images))
+        return [json.loads(line) for line in out.splitlines() if line]
+
+
+def image_repo(image):
+    """Returns the repository of an image reference (without tag / digest)."""
+    repo = image.partition('@')[0]
+    if ':' in repo.rpartition('/')[2]:
+        repo = repo.rpartition(':')[0]
+    return repo
+
+
+def image_digest(docker, image):
+    """Returns (image ID, repo digest or None) of a local image or None.
+
+    The repo digest (repo@sha256:...) identifies the image in its registry.
+    """
+    try:
+        details = api_get(api_path('images', image, 'json'))
+        if details is None:
+            return None
+        image_id, digests = details['Id'], details.get('RepoDigests') or []
+    except DockerAPIUnavailable:
+        out = _exec_query([
+            docker, 'images', '--digests', '--no-trunc',
+            '--format', '{{.ID}} {{.Repository}}@{{.Digest}}', image])
+        lines = out.split('\n', 1)[0].split()
+        if not lines:
+            return None
+        image_id, digests = lines[0], [
+            d for d in lines[1:] if not d.endswith('@<none>')]
+    repo = image_repo(image)
+    for digest in digests:
+        if image_repo(digest) == repo:
+            return image_id, digest
+    return image_id, digests[0] if digests else None
+
+
+def network_inspect(docker, network):
+    """Returns the docker network inspect dict for network or None."""
+    try:
+        details = [api_get(api_path('networks', network))]
+    except DockerAPIUnavailable:
+        details = json.loads(
+            _exec_query([docker, 'network', 'inspect', network]))
+    for d in details:
+        if d and d['Name'] == network:
+            return d
+    return None
@@ -3,3 +3,7 @@
 
 class UserDockerException(Exception):
     pass
+
+
+class GPUsUnavailable(UserDockerException):
+    """Not enough (or not the requested) GPUs are available right now."""
@@ -6,11 +6,12 @@ from shlex import quote
 import subprocess
 import sys
 
+from ..config import EXEC_REPLACE_PROCESS
 from .exceptions import UserDockerException
 from .logger import logger
 
 
-def exec_cmd(cmd, dry_run=False, return_status=True, loglvl=logging.INFO):
+def _log_and_check_cmd(cmd, dry_run, loglvl):
     logger.log(
         loglvl,
         '%s command: %s',
@@ -19,14 +20,18 @@ def exec_cmd(cmd, dry_run=False, return_status=True, loglvl=logging.INFO):
     )
     logger.debug('internal repr: %s', cmd)
 
-    if dry_run:
-        return 0
-
-    if not os.path.exists(cmd[0]):
+    if not dry_run and not os.path.exists(cmd[0]):
         raise UserDockerException(
             "ERROR: can't find executable: %s" % cmd[0]
         )
 
+
+def exec_cmd(cmd, dry_run=False, return_status=True, loglvl=logging.INFO):
+    _log_and_check_cmd(cmd, dry_run, loglvl)
+
+    if dry_run:
+        return 0
+
     try:
         if return_status:
             ret = subprocess.check_call(cmd)
@@ -38,5 +43,64 @@ def exec_cmd(cmd, dry_run=False, return_status=True, loglvl=logging.INFO):
         sys.exit(ret)
 
 
-def exit_exec_cmd(cmd, dry_run=False):
+def exec_cmd_output_lines(cmd, output, loglvl=logging.INFO):
+    """Executes cmd passing each line of its output (stdout and stderr) to
+    output(line). Returns the return code of cmd."""
+    _log_and_check_cmd(cmd, False, loglvl)
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    for line in proc.stdout:
+        output(line.rstrip('\n'))
+    return proc.wait()
+
+
+def exec_cmd_input(cmd, chunks, dry_run=False, loglvl=logging.INFO):
+    """Executes cmd writing chunks (iterable of bytes) to its stdin.
+
+    If iterating chunks raises, cmd is killed and the exception re-raised.
+    Returns the return code of cmd.
+    """
+    _log_and_check_cmd(cmd, dry_run, loglvl)
+    if dry_run:
+        for _ in chunks:
+            pass
+        return 0
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for chunk in chunks:
+            proc.stdin.write(chunk)
+        proc.stdin.close()
+    except BrokenPipeError:
+        # cmd exited early, its return code tells why
+        pass
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    return proc.wait()
+
+
+def replace_process_exec_cmd(cmd, loglvl=logging.INFO):
+    """Replaces the current process with cmd (os.execv), never returns.
+
+    The executed command inherits pid, environment, signals and tty directly.
+    Exit handlers (atexit) don't run, callers release resources they hold
+    (e.g., dockerapi.close_connections) before.
+    """
+    _log_and_check_cmd(cmd, False, loglvl)
+    # exec doesn't return, flush pending output now
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(cmd[0], cmd)
+
+
+def exit_exec_cmd(cmd, dry_run=False, replace_process=False):
+    """Executes cmd and exits with its return code.
+
+    For pure pass-through commands replace_process=True allows to replace the
+    userdocker process with cmd if enabled by the admin (EXEC_REPLACE_PROCESS).
+    """
+    if replace_process and EXEC_REPLACE_PROCESS and not dry_run:
+        replace_process_exec_cmd(cmd)
     sys.exit(exec_cmd(cmd, dry_run=dry_run))
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental container -> GPU index fed by docker events.
+
+Instead of listing all running containers for each query, the index only
+handles containers started since its last update (docker container start /
+die / destroy events). Ownership and GPUs are taken from the container labels
+(see labels.py), only containers without labels (started by older versions)
+are inspected. It's persisted as a compact snapshot in RUNTIME_DIR:
+userdockerd follows the events stream live, userdocker invocations catch up
+from the snapshot. Queries are hence O(GPUs) instead of O(containers).
+"""
+
+import calendar
+from collections import defaultdict
+import json
+import threading
+import time
+
+from ..config import CONTAINER_LABELS_ENV_FALLBACK
+from ..config import NV_CONTAINER_GPU_INDEX_MAX_AGE
+from ..config import RUNTIME_DIR
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .dockerapi import DockerAPIUnavailable
+from .dockerapi import api_path
+from .dockerapi import api_stream
+from .dockerapi import container_inspect
+from .dockerapi import containers_inspect
+from .dockerapi import containers_labels
+from .labels import LABEL_GPU
+from .labels import OWNER_LABELS
+from .labels import container_owner
+from .labels import owner_from_labels
+from .logger import logger
+
+
+GPU_INDEX_FN = RUNTIME_DIR + 'gpu_index.json'
+GPU_INDEX_EVENTS = ('start', 'die', 'destroy')
+
+# docker only buffers the last 256 events. If catching up returns that many,
+# older events might be lost and the index is rebuilt.
+DOCKER_EVENTS_BUFFER = 256
+
+# events are re-requested with this overlap (in seconds) to not miss events
+# that were logged but not yet published while catching up (applying events is
+# idempotent)
+CATCH_UP_OVERLAP = 1
+
+
+def _now_nano():
+    return int(time.time() * 10**9)
+
+
+def _docker_timestamp(time_nano):
+    return '%d.%09d' % divmod(time_nano, 10**9)
+
+
+def _started_at(details):
+    """Returns State.StartedAt of a docker inspect dict as epoch or None."""
+    started = (details.get('State') or {}).get('StartedAt') or ''
+    try:
+        return calendar.timegm(
+            time.strptime(started[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+class ContainerGPUIndex:
+    """GPUs used by running containers, updated incrementally by events.
+
+    inspect_container(docker, container) returns the docker inspect dict of a
+    container or None and can be replaced (e.g., to test with fake events).
+    """
+
+    def __init__(self, inspect_container=container_inspect):
+        self.inspect_container = inspect_container
+        # userdockerd follows events in a thread while answering queries
+        self._lock = threading.RLock()
+        # container -> (name, user, uid, gpus) for containers using GPUs
+        self.containers = {}
+        # gpu -> {container: (container, name, user, uid)}
+        self._by_gpu = defaultdict(dict)
+        # container -> start time (epoch, None if unknown) of the above
+        self.started = {}
+        # timeNano up to which events were applied (0: rebuild needed)
+        self.since = 0
+
+    def add(self, details):
+        """Adds (or updates) a container from its docker inspect dict."""
+        user, uid, gpus = container_owner(details)
+        self._add(details['Id'], details['Name'], user, uid, gpus,
+                  _started_at(details))
+
+    def _add(self, container, name, user, uid, gpus, started=None):
+        with self._lock:
+            self.remove(container)
+            if not gpus:
+                return
+            self.containers[container] = (name, user, uid, gpus)
+            self.started[container] = started
+            for gpu in gpus:
+                self._by_gpu[gpu][container] = (container, name, user, uid)
+        for gpu in gpus:
+            logger.debug(
+                'gpu %d used by container: %s, name: %s, user: %s, uid: %s',
+                gpu, container, name, user, uid
+            )
+
+    def remove(self, container):
+        with self._lock:
+            info = self.containers.pop(container, None)
+            self.started.pop(container, None)
+            if not info:
+                return
+            for gpu in info[3]:
+                self._by_gpu[gpu].pop(container, None)
+                if not self._by_gpu[gpu]:
+                    del self._by_gpu[gpu]
+
+    def gpus_used(self):
+        """Returns {gpu: [(container, name, user, uid), ...]}."""
+        gpus_used_by_containers = defaultdict(list)
+        with self._lock:
+            for gpu, containers in self._by_gpu.items():
+                gpus_used_by_containers[gpu] = list(containers.values())
+        return gpus_used_by_containers
+
+    def started_times(self):
+        """Returns {container: start time (epoch or None)}.
+
+        Containers found by a rebuild report their creation time.
+        """
+        with self._lock:
+            return dict(self.started)
+
+    def rebuild(self, docker):
+        """Rebuilds the index from the running containers.
+
+        Without CONTAINER_LABELS_ENV_FALLBACK, only containers with the GPU
+        label are listed (filtered by the daemon).
+        """
+        since = _now_nano()
+        filters = None if CONTAINER_LABELS_ENV_FALLBACK \
+            else {'label': [LABEL_GPU]}
+        labeled, unlabeled = [], []
+        for container, name, labels, created in containers_labels(
+                docker, OWNER_LABELS, filters):
+            owner = owner_from_labels(labels)
+            if owner is not None:
+                labeled.append((container, name) + owner + (created,))
+            elif CONTAINER_LABELS_ENV_FALLBACK:
+                unlabeled.append(container)
+        details = containers_inspect(docker, unlabeled)
+        with self._lock:
+            self.containers.clear()
+            self._by_gpu.clear()
+            self.started.clear()
+            for container_info in labeled:
+                self._add(*container_info)
+            for d in details:
+                self.add(d)
+            self.since = since
+        logger.debug('rebuilt container GPU index')
+
+    def apply_event(self, docker, event):
+        """Applies a single docker event (others than GPU_INDEX_EVENTS of
+        containers are ignored)."""
+        if event.get('Type') == 'container' \
+                and event.get('Action') in GPU_INDEX_EVENTS:
+            container = event['Actor']['ID']
+            logger.debug('container event: %s %s', event['Action'], container)
+            if event['Action'] == 'start':
+                # events carry the labels, only inspect unlabeled containers
+                attributes = event['Actor'].get('Attributes') or {}
+                owner = owner_from_labels(attributes)
+                if owner is not None:
+                    self._add(container, '/' + attributes.get('name', ''),
+                              *owner, started=event.get('time'))
+                elif CONTAINER_LABELS_ENV_FALLBACK:
+                    details = self.inspect_container(docker, container)
+                    if details is not None:
+                        self.add(details)
+            else:
+                self.remove(container)
+        self.since = max(self.since, event.get('timeNano', 0))
+
+    def apply_events(self, docker, events):
+        """Applies events (any iterable of docker event dicts).
+
+        Returns the number of events.
+        """
+        count = 0
+        for event in events:
+            self.apply_event(docker, event)
+            count += 1
+        return count
+
+    def catch_up(self, docker, events=None):
+        """Applies the events since the last update.
+
+        Rebuilds the index if it's older than NV_CONTAINER_GPU_INDEX_MAX_AGE,
+        events might have been lost or the docker API is unavailable. events
+        default to all docker events since the last update.
+        """
+        now = _now_nano()
+        if now - self.since > NV_CONTAINER_GPU_INDEX_MAX_AGE * 10**9:
+            self.rebuild(docker)
+            return
+        if events is None:
+            # all events (not only the container ones) to detect buffer
+            # overflows
+            events = api_stream(api_path(
+                'events',
+                since=_docker_timestamp(self.since),
+                until=_docker_timestamp(now),
+            ))
+        try:
+            count = self.apply_events(docker, events)
+        except (DockerAPIUnavailable, OSError, ValueError) as e:
+            logger.debug('catching up via docker events failed: %r', e)
+            self.rebuild(docker)
+            return
+        if count >= DOCKER_EVENTS_BUFFER:
+            self.rebuild(docker)
+            return
+        self.since = max(self.since, now - CATCH_UP_OVERLAP * 10**9)
+
+    def follow(self, docker, events=None):
+        """Applies events as they arrive (blocks), saving after each.
+
+        events default to the live docker events stream of containers.
+        """
+        if events is None:
+            events = api_stream(api_path(
+                'events',
+                since=_docker_timestamp(self.since),
+                filters={'type': ['container'], 'event': GPU_INDEX_EVENTS},
+            ))
+        for event in events:
+            self.apply_event(docker, event)
+            self.save()
+
+    def save(self, fn=GPU_INDEX_FN):
+        """Persists a snapshot of the index (only possible as root)."""
+        with self._lock:
+            snapshot = json.dumps({
+                'since': self.since,
+                'containers': self.containers,
+                'started': self.started,
+            })
+        try:
+            write_atomic(fn, snapshot.encode())
+        except OSError as e:
+            logger.debug('could not save container GPU index: %s', e)
+
+    @classmethod
+    def load(cls, fn=GPU_INDEX_FN, inspect_container=container_inspect):
+        """Returns the index from a snapshot (empty if missing / untrusted)."""
+        index = cls(inspect_container)
+        try:
+            if not is_trusted(fn):
+                logger.warning('ignoring untrusted container GPU index %s', fn)
+                return index
+            with open(fn) as f:
+                snapshot = json.load(f)
+            started = snapshot.get('started', {})
+            for container, (name, user, uid, gpus) in \
+                    snapshot['containers'].items():
+                index._add(container, name, user, uid, gpus,
+                           started.get(container))
+            # snapshots of older versions lack start times: rebuild
+            index.since = snapshot['since'] if 'started' in snapshot else 0
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('ignoring broken container GPU index: %s', e)
+            index = cls(inspect_container)
+        return index
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+Pluggable backends to query GPU stats (see NV_GPU_QUERY_BACKEND in config).
+
+Each backend returns {gpu index: (MiB memory used, % utilization)}:
+- nvidia-smi: runs nvidia-smi (slow to start, often several 100 ms)
+- nvml: queries the NVIDIA management library in process via ctypes
+- fake: returns NV_FAKE_GPU_STATS from config (for testing)
+
+sample_gpu_stats takes several samples (NV_GPU_SAMPLE_COUNT) and returns their
+peak values, so a GPU that is only briefly idle (e.g., between two processes of
+a job) doesn't look free.
+
+PCI bus IDs ({gpu: bus id}) and the GPU interconnect topology are queried via
+the same backends. The topology is returned as {gpu: {other gpu: link}} with
+links as in nvidia-smi topo -m (e.g., 'NV2', 'PIX', 'SYS'). The fake backend
+parses a recorded nvidia-smi topo -m output (NV_FAKE_GPU_TOPOLOGY).
+"""
+
+import ctypes
+import logging
+import re
+import time
+
+from ..config import NVIDIA_SMI
+from ..config import NV_FAKE_GPU_PCI_BUS_IDS
+from ..config import NV_FAKE_GPU_STATS
+from ..config import NV_FAKE_GPU_TOPOLOGY
+from ..config import NV_GPU_QUERY_BACKEND
+from ..config import NV_GPU_SAMPLE_COUNT
+from ..config import NV_GPU_SAMPLE_INTERVAL
+from .exceptions import UserDockerException
+from .execute import exec_cmd
+from .logger import logger
+
+
+def query_gpu_stats_nvidia_smi(nvidia_smi=NVIDIA_SMI):
+    gpu_stats_str = exec_cmd(
+        [nvidia_smi,
+         '--query-gpu=index,memory.used,utilization.gpu',
+         '--format=csv,noheader,nounits'],
+        return_status=False,
+        loglvl=logging.DEBUG,
+    )
+    logger.debug('gpu usage:\n%s', gpu_stats_str)
+    gpu_stats = {}
+    for line in gpu_stats_str.splitlines():
+        gpu, mem_used, gpu_utilization = line.split(', ')
+        # utilization is '[N/A]' for some GPUs
+        gpu_utilization = int(gpu_utilization) \
+            if gpu_utilization.isdigit() else 0
+        gpu_stats[int(gpu)] = (int(mem_used), gpu_utilization)
+    return gpu_stats
+
+
+class _NVMLMemory(ctypes.Structure):
+    _fields_ = [
+        ('total', ctypes.c_ulonglong),
+        ('free', ctypes.c_ulonglong),
+        ('used', ctypes.c_ulonglong),
+    ]
+
+
+class _NVMLUtilization(ctypes.Structure):
+    _fields_ = [
+        ('gpu', ctypes.c_uint),
+        ('memory', ctypes.c_uint),
+    ]
+
+
+NVML_LIBRARY = 'libnvidia-ml.so.1'
+NVML_ERROR_NOT_SUPPORTED = 3
+_nvml = None
+
+
+def _nvml_check(lib, ret):
+    if ret != 0:
+        raise UserDockerException(
+            'ERROR: NVML call failed: %s' % lib.nvmlErrorString(ret).decode()
+        )
+
+
+def _nvml_lib():
+    """Returns the initialized NVML library.
+
+    Raises OSError if it's missing or can't be initialized (e.g., driver not
+    loaded or a version mismatch).
+    """
+    global _nvml
+    if _nvml is None:
+        lib = ctypes.CDLL(NVML_LIBRARY)
+        lib.nvmlErrorString.restype = ctypes.c_char_p
+        ret = lib.nvmlInit_v2()
+        if ret != 0:
+            raise OSError(
+                'NVML init failed: %s' % lib.nvmlErrorString(ret).decode())
+        _nvml = lib
+    return _nvml
+
+
+def query_gpu_stats_nvml(nvidia_smi=None):
+    lib = _nvml_lib()
+    count = ctypes.c_uint()
+    _nvml_check(lib, lib.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+    gpu_stats = {}
+    for gpu in range(count.value):
+        handle = ctypes.c_void_p()
+        _nvml_check(lib, lib.nvmlDeviceGetHandleByIndex_v2(
+            gpu, ctypes.byref(handle)))
+        mem = _NVMLMemory()
+        _nvml_check(lib, lib.nvmlDeviceGetMemoryInfo(
+            handle, ctypes.byref(mem)))
+        util = _NVMLUtilization()
+        ret = lib.nvmlDeviceGetUtilizationRates(handle, ctypes.byref(util))
+        if ret == NVML_ERROR_NOT_SUPPORTED:
+            # as '[N/A]' in nvidia-smi
+            util.gpu = 0
+        else:
+            _nvml_check(lib, ret)
+        gpu_stats[gpu] = (mem.used // 2**20, util.gpu)
+    logger.debug('gpu usage (nvml): %r', gpu_stats)
+    return gpu_stats
+
+
+def query_gpu_stats_fake(nvidia_smi=None):
+    return {
+        int(gpu): tuple(stats) for gpu, stats in NV_FAKE_GPU_STATS.items()
+    }
+
+
+GPU_QUERY_BACKENDS = {
+    'nvidia-smi': query_gpu_stats_nvidia_smi,
+    'nvml': query_gpu_stats_nvml,
+    'fake': query_gpu_stats_fake,
+}
+
+
+def _query(backends, nvidia_smi, backend):
+    try:
+        query = backends[backend]
+    except KeyError:
+        raise UserDockerException(
+            "ERROR: NV_GPU_QUERY_BACKEND config variable not expected range, "
+            "contact admin"
+        )
+    try:
+        return query(nvidia_smi)
+    except OSError as e:
+        if backend != 'nvml':
+            raise
+        logger.warning('NVML unavailable, falling back to nvidia-smi: %s', e)
+        return backends['nvidia-smi'](nvidia_smi)
+
+
+def query_gpu_stats(nvidia_smi=NVIDIA_SMI, backend=NV_GPU_QUERY_BACKEND):
+    """Returns {gpu: (MiB memory used, % utilization)} via backend.
+
+    Falls back to nvidia-smi if NVML can't be loaded or initialized.
+    """
+    return _query(GPU_QUERY_BACKENDS, nvidia_smi, backend)
+
+
+def aggregate_gpu_stats(samples):
+    """Returns the peak {gpu: (MiB memory used, % utilization)} of samples."""
+    gpu_stats = {}
+    for sample in samples:
+        for gpu, (mem_used, gpu_utilization) in sample.items():
+            m, u = gpu_stats.get(gpu, (0, 0))
+            gpu_stats[gpu] = (max(m, mem_used), max(u, gpu_utilization))
+    return gpu_stats
+
+
+def sample_gpu_stats(
+        nvidia_smi=NVIDIA_SMI, count=NV_GPU_SAMPLE_COUNT,
+        interval=NV_GPU_SAMPLE_INTERVAL, backend=NV_GPU_QUERY_BACKEND):
+    """Returns the peak stats of count queries interval seconds apart."""
+    samples = []
+    for i in range(max(1, count)):
+        if i:
+            time.sleep(interval)
+        samples.append(query_gpu_stats(nvidia_smi, backend))
+    gpu_stats = aggregate_gpu_stats(samples)
+    if len(samples) > 1:
+        logger.debug('peak gpu usage of %d samples: %r', len(samples),
+                     gpu_stats)
+    return gpu_stats
+
+
+def parse_nvidia_smi_topology(topo_str):
+    """Parses nvidia-smi topo -m output into {gpu: {other gpu: link}}."""
+    gpus = None
+    topology = {}
+    for line in topo_str.splitlines():
+        tokens = line.split()
+        if gpus is None:
+            # header: GPU0 GPU1 ... followed by NICs and affinity columns
+            if tokens and tokens[0] == 'GPU0':
+                gpus = [
+                    int(t[3:]) for t in tokens if re.match(r'^GPU\d+$', t)
+                ]
+            continue
+        if not tokens or not re.match(r'^GPU\d+$', tokens[0]):
+            continue
+        gpu = int(tokens[0][3:])
+        topology[gpu] = {
+            other: link
+            for other, link in zip(gpus, tokens[1:1 + len(gpus)])
+            if other != gpu
+        }
+    if gpus is None:
+        raise UserDockerException(
+            'ERROR: could not parse GPU topology:\n%s' % topo_str)
+    return topology
+
+
+def query_gpu_topology_nvidia_smi(nvidia_smi=NVIDIA_SMI):
+    topo_str = exec_cmd(
+        [nvidia_smi, 'topo', '-m'],
+        return_status=False,
+        loglvl=logging.DEBUG,
+    )
+    logger.debug('gpu topology:\n%s', topo_str)
+    return parse_nvidia_smi_topology(topo_str)
+
+
+class _NVMLPciInfo(ctypes.Structure):
+    _fields_ = [
+        ('busIdLegacy', ctypes.c_char * 16),
+        ('domain', ctypes.c_uint),
+        ('bus', ctypes.c_uint),
+        ('device', ctypes.c_uint),
+        ('pciDeviceId', ctypes.c_uint),
+        ('pciSubSystemId', ctypes.c_uint),
+        ('busId', ctypes.c_char * 32),
+    ]
+
+
+# nvmlGpuTopologyLevel_t -> nvidia-smi topo -m link
+NVML_TOPOLOGY_LEVELS = {
+    0: 'PIX',  # internal (multi GPU board)
+    10: 'PIX',
+    20: 'PXB',
+    30: 'PHB',
+    40: 'NODE',
+    50: 'SYS',
+}
+NVML_NVLINK_MAX_LINKS = 18
+
+
+def _nvml_pci_bus(pci):
+    return (pci.domain, pci.bus, pci.device)
+
+
+def query_gpu_topology_nvml(nvidia_smi=None):
+    lib = _nvml_lib()
+    count = ctypes.c_uint()
+    _nvml_check(lib, lib.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+    handles = []
+    buses = {}
+    for gpu in range(count.value):
+        handle = ctypes.c_void_p()
+        _nvml_check(lib, lib.nvmlDeviceGetHandleByIndex_v2(
+            gpu, ctypes.byref(handle)))
+        pci = _NVMLPciInfo()
+        _nvml_check(lib, lib.nvmlDeviceGetPciInfo_v3(
+            handle, ctypes.byref(pci)))
+        handles.append(handle)
+        buses[_nvml_pci_bus(pci)] = gpu
+
+    topology = {}
+    for gpu, handle in enumerate(handles):
+        # count active NVLinks to each other GPU
+        nvlinks = dict.fromkeys(range(count.value), 0)
+        for link in range(NVML_NVLINK_MAX_LINKS):
+            active = ctypes.c_uint()
+            if lib.nvmlDeviceGetNvLinkState(
+                    handle, link, ctypes.byref(active)) != 0:
+                # not supported or no such link
+                break
+            if not active.value:
+                continue
+            pci = _NVMLPciInfo()
+            if lib.nvmlDeviceGetNvLinkRemotePciInfo_v2(
+                    handle, link, ctypes.byref(pci)) == 0:
+                other = buses.get(_nvml_pci_bus(pci))
+                if other is not None:
+                    nvlinks[other] += 1
+        topology[gpu] = {}
+        for other, other_handle in enumerate(handles):
+            if other == gpu:
+                continue
+            if nvlinks[other]:
+                topology[gpu][other] = 'NV%d' % nvlinks[other]
+                continue
+            level = ctypes.c_int()
+            _nvml_check(lib, lib.nvmlDeviceGetTopologyCommonAncestor(
+                handle, other_handle, ctypes.byref(level)))
+            topology[gpu][other] = NVML_TOPOLOGY_LEVELS.get(level.value, 'SYS')
+    logger.debug('gpu topology (nvml): %r', topology)
+    return topology
+
+
+def query_gpu_topology_fake(nvidia_smi=None):
+    if not NV_FAKE_GPU_TOPOLOGY:
+        return {}
+    with open(NV_FAKE_GPU_TOPOLOGY) as f:
+        return parse_nvidia_smi_topology(f.read())
+
+
+GPU_TOPOLOGY_BACKENDS = {
+    'nvidia-smi': query_gpu_topology_nvidia_smi,
+    'nvml': query_gpu_topology_nvml,
+    'fake': query_gpu_topology_fake,
+}
+
+
+def query_gpu_topology(nvidia_smi=NVIDIA_SMI, backend=NV_GPU_QUERY_BACKEND):
+    """Returns {gpu: {other gpu: link}} via backend (see query_gpu_stats)."""
+    return _query(GPU_TOPOLOGY_BACKENDS, nvidia_smi, backend)
+
+
+def query_gpu_pci_bus_ids_nvidia_smi(nvidia_smi=NVIDIA_SMI):
+    bus_ids_str = exec_cmd(
+        [nvidia_smi, '--query-gpu=index,pci.bus_id', '--format=csv,noheader'],
+        return_status=False,
+        loglvl=logging.DEBUG,
+    )
+    bus_ids = {}
+    for line in bus_ids_str.splitlines():
+        gpu, bus_id = line.split(', ')
+        bus_ids[int(gpu)] = bus_id.strip()
+    return bus_ids
+
+
+def query_gpu_pci_bus_ids_nvml(nvidia_smi=None):
+    lib = _nvml_lib()
+    count = ctypes.c_uint()
+    _nvml_check(lib, lib.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+    bus_ids = {}
+    for gpu in range(count.value):
+        handle = ctypes.c_void_p()
+        _nvml_check(lib, lib.nvmlDeviceGetHandleByIndex_v2(
+            gpu, ctypes.byref(handle)))
+        pci = _NVMLPciInfo()
+        _nvml_check(lib, lib.nvmlDeviceGetPciInfo_v3(
+            handle, ctypes.byref(pci)))
+        bus_ids[gpu] = pci.busId.decode()
+    return bus_ids
+
+
+def query_gpu_pci_bus_ids_fake(nvidia_smi=None):
+    return {
+        int(gpu): bus_id for gpu, bus_id in NV_FAKE_GPU_PCI_BUS_IDS.items()
+    }
+
+
+GPU_PCI_BUS_ID_BACKENDS = {
+    'nvidia-smi': query_gpu_pci_bus_ids_nvidia_smi,
+    'nvml': query_gpu_pci_bus_ids_nvml,
+    'fake': query_gpu_pci_bus_ids_fake,
+}
+
+
+def query_gpu_pci_bus_ids(
+        nvidia_smi=NVIDIA_SMI, backend=NV_GPU_QUERY_BACKEND):
+    """Returns {gpu: PCI bus id} via backend (see query_gpu_stats)."""
+    return _query(GPU_PCI_BUS_ID_BACKENDS, nvidia_smi, backend)
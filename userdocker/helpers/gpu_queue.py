@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Node local queue of runs waiting for GPUs (run --wait).
+
+Each waiting run enqueues a ticket file in QUEUE_DIR and holds an exclusive
+lock on it as long as it waits (the kernel releases it if the run dies).
+Tickets are ordered fairly across users: a ticket's round is one more than the
+round of its user's previous waiting ticket, but at least the round of the
+queue's head. So users with many waiting runs delay others by at most one run
+per round. Keys of tickets are fixed when enqueuing, so runs only wait for
+tickets with smaller keys (no cycles).
+
+Only the head of the queue tries to reserve GPUs. The others block on the lock
+of the ticket ahead of them until it proceeds, gives up or dies. The head
+blocks on the docker events stream until a container dies (at most
+NV_WAIT_RECHECK_INTERVAL seconds, e.g., for expired reservations or GPU memory
+freed outside of docker) and tries again. GPUs are selected and reserved under
+gpu_reservation_lock, so the launch proceeds atomically wrt. concurrent runs.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import signal
+import socket
+import time
+
+from ..config import NV_WAIT_RECHECK_INTERVAL
+from ..config import RUNTIME_DIR
+from ..config import uid
+from ..config import user_name
+from ..config.cache import is_trusted
+from .dockerapi import DockerAPIUnavailable
+from .dockerapi import api_path
+from .dockerapi import api_stream
+from .exceptions import GPUsUnavailable
+from .logger import logger
+
+
+QUEUE_DIR = RUNTIME_DIR + 'gpu_queue/'
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _raise_timeout(*_):
+    raise _Timeout()
+
+
+def _flock(fd, operation, timeout=None):
+    """flock(fd, operation) giving up after timeout seconds (None: never).
+
+    Returns if the lock was acquired.
+    """
+    if timeout is None:
+        fcntl.flock(fd, operation)
+        return True
+    previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    try:
+        try:
+            signal.setitimer(signal.ITIMER_REAL, max(timeout, 0.001))
+            fcntl.flock(fd, operation)
+            return True
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _Timeout:
+        return False
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _is_live(fn):
+    """Returns if the ticket fn is still locked by its run."""
+    try:
+        fd = os.open(fn, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def queued_tickets():
+    """Returns [(round, ticket, uid), ...] of the waiting runs in queue order.
+
+    Tickets of runs that died are removed.
+    """
+    try:
+        if not is_trusted(QUEUE_DIR):
+            logger.warning('ignoring untrusted GPU queue %s', QUEUE_DIR)
+            return []
+        names = sorted(os.listdir(QUEUE_DIR))
+    except FileNotFoundError:
+        return []
+    tickets = []
+    for name in names:
+        try:
+            ticket_round, _, _, ticket_uid = (int(p) for p in name.split('_'))
+        except ValueError:
+            # temporary file of a ticket being enqueued
+            continue
+        if not _is_live(QUEUE_DIR + name):
+            try:
+                os.unlink(QUEUE_DIR + name)
+            except OSError:
+                pass
+            continue
+        tickets.append((ticket_round, name, ticket_uid))
+    return tickets
+
+
+@contextmanager
+def queue_ticket(count):
+    """Enqueues a ticket for count GPUs while in context, yields its name.
+
+    Yields None if the queue is unavailable (e.g., not running as root).
+    """
+    try:
+        if os.geteuid() != 0:
+            raise PermissionError('only root may enqueue: %s' % QUEUE_DIR)
+        os.makedirs(QUEUE_DIR, mode=0o755, exist_ok=True)
+        tickets = queued_tickets()
+        ticket_round = max(
+            [tickets[0][0] if tickets else 0]
+            + [r + 1 for r, _, u in tickets if u == uid]
+        )
+        # names sort in queue order: round, enqueue time (ns), pid, uid
+        name = '%08d_%019d_%d_%d' % (
+            ticket_round, int(time.time() * 10**9), os.getpid(), uid)
+        # lock the ticket before it's visible, so it's never considered dead
+        tmp_fn = QUEUE_DIR + '.' + name
+        fd = os.open(tmp_fn, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, json.dumps({
+            'user': user_name, 'uid': uid, 'pid': os.getpid(),
+            'gpus': count, 'time': time.time(),
+        }).encode())
+        os.rename(tmp_fn, QUEUE_DIR + name)
+    except OSError as e:
+        logger.warning('GPU queue unavailable, waiting unordered: %s', e)
+        yield None
+        return
+    try:
+        yield name
+    finally:
+        try:
+            os.unlink(QUEUE_DIR + name)
+        except OSError:
+            pass
+        os.close(fd)
+
+
+def _wait_for_ticket(name, timeout):
+    """Blocks until the run of ticket name proceeded, gave up or died.
+
+    Returns False after timeout seconds (None: no timeout).
+    """
+    try:
+        fd = os.open(QUEUE_DIR + name, os.O_RDONLY)
+    except FileNotFoundError:
+        return True
+    try:
+        return _flock(fd, fcntl.LOCK_SH, timeout)
+    finally:
+        os.close(fd)
+
+
+def _wait_for_container_exit(since, timeout):
+    """Blocks until a container died after since (epoch) or for timeout
+    seconds."""
+    path = api_path(
+        'events', since='%.9f' % since,
+        filters={'type': ['container'], 'event': ['die']},
+    )
+    try:
+        event = next(api_stream(path, timeout=timeout), None)
+        if event is not None:
+            logger.debug('container %s died, checking GPUs again',
+                         event.get('Actor', {}).get('ID'))
+    except socket.timeout:
+        pass
+    except (DockerAPIUnavailable, OSError, ValueError) as e:
+        logger.debug('waiting for docker events failed: %r', e)
+        time.sleep(timeout)
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(0., deadline - time.time())
+
+
+def wait_for_gpus(reserve, count, timeout=-1):
+    """Returns reserve() once it doesn't raise GPUsUnavailable anymore.
+
+    reserve should select and reserve GPUs under gpu_reservation_lock. Runs
+    wait in the queue (see module docstring) for at most timeout seconds (-1:
+    no limit), then the last GPUsUnavailable is raised.
+    """
+    deadline = None if timeout < 0 else time.time() + timeout
+    unavailable = GPUsUnavailable(
+        'ERROR: no GPUs became available within %ds' % timeout)
+    logged = set()
+
+    def log_once(msg, *args):
+        if msg not in logged:
+            logged.add(msg)
+            logger.info(msg, *args)
+
+    with queue_ticket(count) as ticket:
+        while True:
+            names = [name for _, name, _ in queued_tickets()]
+            ahead = names[:names.index(ticket)] if ticket in names else []
+            if ahead:
+                log_once('waiting for %d GPU(s), %d run(s) ahead in queue',
+                         count, len(ahead))
+                if not _wait_for_ticket(ahead[-1], _remaining(deadline)):
+                    raise unavailable
+                continue
+            since = time.time()
+            try:
+                return reserve()
+            except GPUsUnavailable as e:
+                unavailable = e
+            remaining = _remaining(deadline)
+            if remaining == 0:
+                raise unavailable
+            log_once('waiting for %d GPU(s) to become available', count)
+            recheck = NV_WAIT_RECHECK_INTERVAL if remaining is None \
+                else min(remaining, NV_WAIT_RECHECK_INTERVAL)
+            _wait_for_container_exit(since, recheck)
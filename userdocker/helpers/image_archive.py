@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming validation of image archives for load.
+
+docker load creates the repo tags listed in the archive (manifest.json,
+repositories or the OCI index.json), so ALLOWED_IMAGE_REGEXPS would be
+bypassed by loading images. The archive is hence streamed from stdin through
+an incremental tar parser to docker load: the metadata files are parsed on the
+fly and their tags checked as soon as they're complete, all other members are
+only skipped over, nothing is buffered in memory or on disk. docker load only
+creates images after it received the whole archive, so on a disallowed tag it
+is killed before receiving the rest (including the chunk with the tag).
+
+Compressed archives (gzip, bzip2, xz) are decompressed for parsing only, the
+compressed bytes are forwarded. Archives that can't be validated (unknown
+compression, corrupt headers, links named like metadata files, ...) are
+rejected.
+
+docker load follows links in member paths, so metadata files could be written
+via a link to a directory (e.g., a -> . and a/manifest.json) under a name that
+isn't checked. Members below a (sym- or hard)link member are hence rejected, as
+well as metadata files after a link to a directory (the archive root, a path
+outside of it or a directory seen so far). Links to files (e.g., layer.tar in
+legacy docker save archives) are fine.
+"""
+
+import bz2
+import json
+import lzma
+import posixpath
+import zlib
+
+from .exceptions import UserDockerException
+from .image_index import normalize_ref
+from .logger import logger
+from .policy import policy
+
+
+BLOCK_SIZE = 512
+CHUNK_SIZE = 1 << 20
+
+# members docker load takes repo tags from
+METADATA_FILES = ('manifest.json', 'repositories', 'index.json')
+METADATA_MAX_SIZE = 64 << 20
+REGULAR_FILE_TYPES = (b'0', b'\0', b'7')
+LINK_TYPES = (b'1', b'2')
+
+# OCI index annotations naming images
+IMAGE_NAME_ANNOTATIONS = (
+    'io.containerd.image.name',
+    'org.opencontainers.image.ref.name',
+)
+
+
+class ImageArchiveRejected(UserDockerException):
+    pass
+
+
+def manifest_tags(data):
+    """Returns the repo tags of a manifest.json (docker save)."""
+    return [
+        tag for image in json.loads(data) for tag in image['RepoTags'] or []
+    ]
+
+
+def repositories_tags(data):
+    """Returns the repo tags of a repositories file (legacy docker save)."""
+    return [
+        '%s:%s' % (repo, tag)
+        for repo, tags in json.loads(data).items() for tag in tags
+    ]
+
+
+def index_tags(data):
+    """Returns the image names of an OCI index.json."""
+    tags = []
+    for manifest in json.loads(data).get('manifests', []):
+        for key in IMAGE_NAME_ANNOTATIONS:
+            name = (manifest.get('annotations') or {}).get(key)
+            # ref.name can be a plain tag, which isn't a name on its own
+            if name and ('/' in name or ':' in name or key != (
+                    'org.opencontainers.image.ref.name')):
+                tags.append(name)
+    return tags
+
+
+METADATA_PARSERS = {
+    'manifest.json': manifest_tags,
+    'repositories': repositories_tags,
+    'index.json': index_tags,
+}
+
+
+def _cstr(field):
+    return field.split(b'\0', 1)[0]
+
+
+def _tar_number(field):
+    if field[0] & 0x80:
+        # base-256 (GNU), negative numbers are invalid for sizes
+        if field[0] == 0xff:
+            raise ValueError('negative number')
+        return int.from_bytes(bytes([field[0] & 0x7f]) + field[1:], 'big')
+    return int(_cstr(field).strip(b' ') or b'0', 8)
+
+
+def _check_checksum(header):
+    chksum = _tar_number(header[148:156])
+    unsigned = sum(header[:148]) + 8 * 32 + sum(header[156:])
+    signed = unsigned - 2 * sum(b for b in header if b & 0x80)
+    if chksum not in (unsigned, signed):
+        raise ValueError('invalid tar header checksum')
+
+
+def _parse_pax(data):
+    records = {}
+    pos = 0
+    while pos < len(data):
+        length, _, _ = data[pos:pos + 20].partition(b' ')
+        length = int(length)
+        record = data[pos:pos + length]
+        if length <= 0 or not record.endswith(b'\n'):
+            raise ValueError('invalid pax record')
+        key, _, value = record.partition(b' ')[2][:-1].partition(b'=')
+        records[key.decode('utf-8', 'replace')] = value
+        pos += length
+    return records
+
+
+def _member_path(name):
+    """Returns the normalized path of a member name (relative to the root)."""
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+    return posixpath.normpath('/' + name).lstrip('/')
+
+
+def _metadata_file(paths):
+    """Returns the metadata file one of the member paths refers to."""
+    for path in paths:
+        if path in METADATA_FILES:
+            return path
+    return None
+
+
+def _resolve(base, target):
+    """Returns the path of target relative to directory base, None if it
+    escapes the root."""
+    parts = base.split('/') if base else []
+    for part in target.split('/'):
+        if part == '..':
+            if not parts:
+                return None
+            parts.pop()
+        elif part and part != '.':
+            parts.append(part)
+    return '/'.join(parts)
+
+
+def _parents(path):
+    """Yields the parent directories of a member path (outermost first)."""
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+        yield '/'.join(parts[:i])
+
+
+class TarStreamValidator:
+    """Incremental tar parser checking the tags of image metadata members.
+
+    feed() it the (uncompressed) archive in chunks of any size. authorize(tag)
+    must raise a UserDockerException for disallowed tags.
+    """
+
+    def __init__(self, authorize):
+        self.authorize = authorize
+        self.tags = []
+        self.done = False
+        self._buf = bytearray()
+        # bytes to skip (member data / padding)
+        self._skip = 0
+        # (kind, size, padding, name) of the member content being collected
+        self._collect = None
+        # data size of an old GNU sparse member with extended headers
+        self._sparse_size = None
+        self._pax = {}
+        self._long_names = []
+        self._long_link = None
+        # paths of link members, directories seen so far and the first link
+        # to a directory (see module docstring)
+        self._links = set()
+        self._dirs = set()
+        self._dir_link = None
+
+    def feed(self, data):
+        try:
+            self._feed(memoryview(data))
+        except (ValueError, TypeError) as e:
+            raise ImageArchiveRejected(
+                'ERROR: load: corrupt tar archive (%s)' % e)
+
+    def _feed(self, data):
+        while data and not self.done:
+            if self._skip:
+                n = min(self._skip, len(data))
+                self._skip -= n
+                data = data[n:]
+                continue
+            if self._collect:
+                kind, size, padding, name = self._collect
+                n = min(size - len(self._buf), len(data))
+                self._buf += data[:n]
+                data = data[n:]
+                if len(self._buf) == size:
+                    content, self._buf = bytes(self._buf), bytearray()
+                    self._collect = None
+                    self._skip = padding
+                    self._member_content(kind, name, content)
+                continue
+            n = min(BLOCK_SIZE - len(self._buf), len(data))
+            self._buf += data[:n]
+            data = data[n:]
+            if len(self._buf) == BLOCK_SIZE:
+                header, self._buf = bytes(self._buf), bytearray()
+                self._header(header)
+
+    def close(self):
+        if not self.done:
+            logger.warning('load: image archive ended prematurely')
+
+    def _collect_content(self, kind, size, name=None):
+        if size > METADATA_MAX_SIZE:
+            raise ImageArchiveRejected(
+                'ERROR: load: %s member of %d bytes too large to validate' % (
+                    name or kind, size))
+        padding = -size % BLOCK_SIZE
+        if size:
+            self._collect = (kind, size, padding, name)
+        else:
+            self._skip = padding
+            self._member_content(kind, name, b'')
+
+    def _header(self, header):
+        if self._sparse_size is not None:
+            # old GNU sparse format: extended headers until not isextended,
+            # followed by the member data
+            if not header[504]:
+                self._skip, self._sparse_size = self._sparse_size, None
+            return
+        if header == bytes(BLOCK_SIZE):
+            # end of archive, docker ignores anything after it
+            self.done = True
+            return
+        _check_checksum(header)
+        typeflag = header[156:157]
+        size = _tar_number(header[124:136])
+        if typeflag == b'x':
+            self._collect_content('pax', size)
+            return
+        if typeflag == b'L':
+            self._collect_content('longname', size)
+            return
+        if typeflag == b'K':
+            self._collect_content('longlink', size)
+            return
+        if typeflag == b'g':
+            # global pax header
+            self._skip = size + -size % BLOCK_SIZE
+            return
+
+        names = [_cstr(header[0:100])]
+        prefix = _cstr(header[345:500])
+        if prefix:
+            # the prefix field isn't used by all formats, check both names
+            names.append(prefix + b'/' + names[0])
+        if 'path' in self._pax:
+            names.append(self._pax['path'])
+        names.extend(self._long_names)
+        if 'size' in self._pax:
+            size = int(self._pax['size'])
+        link_target = self._pax.get('linkpath') or self._long_link \
+            or _cstr(header[157:257])
+        self._pax, self._long_names, self._long_link = {}, [], None
+
+        paths = list(dict.fromkeys(_member_path(n) for n in names))
+        self._check_paths(paths, typeflag, link_target)
+        name = _metadata_file(paths)
+        if name is not None and self._dir_link is not None:
+            raise ImageArchiveRejected(
+                "ERROR: load: %s after link to a directory %s" % (
+                    name, self._dir_link))
+        if typeflag == b'S' and header[482] and name is None:
+            self._sparse_size = size + -size % BLOCK_SIZE
+        elif name is None or typeflag == b'5':
+            self._skip = size + -size % BLOCK_SIZE
+        elif typeflag in REGULAR_FILE_TYPES:
+            self._collect_content('metadata', size, name)
+        else:
+            raise ImageArchiveRejected(
+                "ERROR: load: can't validate %s of type %r" % (
+                    name, typeflag.decode()))
+
+    def _check_paths(self, paths, typeflag, link_target):
+        """Rejects members below links, records links and directories."""
+        for path in paths:
+            for parent in _parents(path):
+                if parent in self._links:
+                    raise ImageArchiveRejected(
+                        "ERROR: load: %s is below link %s" % (path, parent))
+        for path in paths:
+            self._dirs.update(_parents(path))
+            if typeflag == b'5':
+                self._dirs.add(path)
+            elif typeflag in LINK_TYPES:
+                self._links.add(path)
+                if self._dir_link is None and self._is_dir_link(
+                        path, typeflag, link_target):
+                    self._dir_link = path
+
+    def _is_dir_link(self, path, typeflag, target):
+        """Returns if the link member path may refer to a directory."""
+        target = target.decode('utf-8', 'replace')
+        if typeflag == b'2':
+            # symlinks are relative to their directory
+            if target.startswith('/') or target.endswith('/'):
+                return True
+            resolved = _resolve(posixpath.dirname(path), target)
+        else:
+            resolved = _resolve('', target)
+        return resolved is None or resolved == '' or resolved in self._dirs
+
+    def _member_content(self, kind, name, content):
+        if kind == 'pax':
+            self._pax.update(_parse_pax(content))
+        elif kind == 'longname':
+            self._long_names.append(_cstr(content))
+        elif kind == 'longlink':
+            self._long_link = _cstr(content)
+        else:
+            try:
+                tags = METADATA_PARSERS[name](content.decode('utf-8'))
+            except (ValueError, TypeError, AttributeError, KeyError) as e:
+                raise ImageArchiveRejected(
+                    "ERROR: load: can't parse %s: %r" % (name, e))
+            for tag in tags:
+                self.authorize(tag)
+            logger.debug('load: %s tags: %r', name, tags)
+            self.tags.extend(tags)
+
+
+class _Decompressor:
+    """Streaming decompressor of (multi-member) gzip, bzip2 and xz data."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self._d = self._new()
+
+    def _new(self):
+        if self.kind == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.kind == 'bzip2':
+            return bz2.BZ2Decompressor()
+        return lzma.LZMADecompressor()
+
+    def pieces(self, data):
+        """Yields the decompressed data in pieces of at most CHUNK_SIZE."""
+        while data:
+            if self.kind == 'gzip':
+                yield self._d.decompress(data, CHUNK_SIZE)
+                while self._d.unconsumed_tail:
+                    yield self._d.decompress(
+                        self._d.unconsumed_tail, CHUNK_SIZE)
+            else:
+                yield self._d.decompress(data, max_length=CHUNK_SIZE)
+                while not self._d.eof and not self._d.needs_input:
+                    yield self._d.decompress(b'', max_length=CHUNK_SIZE)
+            data = b''
+            if self._d.eof and self._d.unused_data:
+                # next member / stream
+                data = self._d.unused_data
+                self._d = self._new()
+
+
+# (magic, compression) as detected by docker load
+COMPRESSION_MAGICS = (
+    (b'\x1f\x8b\x08', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+
+class ImageArchiveValidator:
+    """Validates a possibly compressed image archive fed in chunks."""
+
+    def __init__(self, authorize=None):
+        self.tar = TarStreamValidator(authorize or authorize_tag)
+        self._decompressor = None
+        self._head = b''
+
+    @property
+    def tags(self):
+        return self.tar.tags
+
+    def feed(self, data):
+        if self._head is not None:
+            # detect compression from the first bytes
+            self._head += data
+            if len(self._head) < 6:
+                return
+            data, self._head = self._head, None
+            self._detect(data)
+        if self.tar.done:
+            return
+        if self._decompressor is None:
+            self.tar.feed(data)
+            return
+        try:
+            for piece in self._decompressor.pieces(data):
+                self.tar.feed(piece)
+                if self.tar.done:
+                    break
+        except (OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+            raise ImageArchiveRejected(
+                'ERROR: load: corrupt %s data: %s' % (
+                    self._decompressor.kind, e))
+
+    def _detect(self, head):
+        for magic, kind in COMPRESSION_MAGICS:
+            if head.startswith(magic):
+                if kind == 'zstd':
+                    raise ImageArchiveRejected(
+                        "ERROR: load: can't validate zstd compressed archives,"
+                        " please decompress or use gzip")
+                self._decompressor = _Decompressor(kind)
+                logger.debug('load: %s compressed archive', kind)
+                return
+
+    def close(self):
+        if self._head:
+            self._head, head = None, self._head
+            self._detect(head)
+            self.feed(head)
+        self.tar.close()
+
+
+def authorize_tag(tag):
+    """Checks tag against ALLOWED_IMAGE_REGEXPS (as docker ps shows it)."""
+    return policy().authorize_image(normalize_ref(tag))
+
+
+def validated_chunks(stream, chunk_size=CHUNK_SIZE):
+    """Yields the image archive read from stream in chunks, validated.
+
+    Each chunk is validated before it's yielded (it could complete the
+    archive). Raises ImageArchiveRejected for disallowed / invalid archives.
+    """
+    validator = ImageArchiveValidator()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        validator.feed(chunk)
+        yield chunk
+    validator.close()
+    logger.info('load: validated tags: %s',
+                ', '.join(dict.fromkeys(validator.tags)) or '-')
+
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Node local index of the locally available images.
+
+Maps image references (repo:tag and repo@digest) to their ID, digest, size and
+creation time. It's refreshed from the daemon's image list and persisted as a
+snapshot in RUNTIME_DIR. The snapshot is valid as long as the mtime of docker's
+reference store (repositories.json in DOCKER_IMAGE_DB, rewritten on each pull,
+tag, load and rmi) is unchanged, which is checked with a stat instead of a
+daemon round trip. If the reference store can't be stat'ed, image events since
+the snapshot invalidate it. userdockerd refreshes the snapshot on image events.
+"""
+
+import glob
+import json
+import os
+import time
+
+from ..config import DOCKER_IMAGE_DB
+from ..config import IMAGE_INDEX
+from ..config import RUNTIME_DIR
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .dockerapi import DockerAPIUnavailable
+from .dockerapi import api_path
+from .dockerapi import api_stream
+from .dockerapi import image_exists
+from .dockerapi import image_repo
+from .dockerapi import images_list
+from .logger import logger
+
+
+IMAGE_INDEX_FN = RUNTIME_DIR + 'image_index.json'
+IMAGE_EVENTS = ('delete', 'import', 'load', 'pull', 'tag', 'untag')
+
+DEFAULT_REGISTRY_PREFIXES = ('docker.io/library/', 'docker.io/', 'library/')
+
+
+def normalize_ref(image):
+    """Returns image as listed by docker images (with tag, short name)."""
+    if '@' not in image and image_repo(image) == image:
+        image += ':latest'
+    for prefix in DEFAULT_REGISTRY_PREFIXES:
+        if image.startswith(prefix):
+            return image[len(prefix):]
+    return image
+
+
+def image_db_mtime(image_db=DOCKER_IMAGE_DB):
+    """Returns the latest mtime of docker's reference stores or None."""
+    mtimes = []
+    for fn in glob.glob(os.path.join(image_db, '*', 'repositories.json')):
+        try:
+            mtimes.append(os.stat(fn).st_mtime_ns)
+        except OSError:
+            pass
+    return max(mtimes) if mtimes else None
+
+
+class ImageIndex:
+    """Local images by reference, see module docstring."""
+
+    def __init__(self):
+        # ref -> {'id': ..., 'digest': ..., 'size': ..., 'created': ...}
+        self.images = {}
+        # time and reference store mtime of the last refresh
+        self.time = 0
+        self.db_mtime = None
+
+    def lookup(self, image):
+        """Returns the info of a local image reference or None."""
+        return self.images.get(normalize_ref(image))
+
+    def refresh(self, docker):
+        """Rebuilds the index from the daemon's image list."""
+        db_mtime, now = image_db_mtime(), time.time()
+        images = {}
+        for image_id, tags, digests, size, created in images_list(docker):
+            info = {
+                'id': image_id,
+                'digest': digests[0] if digests else None,
+                'size': size,
+                'created': created,
+            }
+            for ref in tags + digests:
+                images[ref] = info
+        self.images, self.time, self.db_mtime = images, now, db_mtime
+        logger.debug('refreshed image index: %d references', len(images))
+
+    def is_current(self):
+        """Returns if no images changed since the last refresh.
+
+        Uses the reference store mtime if available, image events otherwise.
+        """
+        if not self.time:
+            return False
+        db_mtime = image_db_mtime()
+        if db_mtime is not None:
+            return db_mtime == self.db_mtime
+        path = api_path(
+            'events', since='%.9f' % self.time, until='%.9f' % time.time(),
+            filters={'type': ['image'], 'event': IMAGE_EVENTS},
+        )
+        try:
+            return next(api_stream(path), None) is None
+        except (DockerAPIUnavailable, OSError, ValueError) as e:
+            logger.debug('checking image events failed: %r', e)
+            return False
+
+    def follow(self, docker, events=None):
+        """Refreshes and saves the index on image events (blocks)."""
+        if events is None:
+            events = api_stream(api_path(
+                'events', since='%.9f' % self.time,
+                filters={'type': ['image'], 'event': IMAGE_EVENTS},
+            ))
+        for event in events:
+            logger.debug('image event: %s %s', event.get('Action'),
+                         event.get('Actor', {}).get('ID'))
+            self.refresh(docker)
+            self.save()
+
+    def save(self, fn=IMAGE_INDEX_FN):
+        """Persists a snapshot of the index (only possible as root)."""
+        snapshot = json.dumps({
+            'time': self.time,
+            'db_mtime': self.db_mtime,
+            'images': self.images,
+        })
+        try:
+            write_atomic(fn, snapshot.encode())
+        except OSError as e:
+            logger.debug('could not save image index: %s', e)
+
+    @classmethod
+    def load(cls, fn=IMAGE_INDEX_FN):
+        """Returns the index from a snapshot (empty if missing / untrusted)."""
+        index = cls()
+        try:
+            if not is_trusted(fn):
+                logger.warning('ignoring untrusted image index %s', fn)
+                return index
+            with open(fn) as f:
+                snapshot = json.load(f)
+            index.images = snapshot['images']
+            index.time = snapshot['time']
+            index.db_mtime = snapshot['db_mtime']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('ignoring broken image index: %s', e)
+            index = cls()
+        return index
+
+
+def image_index(docker, fn=IMAGE_INDEX_FN):
+    """Returns the current image index (from the snapshot if still valid)."""
+    index = ImageIndex.load(fn)
+    if not index.is_current():
+        index.refresh(docker)
+        index.save(fn)
+    return index
+
+
+def local_image_exists(docker, image):
+    """Checks if image is locally available, via the image index first.
+
+    Image IDs and references missing in the index are checked with the daemon
+    (see image_exists).
+    """
+    if IMAGE_INDEX:
+        try:
+            if image_index(docker).lookup(image) is not None:
+                return True
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('image index unavailable: %s', e)
+    return image_exists(docker, image)
+
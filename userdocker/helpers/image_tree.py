@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Image tree (as dockviz images --tree) built in process.
+
+The parent of an image is its ParentId (images built locally with the classic
+builder) or else the image with the longest layer chain (RootFS.Layers) that
+is a strict prefix of its own (e.g., pulled images sharing base layers). Layer
+chains need an inspect per image, but image IDs are content addresses, so they
+are cached in RUNTIME_DIR and only new images are inspected.
+"""
+
+import json
+
+from ..config import RUNTIME_DIR
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .dockerapi import image_repo
+from .dockerapi import images_inspect
+from .dockerapi import images_list_all
+from .logger import logger
+
+
+IMAGE_LAYERS_FN = RUNTIME_DIR + 'image_layers.json'
+
+
+def _image(image_id, parent, tags, size, layers=None):
+    tags = [t for t in tags or [] if t != '<none>:<none>']
+    return {
+        'id': image_id, 'parent': parent or None, 'tags': tags,
+        'size': size, 'layers': layers,
+    }
+
+
+def load_layers(fn=IMAGE_LAYERS_FN):
+    """Returns the cached {image ID: layer chain}."""
+    try:
+        if is_trusted(fn):
+            with open(fn) as f:
+                return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug('ignoring cached image layers: %s', e)
+    return {}
+
+
+def save_layers(layers, fn=IMAGE_LAYERS_FN):
+    try:
+        write_atomic(fn, json.dumps(layers).encode())
+    except OSError as e:
+        logger.debug('could not cache image layers: %s', e)
+
+
+def list_images(docker, layers_fn=IMAGE_LAYERS_FN):
+    """Returns all images (including intermediate ones) with their layers."""
+    images, layers = [], {}
+    for d in images_list_all(docker):
+        images.append(_image(
+            d['Id'], d.get('ParentId'), d.get('RepoTags'), d['Size']))
+        if 'RootFS' in d:
+            layers[d['Id']] = d['RootFS'].get('Layers') or []
+
+    # only images without (local) parent need their layer chains
+    ids = set(i['id'] for i in images)
+    cached = load_layers(layers_fn)
+    cached.update(layers)
+    missing = [
+        i['id'] for i in images
+        if i['parent'] not in ids and i['id'] not in cached
+    ]
+    if missing:
+        for d in images_inspect(docker, missing):
+            cached[d['Id']] = d.get('RootFS', {}).get('Layers') or []
+        save_layers(
+            {k: v for k, v in cached.items() if k in ids}, layers_fn)
+    for i in images:
+        i['layers'] = cached.get(i['id'])
+    return images
+
+
+def _sort_key(image):
+    return image['tags'][:1], image['id']
+
+
+def build_tree(images):
+    """Sets 'children' of images, returns the roots (sorted by tags / ID)."""
+    by_id = {i['id']: i for i in images}
+    by_layers = {}
+    for i in images:
+        i['children'] = []
+        if i['layers']:
+            by_layers.setdefault(tuple(i['layers']), []).append(i)
+    roots = []
+    for i in images:
+        parent = by_id.get(i['parent'])
+        if parent is None and i['layers']:
+            layers = tuple(i['layers'])
+            for n in range(len(layers) - 1, 0, -1):
+                candidates = by_layers.get(layers[:n])
+                if candidates:
+                    # prefer tagged images as parents
+                    parent = min(
+                        candidates, key=lambda c: (not c['tags'], c['id']))
+                    break
+        (parent['children'] if parent else roots).append(i)
+    for i in images:
+        i['children'].sort(key=_sort_key)
+    return sorted(roots, key=_sort_key)
+
+
+def find_image(images, name):
+    """Returns the image with ID (prefix) or tag name or None."""
+    tagged = name
+    if '@' not in name and image_repo(name) == name:
+        tagged += ':latest'
+    for i in images:
+        if tagged in i['tags']:
+            return i
+    if len(name) >= 4:
+        name = name if name.startswith('sha256:') else 'sha256:' + name
+        for i in images:
+            if i['id'].startswith(name):
+                return i
+    return None
+
+
+def human_size(size):
+    """Formats size like dockviz (powers of 1000, one decimal)."""
+    size = float(size)
+    units = ['B', 'KB', 'MB', 'GB', 'TB']
+    unit = 0
+    while size >= 1000 and unit < len(units) - 1:
+        size /= 1000
+        unit += 1
+    return '%.1f %s' % (size, units[unit])
+
+
+def _short_id(image_id):
+    return image_id.partition('sha256:')[2][:12] or image_id[:12]
+
+
+def render_tree(roots):
+    """Returns the tree as lines like dockviz images --tree."""
+    lines = []
+    # iterative (deep chains of intermediate images)
+    stack = [(r, '', i == len(roots) - 1) for i, r in reversed(list(
+        enumerate(roots)))]
+    while stack:
+        image, indent, last = stack.pop()
+        line = '%s%s%s Virtual Size: %s' % (
+            indent, '└─' if last else '├─', _short_id(image['id']),
+            human_size(image['size']))
+        if image['tags']:
+            line += ' Tags: %s' % ', '.join(image['tags'])
+        lines.append(line)
+        indent += '  ' if last else '│ '
+        children = image['children']
+        stack.extend(
+            (c, indent, i == len(children) - 1)
+            for i, c in reversed(list(enumerate(children))))
+    return lines
+
+
+def tree_json(roots):
+    """Returns the tree as json serializable nested dicts."""
+    nodes = []
+    # iterative like render_tree
+    stack = [(r, nodes) for r in reversed(roots)]
+    while stack:
+        image, siblings = stack.pop()
+        node = {
+            'id': image['id'], 'tags': image['tags'], 'size': image['size'],
+            'children': [],
+        }
+        siblings.append(node)
+        stack.extend(
+            (c, node['children']) for c in reversed(image['children']))
+    return nodes
+
+
+def dumps_tree_json(roots, indent=2):
+    """Returns tree_json(roots) as json.dumps(..., indent=indent) would.
+
+    json.dumps recurses per nesting level and fails on deep chains.
+    """
+    def pad(level):
+        return '\n' + ' ' * (indent * level)
+
+    def dumps(value, level):
+        return json.dumps(value, indent=indent).replace('\n', pad(level))
+
+    chunks = []
+    # (node, level) to expand or a string to append
+    stack = [(tree_json(roots), 0)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            chunks.append(item)
+            continue
+        value, level = item
+        if isinstance(value, list):
+            if not value:
+                chunks.append('[]')
+                continue
+            chunks.append('[')
+            todo = []
+            for i, node in enumerate(value):
+                todo += [pad(level + 1), (node, level + 1)]
+                if i < len(value) - 1:
+                    todo.append(',')
+            todo += [pad(level), ']']
+        else:
+            chunks.append('{')
+            todo = []
+            for key in ('id', 'tags', 'size'):
+                todo.append('%s%s: %s,' % (
+                    pad(level + 1), json.dumps(key),
+                    dumps(value[key], level + 1)))
+            todo += [pad(level + 1) + '"children": ',
+                     (value['children'], level + 1), pad(level), '}']
+        stack.extend(reversed(todo))
+    return ''.join(chunks)
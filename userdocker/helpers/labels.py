@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Ownership and GPU assignment of containers started by userdocker.
+
+run stamps them as container labels (and env vars, see USERDOCKER_* in
+containers), so the docker daemon can filter containers by owner / GPU usage
+server side and container listings include them without inspecting each
+container. Containers started by older versions only have the env vars (see
+CONTAINER_LABELS_ENV_FALLBACK).
+"""
+
+LABEL_USER = 'userdocker.user'
+LABEL_UID = 'userdocker.uid'
+LABEL_GPU = 'userdocker.gpu'
+OWNER_LABELS = (LABEL_USER, LABEL_UID, LABEL_GPU)
+
+
+def userdocker_labels(user_name, uid, gpus=None):
+    """Returns the labels of a container (gpus as comma separated str)."""
+    labels = {LABEL_USER: user_name, LABEL_UID: str(uid)}
+    if gpus:
+        labels[LABEL_GPU] = gpus
+    return labels
+
+
+def owner_from_labels(labels):
+    """Returns (user, uid, gpus) from container labels, None if unlabeled."""
+    if not labels or not labels.get(LABEL_UID):
+        return None
+    gpus = labels.get(LABEL_GPU)
+    return (
+        labels.get(LABEL_USER) or '',
+        int(labels[LABEL_UID]),
+        [int(g) for g in gpus.split(',')] if gpus else [],
+    )
+
+
+def container_find_userdocker_user_uid_gpus(container_env):
+    pairs = [var.partition('=') for var in container_env]
+    users = [v for k, _, v in pairs if k == 'USERDOCKER_USER']
+    uids = [v for k, _, v in pairs if k == 'USERDOCKER_UID']
+    gpus = [v for k, _, v in pairs if k == 'USERDOCKER_NV_GPU']
+    if gpus:
+        gpus = [int(g) for g in gpus[0].split(',')]
+    return users[0] if users else '', int(uids[0]) if uids else None, gpus
+
+
+def container_owner(details):
+    """Returns (user, uid, gpus) of a container from its docker inspect dict.
+
+    Uses the labels, the env vars for containers started by older versions.
+    uid is None for containers not started by userdocker.
+    """
+    owner = owner_from_labels(details['Config'].get('Labels'))
+    if owner is not None:
+        return owner
+    return container_find_userdocker_user_uid_gpus(
+        details['Config']['Env'] or [])
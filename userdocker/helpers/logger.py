@@ -12,6 +12,7 @@ def logger_setup(args):
     logging.root.setLevel(args.loglvl)
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug('configs loaded: %s', config.configs_loaded)
+        logger.debug('config cache: %s', config.configs_cache)
         if len(config.configs_loaded) <= 1:
             logger.warning(
                 'No config found, using defaults! You should copy\n%s\nto\n%s\n'
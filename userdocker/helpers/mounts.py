@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent, time bounded probing of mount host paths.
+
+Each host path is probed in its own daemon thread (a hanging NFS server can
+block a stat / listdir for minutes and such threads can't be interrupted), so
+automounts are triggered in parallel and a run waits at most
+PROBE_MOUNTS_TIMEOUT seconds. Mounts that timed out or failed are remembered
+as dead in RUNTIME_DIR for PROBE_MOUNTS_DEAD_CACHE_TTL seconds to fail
+immediately.
+"""
+
+import json
+import os
+import threading
+import time
+
+from ..config import PROBE_MOUNTS_DEAD_CACHE_TTL
+from ..config import PROBE_MOUNTS_TIMEOUT
+from ..config import PROBE_USED_MOUNTS
+from ..config import RUNTIME_DIR
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .exceptions import UserDockerException
+from .logger import logger
+
+
+DEAD_MOUNTS_FN = RUNTIME_DIR + 'dead_mounts.json'
+
+# log mounts still probing after this many seconds
+PROBE_MOUNTS_SLOW = 1
+
+
+def probe_mount(path, listdir=PROBE_USED_MOUNTS):
+    """Returns if path exists, lists dirs to trigger automounts."""
+    if not os.path.exists(path):
+        return False
+    if listdir and os.path.isdir(path):
+        os.listdir(path)
+    return True
+
+
+def load_dead_mounts(fn=DEAD_MOUNTS_FN):
+    """Returns {path: time} of mounts recently found dead."""
+    try:
+        if not is_trusted(fn):
+            return {}
+        with open(fn) as f:
+            dead_mounts = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {
+        path: t for path, t in dead_mounts.items()
+        if 0 <= now - t < PROBE_MOUNTS_DEAD_CACHE_TTL
+    }
+
+
+def remember_dead_mounts(paths, fn=DEAD_MOUNTS_FN):
+    dead_mounts = load_dead_mounts(fn)
+    dead_mounts.update(dict.fromkeys(paths, time.time()))
+    try:
+        write_atomic(fn, json.dumps(dead_mounts).encode())
+    except OSError as e:
+        logger.debug('could not remember dead mounts: %s', e)
+
+
+def _probe(probe, path, results):
+    start = time.time()
+    try:
+        res = probe(path)
+    except Exception as e:
+        res = e
+    results[path] = (res, time.time() - start)
+
+
+def probe_mounts(paths, timeout=PROBE_MOUNTS_TIMEOUT, probe=probe_mount,
+                 dead_mounts_fn=DEAD_MOUNTS_FN):
+    """Probes paths concurrently.
+
+    Raises UserDockerException for paths that don't exist, fail, are known to
+    be dead or don't respond within timeout seconds. dead_mounts_fn=None
+    disables the dead mounts cache.
+    """
+    paths = list(dict.fromkeys(paths))
+    if dead_mounts_fn:
+        dead_mounts = load_dead_mounts(dead_mounts_fn)
+        dead = [p for p in paths if p in dead_mounts]
+        if dead:
+            raise UserDockerException(
+                "ERROR: mount(s) recently unresponsive, try again later: %s"
+                % ', '.join(dead)
+            )
+
+    results = {}
+    threads = []
+    for path in paths:
+        t = threading.Thread(target=_probe, args=(probe, path, results))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    start = time.time()
+    deadline = start + timeout
+    reported = False
+    for path, t in zip(paths, threads):
+        while t.is_alive() and time.time() < deadline:
+            t.join(min(PROBE_MOUNTS_SLOW, max(0, deadline - time.time())))
+            if t.is_alive() and not reported \
+                    and time.time() - start >= PROBE_MOUNTS_SLOW:
+                reported = True
+                logger.warning(
+                    'waiting for slow mount(s): %s', ', '.join(
+                        p for p in paths if p not in results))
+    for path in paths:
+        if path in results:
+            logger.debug(
+                'probed mount %s in %.3fs: %r', path, results[path][1],
+                results[path][0])
+
+    missing = [p for p in paths if results.get(p, (True,))[0] is False]
+    if missing:
+        raise UserDockerException(
+            "ERROR: mount can't be found: %s" % ', '.join(missing)
+        )
+    failed = [
+        (p, results[p][0]) for p in paths
+        if p in results and isinstance(results[p][0], Exception)
+    ]
+    slow = [p for p in paths if p not in results]
+    if dead_mounts_fn and (failed or slow):
+        remember_dead_mounts([p for p, _ in failed] + slow, dead_mounts_fn)
+    if failed:
+        raise UserDockerException(
+            "ERROR: mount(s) failed: %s" % ', '.join(
+                '%s (%s)' % (p, e) for p, e in failed)
+        )
+    if slow:
+        raise UserDockerException(
+            "ERROR: mount(s) didn't respond within %ss: %s" % (
+                timeout, ', '.join(slow))
+        )
+
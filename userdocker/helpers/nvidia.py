@@ -1,101 +1,157 @@
 # -*- coding: utf-8 -*-
 import os
-import json
-import logging
 import re
+import time
 from collections import defaultdict
 from operator import itemgetter
 
 from ..config import uid
 from ..config import NVIDIA_SMI
 from ..config import NV_ALLOWED_GPUS
+from ..config import NV_CONTAINER_GPU_INDEX
 from ..config import NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION
 from ..config import NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED
+from ..config import NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION
+from ..config import USERDOCKERD_MAX_STATE_AGE
+from .exceptions import UserDockerException
 from .logger import logger
-from .execute import exec_cmd
+from .gpu_index import ContainerGPUIndex
+from .gpu_query import sample_gpu_stats
+from .reservation import add_reservations_to_gpus_used
+from .placement import place_gpus
+from .placement import placement_policy
+from .topology import gpu_topology
+from .userdockerd import DaemonUnavailable
+from .userdockerd import daemon_query
 
 
-def container_find_userdocker_user_uid_gpus(container_env):
-    pairs = [var.partition('=') for var in container_env]
-    users = [v for k, _, v in pairs if k == 'USERDOCKER_USER']
-    uids = [v for k, _, v in pairs if k == 'USERDOCKER_UID']
-    gpus = [v for k, _, v in pairs if k == 'USERDOCKER_NV_GPU']
-    if gpus:
-        gpus = [int(g) for g in gpus[0].split(',')]
-    return users[0] if users else '', int(uids[0]) if uids else None, gpus
+def _container_gpu_index(docker):
+    """Returns a current ContainerGPUIndex.
+
+    With NV_CONTAINER_GPU_INDEX, the index snapshot is caught up via docker
+    events, otherwise it's rebuilt from all running containers.
+    """
+    if NV_CONTAINER_GPU_INDEX:
+        index = ContainerGPUIndex.load()
+        index.catch_up(docker)
+        index.save()
+    else:
+        index = ContainerGPUIndex()
+        index.rebuild(docker)
+    return index
+
+
+def nvidia_collect_gpus_used_by_containers(docker):
+    """Returns {gpu: [(container, name, user, uid), ...]} from docker."""
+    return _container_gpu_index(docker).gpus_used()
+
+
+def _daemon_snapshot():
+    """Returns the GPU state snapshot of userdockerd (see GPUSnapshots).
+
+    Raises DaemonUnavailable if the daemon can't be used or its state is
+    outdated.
+    """
+    state = daemon_query('state')
+    age = time.time() - state['time']
+    if age > USERDOCKERD_MAX_STATE_AGE:
+        raise DaemonUnavailable('userdockerd state outdated: %.1fs' % age)
+    gpus_used_by_containers = defaultdict(list)
+    for gpu, info in state['used'].items():
+        gpus_used_by_containers[int(gpu)] = [tuple(i) for i in info]
+    return {
+        'time': state['time'],
+        'gpus': {int(gpu): tuple(s) for gpu, s in state['gpus'].items()},
+        'used': gpus_used_by_containers,
+        # not sent by older daemons
+        'started': state.get('started', {}),
+    }
+
+
+class GPUSnapshots:
+    """Consistent snapshots of the GPU state, e.g., for ps --watch.
+
+    take() returns {'time': epoch, 'gpus': gpu_stats, 'used':
+    gpus_used_by_containers, 'started': {container: start time or None}},
+    answered by userdockerd if running, otherwise collected locally. Locally,
+    the container GPU index is kept between snapshots and only caught up with
+    the docker events since the previous one.
+    """
+
+    def __init__(self, docker, nvidia_smi=NVIDIA_SMI):
+        self.docker = docker
+        self.nvidia_smi = nvidia_smi
+        self.index = None
+
+    def take(self):
+        try:
+            return _daemon_snapshot()
+        except DaemonUnavailable:
+            pass
+        if self.index is None:
+            self.index = _container_gpu_index(self.docker)
+        else:
+            self.index.catch_up(self.docker)
+            if NV_CONTAINER_GPU_INDEX:
+                self.index.save()
+        return {
+            'time': time.time(),
+            'gpus': sample_gpu_stats(self.nvidia_smi),
+            'used': self.index.gpus_used(),
+            'started': self.index.started_times(),
+        }
 
 
 def nvidia_get_gpus_used_by_containers(docker):
-    running_containers = exec_cmd(
-        [docker, 'ps', '-q'],
-        return_status=False,
-        loglvl=logging.DEBUG,
-    ).split()
-    gpu_used_by_containers = defaultdict(list)
-    if not running_containers:
-        return gpu_used_by_containers
-    gpu_used_by_containers_str = exec_cmd(
-        [
-            docker, 'inspect', '--format',
-            '[{{json .Name}}, {{json .Id}}, {{json .Config.Env}}]'
-        ] + running_containers,
-        return_status=False,
-        loglvl=logging.DEBUG,
-    )
-    logger.debug('gpu_used_by_containers_str: %s', gpu_used_by_containers_str)
-    for line in gpu_used_by_containers_str.splitlines():
-        container_name, container, container_env = json.loads(line)
-        container_user, container_uid, gpus = \
-            container_find_userdocker_user_uid_gpus(container_env)
-        for gpu_id in gpus:
-            gpu_used_by_containers[gpu_id].append(
-                (container, container_name, container_user, container_uid)
-            )
-            logger.debug(
-                'gpu %d used by container: %s, name: %s, user: %s, uid: %s',
-                gpu_id, container, container_name, container_user, container_uid
-            )
-    return gpu_used_by_containers
+    """Like nvidia_collect_gpus_used_by_containers, but via userdockerd."""
+    try:
+        return _daemon_snapshot()['used']
+    except DaemonUnavailable:
+        return nvidia_collect_gpus_used_by_containers(docker)
+
+
+def nvidia_get_gpu_state(docker, nvidia_smi=NVIDIA_SMI):
+    """Returns (gpu_stats, gpus_used_by_containers).
+
+    gpu_stats is {gpu: (MiB memory used, % utilization)}, the peak values of
+    the sampling window (see sample_gpu_stats, userdockerd's GPU history).
+
+    Answered by userdockerd if running, otherwise collected locally.
+    """
+    snapshot = GPUSnapshots(docker, nvidia_smi).take()
+    return snapshot['gpus'], snapshot['used']
 
 
 def nvidia_get_available_gpus(docker, nvidia_smi=NVIDIA_SMI):
     if not NV_ALLOWED_GPUS:
-        return []
-
-    gpu_mem_used_str = exec_cmd(
-        [nvidia_smi,
-         '--query-gpu=index,memory.used,utilization.gpu',
-         '--format=csv'],
-        return_status=False,
-        loglvl=logging.DEBUG,
-    )
-    logger.debug('gpu usage:\n%s', gpu_mem_used_str)
-    gpu_mem_used = {}
-    for line in gpu_mem_used_str.splitlines()[1:]:  # skip header
-        gpu, mem_used, gpu_utilization = line.split(', ')
-        gpu = int(gpu)
-        mem_used = int(mem_used.split(' MiB')[0])
-        gpu_mem_used[gpu] = mem_used
-
-    gpus_used_by_containers = nvidia_get_gpus_used_by_containers(docker)
+        return [], []
+
+    gpu_stats, gpus_used_by_containers = \
+        nvidia_get_gpu_state(docker, nvidia_smi)
+    # GPUs reserved by concurrent runs that haven't started their containers
+    add_reservations_to_gpus_used(gpus_used_by_containers)
     gpus_used_by_own_containers = [
         gpu for gpu, info in gpus_used_by_containers.items()
         if any(i[3] == uid for i in info)
     ]
 
-    # get available gpus asc by mem used and reservation counts
+    # get available gpus asc by mem used, utilization and reservation counts
     mem_limit = NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED
-    mem_res_gpu = [
-        (m, len(gpus_used_by_containers.get(gpu, [])), gpu)
-        for gpu, m in gpu_mem_used.items()
+    util_limit = NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION
+    mem_util_res_gpu = [
+        (m, u, len(gpus_used_by_containers.get(gpu, [])), gpu)
+        for gpu, (m, u) in gpu_stats.items()
     ]
     available_gpus = [
-        g for m, r, g in sorted(mem_res_gpu) if mem_limit < 0 or m <= mem_limit
+        g for m, u, r, g in sorted(mem_util_res_gpu)
+        if (mem_limit < 0 or m <= mem_limit)
+        and (util_limit < 0 or u <= util_limit)
     ]
     if NV_ALLOWED_GPUS != 'ALL':
         available_gpus = [g for g in available_gpus if g in NV_ALLOWED_GPUS]
     logger.debug(
-        'available GPUs after mem and allowance filtering: %r', available_gpus)
+        'available GPUs after mem, utilization and allowance filtering: %r',
+        available_gpus)
 
     if NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION:
         available_gpus = [
@@ -104,3 +160,28 @@ def nvidia_get_available_gpus(docker, nvidia_smi=NVIDIA_SMI):
         ]
 
     return available_gpus, gpus_used_by_own_containers
+
+
+def nvidia_select_gpus(available_gpus, count, nvidia_smi=NVIDIA_SMI):
+    """Selects count of the available_gpus (ordered by preference).
+
+    The GPUs are placed by NV_PLACEMENT_POLICY (see placement.py).
+    """
+    policy = placement_policy()
+    if policy == 'default' or (policy == 'topology' and count <= 1):
+        return available_gpus[:count]
+    try:
+        topology = gpu_topology(nvidia_smi)
+    except (UserDockerException, OSError, ValueError, SystemExit) as e:
+        # exec_cmd exits if nvidia-smi topo -m fails
+        logger.warning('GPU topology unavailable, ignoring it: %r', e)
+        return available_gpus[:count]
+    # GPUs of the node users may use, the unavailable ones count as occupied
+    node_gpus = set(topology) | set(available_gpus)
+    if NV_ALLOWED_GPUS != 'ALL':
+        node_gpus &= set(NV_ALLOWED_GPUS)
+    gpus = place_gpus(policy, available_gpus, count, topology, node_gpus)
+    logger.debug(
+        '%s placement of %d of GPUs %r: %r', policy, count, available_gpus,
+        gpus)
+    return gpus
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Per slurm job pinning of image references to digests (SLURM_PIN_IMAGE_DIGEST).
+
+If a tag moves while the tasks of a job start, they could run different
+images. The task with SLURM_PROCID 0 resolves the image reference to its
+digest (repo@sha256:..., the image ID for images without one) and publishes
+it in a job scoped file in SLURM_PIN_DIR, which should be shared by all nodes
+(e.g., on NFS). All other tasks wait for the published digest (pulling it if
+their node lacks it) instead of resolving the reference themselves.
+
+Without SLURM_PIN_DIR the pins are node local (RUNTIME_DIR) and the first task
+of a job on each node resolves the reference, so nodes can only disagree if
+the tag moves while the job starts.
+
+Pin and lock files which weren't used for SLURM_PIN_MAX_AGE are pruned
+whenever a new pin is published.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+
+from ..config import RUNTIME_DIR
+from ..config import SLURM_PIN_DIR
+from ..config import SLURM_PIN_MAX_AGE
+from ..config import SLURM_PIN_TIMEOUT
+from ..config import uid
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .dockerapi import image_digest
+from .logger import logger
+
+
+JOBS_DIR = RUNTIME_DIR + 'jobs/'
+PINS_DIR = SLURM_PIN_DIR or JOBS_DIR
+
+# poll interval while waiting for the digest published by SLURM_PROCID 0
+PIN_POLL_INTERVAL = 0.5
+
+
+def _job_prefix(jobid):
+    return 'slurm_%s' % re.sub(r'[^\w.-]', '_', jobid)
+
+
+def _lock_fn(jobid):
+    return JOBS_DIR + _job_prefix(jobid) + '.lock'
+
+
+def _pin_fn(jobid, image):
+    # one file per image: no read-modify-write of a file shared between nodes
+    h = hashlib.sha1(image.encode()).hexdigest()[:16]
+    return PINS_DIR + '%s_image_%s.json' % (_job_prefix(jobid), h)
+
+
+def _touch(fn):
+    """Marks fn as used (pruning is by age of last use)."""
+    try:
+        os.utime(fn)
+    except OSError:
+        pass
+
+
+@contextmanager
+def job_lock(jobid):
+    """Node local lock of a slurm job (serializes its tasks)."""
+    fn = _lock_fn(jobid)
+    try:
+        os.makedirs(JOBS_DIR, mode=0o755, exist_ok=True)
+        fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        logger.warning('job lock unavailable: %s', e)
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        _touch(fn)
+        yield
+    finally:
+        os.close(fd)
+
+
+def load_pin(jobid, image):
+    """Returns the pin of image published for jobid (by our uid) or None."""
+    fn = _pin_fn(jobid, image)
+    try:
+        if not is_trusted(fn):
+            return None
+        with open(fn) as f:
+            pin = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if pin.get('uid') != uid or pin.get('image') != image:
+        # slurm reused the job ID
+        return None
+    _touch(fn)
+    return pin.get('pinned')
+
+
+def save_pin(jobid, image, pinned):
+    try:
+        write_atomic(_pin_fn(jobid, image), json.dumps({
+            'uid': uid,
+            'time': time.time(),
+            'image': image,
+            'pinned': pinned,
+        }).encode())
+    except OSError as e:
+        logger.warning('could not publish image pin of job %s: %s', jobid, e)
+
+
+def prune_pins(max_age=None):
+    """Removes pin and lock files not used for max_age seconds.
+
+    max_age defaults to SLURM_PIN_MAX_AGE.
+    """
+    if max_age is None:
+        max_age = SLURM_PIN_MAX_AGE
+    limit = time.time() - max_age
+    for d in sorted({JOBS_DIR, PINS_DIR}):
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            if not name.startswith('slurm_'):
+                continue
+            fn = os.path.join(d, name)
+            try:
+                if os.lstat(fn).st_mtime < limit:
+                    os.unlink(fn)
+                    logger.debug('pruned stale job file %s', fn)
+            except OSError:
+                pass
+
+
+def resolve_image(docker, image):
+    """Returns the digest reference (or ID) of a local image or None."""
+    digest = image_digest(docker, image)
+    if digest is None:
+        return None
+    image_id, repo_digest = digest
+    return repo_digest or image_id
+
+
+def wait_for_pin(jobid, image, timeout=None):
+    """Waits up to timeout (SLURM_PIN_TIMEOUT) seconds for the pin published
+    by SLURM_PROCID 0, returns None if there is none.
+    """
+    if timeout is None:
+        timeout = SLURM_PIN_TIMEOUT
+    deadline = time.monotonic() + timeout
+    while True:
+        pinned = load_pin(jobid, image)
+        if pinned is not None or time.monotonic() >= deadline:
+            return pinned
+        time.sleep(PIN_POLL_INTERVAL)
+
+
+def _resolve(docker, image, pull):
+    pinned = resolve_image(docker, image)
+    if pinned is None and pull is not None:
+        pull(image)
+        pinned = resolve_image(docker, image)
+    if pinned is None:
+        logger.warning(
+            'could not resolve digest of %s, not pinning it', image)
+    return pinned
+
+
+def _resolve_and_publish(docker, jobid, image, pull):
+    pinned = _resolve(docker, image, pull)
+    if pinned is None:
+        return image
+    save_pin(jobid, image, pinned)
+    prune_pins()
+    logger.info('pinned image %s to %s for job %s', image, pinned, jobid)
+    return pinned
+
+
+def _use_pin(docker, image, pinned, pull):
+    """Returns pinned if it's available locally (after pulling it)."""
+    if resolve_image(docker, pinned) is None and pull is not None \
+            and '@' in pinned:
+        pull(pinned)
+    if resolve_image(docker, pinned) is None:
+        logger.warning(
+            'pinned image %s of %s not available, not pinning it',
+            pinned, image)
+        return image
+    return pinned
+
+
+def pin_job_image(docker, jobid, image, pull=None, procid=None):
+    """Returns image pinned to the digest resolved once for jobid.
+
+    With a shared SLURM_PIN_DIR procid 0 resolves and publishes the digest,
+    the other tasks wait for it. Otherwise (or if procid is None), the first
+    task on each node resolves it. If an image isn't available locally,
+    pull(image) is called (if given). Returns image itself if it can't be
+    resolved.
+    """
+    resolver = not SLURM_PIN_DIR or procid is None or procid == '0'
+    with job_lock(jobid):
+        pinned = load_pin(jobid, image)
+        if pinned is None and resolver:
+            return _resolve_and_publish(docker, jobid, image, pull)
+    if pinned is None:
+        pinned = wait_for_pin(jobid, image)
+        if pinned is None:
+            logger.warning(
+                'no image pin of %s published for job %s within %ds, '
+                'resolving it on this node', image, jobid, SLURM_PIN_TIMEOUT)
+            return _resolve(docker, image, pull) or image
+    logger.debug('image %s pinned to %s by job %s', image, pinned, jobid)
+    return _use_pin(docker, image, pinned, pull)
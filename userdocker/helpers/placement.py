@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+GPU placement policies (see NV_PLACEMENT_POLICY in config).
+
+A policy selects count of the free GPUs (ordered by preference, see
+nvidia_get_available_gpus). pack, spread and best_fit place containers into
+domains: groups of GPUs connected without crossing CPU sockets (links better
+than SYS in nvidia-smi topo -m), in which multi GPU containers run well.
+- default: the first free GPUs (least memory used, utilization, reservations)
+- topology: the best connected free GPUs (see topology.py)
+- pack: the most occupied domain with enough free GPUs, keeping emptier
+  domains free for large containers. Otherwise fills up the most occupied
+  domains first.
+- spread: the least occupied domain with enough free GPUs (spreads load over
+  sockets). Otherwise takes from the domains with most free GPUs first.
+- best_fit: the domain with the fewest free GPUs that are still enough.
+  Otherwise takes from the domains with most free GPUs first (spanning the
+  fewest domains).
+Within a domain, the best connected GPUs are selected.
+"""
+
+from ..config import NV_PLACEMENT_POLICY
+from ..config import NV_TOPOLOGY_AWARE_SELECTION
+from .exceptions import UserDockerException
+from .topology import LINK_SCORES
+from .topology import link_score
+from .topology import select_best_connected
+
+
+def placement_policy():
+    """Returns the configured policy (None: as NV_TOPOLOGY_AWARE_SELECTION)."""
+    if NV_PLACEMENT_POLICY is None:
+        return 'topology' if NV_TOPOLOGY_AWARE_SELECTION else 'default'
+    if NV_PLACEMENT_POLICY not in PLACEMENT_POLICIES:
+        raise UserDockerException(
+            "ERROR: NV_PLACEMENT_POLICY config variable not expected range, "
+            "contact admin"
+        )
+    return NV_PLACEMENT_POLICY
+
+
+def gpu_domains(gpus, topology):
+    """Returns the domains of gpus as sorted lists (see module docstring).
+
+    GPUs missing in topology are domains of their own.
+    """
+    gpus = set(gpus)
+    domains = []
+    seen = set()
+    for gpu in sorted(gpus):
+        if gpu in seen:
+            continue
+        seen.add(gpu)
+        domain, stack = [], [gpu]
+        while stack:
+            g = stack.pop()
+            domain.append(g)
+            for other, link in topology.get(g, {}).items():
+                if other in gpus and other not in seen \
+                        and link_score(link) > LINK_SCORES['SYS']:
+                    seen.add(other)
+                    stack.append(other)
+        domains.append(sorted(domain))
+    return domains
+
+
+def _place_in_domains(free, count, domains, topology, fit_key, fill_key):
+    """Selects count GPUs of the domain with minimal fit_key(domain, free
+    GPUs of domain) that has enough free GPUs. If there's none, takes the free
+    GPUs of the domains in order of fill_key."""
+    rank = {g: i for i, g in enumerate(free)}
+    candidates = []
+    for domain in domains:
+        domain_free = sorted((g for g in domain if g in rank), key=rank.get)
+        if domain_free:
+            candidates.append((domain, domain_free))
+
+    def key(key_func):
+        return lambda c: (key_func(*c), rank[c[1][0]])
+
+    fitting = [c for c in candidates if len(c[1]) >= count]
+    if fitting:
+        _, domain_free = min(fitting, key=key(fit_key))
+        return select_best_connected(domain_free, count, topology)
+    gpus = []
+    for _, domain_free in sorted(candidates, key=key(fill_key)):
+        gpus.extend(domain_free)
+    return sorted(gpus[:count], key=rank.get)
+
+
+def _occupancy(domain, domain_free):
+    return 1 - len(domain_free) / len(domain)
+
+
+def place_default(free, count, domains, topology):
+    return free[:count]
+
+
+def place_topology(free, count, domains, topology):
+    return select_best_connected(free, count, topology)
+
+
+def place_pack(free, count, domains, topology):
+    return _place_in_domains(
+        free, count, domains, topology,
+        fit_key=lambda d, f: -_occupancy(d, f),
+        fill_key=lambda d, f: -_occupancy(d, f),
+    )
+
+
+def place_spread(free, count, domains, topology):
+    return _place_in_domains(
+        free, count, domains, topology,
+        fit_key=lambda d, f: (_occupancy(d, f), -len(f)),
+        fill_key=lambda d, f: -len(f),
+    )
+
+
+def place_best_fit(free, count, domains, topology):
+    return _place_in_domains(
+        free, count, domains, topology,
+        fit_key=lambda d, f: len(f),
+        fill_key=lambda d, f: -len(f),
+    )
+
+
+PLACEMENT_POLICIES = {
+    'default': place_default,
+    'topology': place_topology,
+    'pack': place_pack,
+    'spread': place_spread,
+    'best_fit': place_best_fit,
+}
+
+
+def place_gpus(policy, free, count, topology, gpus=None):
+    """Returns count of the free GPUs (fewer if not enough) by policy.
+
+    gpus are all GPUs of the node (default: the ones in topology and free),
+    the ones not free count as occupied.
+    """
+    if gpus is None:
+        gpus = set(topology) | set(free)
+    domains = gpu_domains(gpus, topology)
+    return PLACEMENT_POLICIES[policy](list(free), count, domains, topology)
+
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Authorization policy of run, compiled once from config.
+
+ALLOWED_IMAGE_REGEXPS and ALLOWED_PORT_MAPPINGS are indexed by their literal
+prefixes, the candidates for a string are combined into a single compiled
+regexp (falling back to a list of compiled regexps if they can't be combined,
+e.g., due to backreferences). Allowed mounts are kept in sets for
+literal matches and in a path trie for prefix grants (host paths ending in
+'/*', see VOLUME_MOUNTS_AVAILABLE in config), so checks don't depend on the
+number of configured patterns / mounts.
+"""
+
+import os
+import re
+import stat
+
+from ..config import ALLOWED_IMAGE_REGEXPS
+from ..config import ALLOWED_PORT_MAPPINGS
+from ..config import VOLUME_MOUNTS_ALWAYS
+from ..config import VOLUME_MOUNTS_AVAILABLE
+from ..config import VOLUME_MOUNTS_DEFAULT
+from ..config import gid
+from ..config import gids
+from ..config import uid
+from .exceptions import UserDockerException
+from .logger import logger
+
+
+PREFIX_GRANT = '/*'
+# constructs looking ahead (end anchors, word boundaries, lookarounds, inline
+# flags, conditionals), so a regexp matching a prefix might not match all
+# strings starting with it
+LOOKAHEAD_CONSTRUCTS = re.compile(r'\$|\\[ZbB]|\(\?[^:P]')
+
+
+def literal_prefix(regexp):
+    """Returns a literal prefix all strings matched by regexp start with."""
+    if '|' in regexp:
+        return ''
+    prefix = []
+    i = 1 if regexp.startswith('^') else 0
+    while i < len(regexp):
+        c = regexp[i]
+        if c == '\\':
+            if i + 1 >= len(regexp) or regexp[i + 1].isalnum():
+                break  # \d, \w, \A, ...
+            c = regexp[i + 1]
+            i += 1
+        elif c in '.^$*+?{}[]()':
+            break
+        if i + 1 < len(regexp) and regexp[i + 1] in '*?{':
+            break  # optional
+        prefix.append(c)
+        i += 1
+    return ''.join(prefix)
+
+
+def combine_regexps(regexps):
+    """Returns a compiled regexp matching if any of regexps matches (re.match)
+    or a list of compiled regexps if they can't be combined."""
+    # group numbers (backreferences) and flags change when combined
+    if not any(re.search(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)', r)
+               for r in regexps):
+        try:
+            return re.compile('|'.join('(?:%s)' % r for r in regexps))
+        except re.error as e:
+            logger.debug('could not combine regexps: %s', e)
+    return [re.compile(r) for r in regexps]
+
+
+class RegexpSet:
+    """Matches (re.match) if any of regexps matches.
+
+    Compiling 1000s of regexps takes long, so they're indexed by literal
+    prefix and only the candidates for a string are compiled (combined).
+    """
+
+    def __init__(self, regexps):
+        self.regexps = list(regexps)
+        self._by_prefix = {}
+        for i, r in enumerate(self.regexps):
+            self._by_prefix.setdefault(literal_prefix(r), []).append(i)
+        self._prefix_lengths = sorted(set(len(p) for p in self._by_prefix))
+        self._compiled = {}
+
+    def __bool__(self):
+        return bool(self.regexps)
+
+    def candidates(self, s):
+        return tuple(sorted(
+            i for n in self._prefix_lengths
+            for i in self._by_prefix.get(s[:n], ())
+        ))
+
+    def match(self, s):
+        candidates = self.candidates(s)
+        if not candidates:
+            return False
+        if candidates not in self._compiled:
+            self._compiled[candidates] = combine_regexps(
+                [self.regexps[i] for i in candidates])
+        compiled = self._compiled[candidates]
+        if isinstance(compiled, list):
+            return any(r.match(s) for r in compiled)
+        return compiled.match(s) is not None
+
+
+def split_mount(mount):
+    """Returns (host_path, container_path, flags) of a -v mount string."""
+    parts = mount.split(':')
+    return (parts + ['', ''])[:3] if len(parts) <= 3 else (None, None, None)
+
+
+def _writable_by(st, owner, owner_gids):
+    """Returns if owner (with groups owner_gids) owns or may write st.
+
+    Sticky dirs (e.g., /tmp) don't count as writable: their entries can only
+    be replaced by their owners.
+    """
+    if st.st_uid == owner:
+        return True
+    if st.st_mode & stat.S_ISVTX and stat.S_ISDIR(st.st_mode):
+        return False
+    return bool(
+        st.st_mode & stat.S_IWOTH
+        or (st.st_mode & stat.S_IWGRP and st.st_gid in owner_gids)
+    )
+
+
+def resolve_untrusted_path(path, owner, owner_gids=()):
+    """Returns the normalized absolute path if it's safe to mount for owner.
+
+    docker only mounts the path after the checks, so owner must not be able to
+    replace any of its components meanwhile (e.g., with a symlink to /etc).
+    Paths with .. or symlink components, missing components or components
+    owned or writable by owner are hence rejected (UserDockerException).
+    """
+    parts = [p for p in path.split('/') if p not in ('', '.')]
+    if not path.startswith('/') or '..' in parts:
+        raise UserDockerException(
+            "ERROR: mount path %s must be absolute without .." % path)
+    resolved = ''
+    for part in parts:
+        resolved += '/' + part
+        try:
+            st = os.lstat(resolved)
+        except OSError as e:
+            raise UserDockerException(
+                "ERROR: mount path %s: can't access %s: %s" % (
+                    path, resolved, e.strerror))
+        if stat.S_ISLNK(st.st_mode):
+            raise UserDockerException(
+                "ERROR: mount path %s contains symlink %s, use the path it "
+                "points to" % (path, resolved))
+        if _writable_by(st, owner, owner_gids):
+            raise UserDockerException(
+                "ERROR: mount path %s contains %s, which you own or may "
+                "write to (could be replaced before it's mounted)" % (
+                    path, resolved))
+    return resolved or '/'
+
+
+class MountTrie:
+    """Path trie of prefix grants: host paths and all their sub-directories."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, host_prefix, container_prefix, flags):
+        node = self._root
+        for part in host_prefix.strip('/').split('/'):
+            if part:
+                node = node.setdefault(part, {})
+        node.setdefault(None, []).append((container_prefix, flags))
+
+    def lookup(self, host_path):
+        """Returns [(relative path, container_prefix, flags), ...] of the
+        deepest grants covering host_path (more specific grants override)."""
+        parts = [p for p in host_path.strip('/').split('/') if p]
+        node = self._root
+        found = []
+        for i in range(len(parts) + 1):
+            if None in node:
+                found = [('/'.join(parts[i:]),) + g for g in node[None]]
+            if i == len(parts) or parts[i] not in node:
+                break
+            node = node[parts[i]]
+        return found
+
+
+class Policy:
+    """Checks images, port mappings and mounts of run against the config."""
+
+    def __init__(
+            self,
+            image_regexps=ALLOWED_IMAGE_REGEXPS,
+            port_mappings=ALLOWED_PORT_MAPPINGS,
+            mounts_always=VOLUME_MOUNTS_ALWAYS,
+            mounts_default=VOLUME_MOUNTS_DEFAULT,
+            mounts_available=VOLUME_MOUNTS_AVAILABLE,
+    ):
+        self.images = RegexpSet(image_regexps)
+        self.port_mappings = RegexpSet(port_mappings)
+        self.mounts_always = list(mounts_always)
+        self.mounts_default = list(mounts_default)
+        self._mounts_available = set(mounts_always + mounts_default)
+        self._prefix_grants = MountTrie()
+        for mount in mounts_available:
+            host_path, container_path, flags = split_mount(mount)
+            if host_path and host_path.endswith(PREFIX_GRANT):
+                if container_path and not container_path.endswith(
+                        PREFIX_GRANT):
+                    raise UserDockerException(
+                        "ERROR: container path of prefix mount %s must be "
+                        "empty or end in %s, contact admin" % (
+                            mount, PREFIX_GRANT)
+                    )
+                self._prefix_grants.add(
+                    os.path.normpath(host_path[:-len(PREFIX_GRANT)]),
+                    container_path[:-len(PREFIX_GRANT)] or None,
+                    flags,
+                )
+            else:
+                self._mounts_available.add(mount)
+
+    def authorize_image(self, image):
+        """Returns image (with :latest if no tag / digest) if allowed."""
+        if ":" not in image and "@" not in image:
+            # user didn't explicitly set a tag or digest, append ":latest"
+            image += ":latest"
+        if self.images and not self.images.match(image):
+            raise UserDockerException(
+                "ERROR: image %s not in allowed image regexps: %s" % (
+                    image, self.images.regexps))
+        return image
+
+    def authorize_all_tags(self, repo):
+        """Returns repo if allowed with any tag (for pull --all-tags).
+
+        That's the case if an allowed regexp matches "repo:" and doesn't look
+        ahead (re.match then matches any tag appended).
+        """
+        if not self.images or any(
+                not LOOKAHEAD_CONSTRUCTS.search(r) and re.match(r, repo + ':')
+                for r in self.images.regexps):
+            return repo
+        raise UserDockerException(
+            "ERROR: allowed image regexps restrict the tags of %s, pull "
+            "allowed tags one by one instead of all tags: %s" % (
+                repo, self.images.regexps))
+
+    def authorize_port_mappings(self, port_mappings):
+        for pm in port_mappings:
+            if not self.port_mappings.match(pm):
+                raise UserDockerException(
+                    "ERROR: given port mapping not allowed: %s" % pm
+                )
+        return list(port_mappings)
+
+    def _prefix_granted_mount(self, user_mount):
+        host_path, container_path, flags = split_mount(user_mount)
+        if not host_path or not host_path.startswith('/') \
+                or not self._prefix_grants.lookup(host_path):
+            return None
+        # checked strictly, so the path can't change before it's mounted
+        real_path = resolve_untrusted_path(host_path, uid, [gid] + gids)
+        for rel_path, container_prefix, grant_flags in \
+                self._prefix_grants.lookup(real_path):
+            target = container_path or real_path
+            if container_prefix is not None:
+                # sub-directory at the same relative container path
+                target = os.path.join(container_prefix, rel_path).rstrip('/')
+                if container_path and container_path != target:
+                    continue
+            if grant_flags and flags not in ('', grant_flags):
+                continue
+            if not grant_flags and flags not in ('', 'ro'):
+                continue
+            mount = '%s:%s' % (real_path, target)
+            if flags or grant_flags:
+                mount += ':' + (flags or grant_flags)
+            return mount
+        return None
+
+    def authorize_mounts(self, user_mounts, default_mounts=True):
+        """Returns the mounts to use (admin enforced, default and user ones)."""
+        mounts = list(self.mounts_always)
+        if default_mounts:
+            mounts += self.mounts_default
+
+        for user_mount in user_mounts:
+            if user_mount in mounts:
+                continue
+            if user_mount in self._mounts_available:
+                mounts.append(user_mount)
+                continue
+
+            host_path, container_path, flag = split_mount(user_mount)
+            # literal matches didn't work, check if the user appended 'ro'
+            if flag == 'ro':
+                st = ':'.join([host_path, container_path])
+                if st in mounts:
+                    # upgrade mount to include ro flag
+                    mounts[mounts.index(st)] = user_mount
+                    continue
+                if st in self._mounts_available:
+                    mounts.append(user_mount)
+                    continue
+
+            # allow potential unspecified container_path mounts
+            if host_path is not None \
+                    and host_path + ':' in self._mounts_available:
+                mounts.append(user_mount)
+                continue
+
+            mount = self._prefix_granted_mount(user_mount)
+            if mount:
+                mounts.append(mount)
+                continue
+
+            raise UserDockerException(
+                "ERROR: given mount not allowed: %s" % user_mount
+            )
+        return mounts
+
+    def authorize_run(self, args):
+        """Returns (image, port_mappings, mounts) authorized for run args."""
+        return (
+            self.authorize_image(args.image),
+            self.authorize_port_mappings(getattr(args, 'port_mappings', [])),
+            self.authorize_mounts(
+                getattr(args, 'volumes', []), not args.no_default_mounts),
+        )
+
+
+_policy = None
+
+
+def policy():
+    """Returns the Policy of the loaded config (built once)."""
+    global _policy
+    if _policy is None:
+        _policy = Policy()
+    return _policy
+
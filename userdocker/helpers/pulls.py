@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Node wide single-flight image pulls.
+
+Concurrent pulls of the same image reference (e.g., all tasks of a slurm job
+with RUN_PULL = 'always', or several users pulling the same base image) are
+coalesced: the first one pulls under a per reference lock in RUNTIME_DIR, the
+others wait for it (at most PULL_LOCK_TIMEOUT seconds). Successful pulls are
+recorded (time and digest): a waiter skips its pull if a pull of the same
+reference finished after it was requested, implicit pulls (run) also if one
+finished within PULL_FRESHNESS seconds.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from ..config import PULL_CONCURRENCY
+from ..config import PULL_LOCK_TIMEOUT
+from ..config import RUNTIME_DIR
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .dockerapi import image_digest
+from .dockerapi import image_repo
+from .exceptions import UserDockerException
+from .execute import exec_cmd
+from .execute import exec_cmd_output_lines
+from .logger import logger
+
+
+PULLS_DIR = RUNTIME_DIR + 'pulls/'
+
+# poll interval while waiting for the pull lock (flock can't time out and
+# SIGALRM is main thread only, but pull_images pulls in threads)
+PULL_LOCK_POLL_INTERVAL = 0.5
+
+
+def pull_key(image, pull_args=()):
+    """Returns the key identifying a pull of image with pull_args."""
+    if '@' not in image and image_repo(image) == image:
+        # docker pulls :latest if no tag / digest is given
+        image += ':latest'
+    return ' '.join(list(pull_args) + [image])
+
+
+def _pull_fn(key, ext):
+    return PULLS_DIR + hashlib.sha256(key.encode()).hexdigest()[:32] + ext
+
+
+@contextmanager
+def pull_lock(key, timeout=None):
+    """Node local lock for pull key (waits for concurrent pulls).
+
+    Waits at most timeout (PULL_LOCK_TIMEOUT) seconds for the lock, then
+    proceeds without it (a hung pull mustn't block all others).
+    """
+    if timeout is None:
+        timeout = PULL_LOCK_TIMEOUT
+    try:
+        os.makedirs(PULLS_DIR, mode=0o755, exist_ok=True)
+        fd = os.open(_pull_fn(key, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        logger.warning('pull lock unavailable: %s', e)
+        yield
+        return
+    try:
+        deadline = time.monotonic() + timeout
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.monotonic() >= deadline:
+                logger.warning(
+                    'concurrent pull of %s takes longer than %ds, pulling '
+                    'anyway', key, timeout)
+                break
+            if not waiting:
+                logger.info('waiting for concurrent pull of %s', key)
+                waiting = True
+            time.sleep(PULL_LOCK_POLL_INTERVAL)
+        yield
+    finally:
+        os.close(fd)
+
+
+def last_pull(key):
+    """Returns the record of the last successful pull of key or None."""
+    fn = _pull_fn(key, '.json')
+    try:
+        if not is_trusted(fn):
+            return None
+        with open(fn) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return record if record.get('key') == key else None
+
+
+def _record_pull(docker, image, key):
+    digest = image_digest(docker, image)
+    record = {
+        'key': key,
+        'time': time.time(),
+        'id': digest[0] if digest else None,
+        'digest': digest[1] if digest else None,
+    }
+    try:
+        write_atomic(_pull_fn(key, '.json'), json.dumps(record).encode())
+    except OSError as e:
+        logger.debug('could not record pull of %s: %s', key, e)
+
+
+def _run_pull(cmd, loglvl, output):
+    if output is None:
+        return exec_cmd(cmd, loglvl=loglvl)
+    # no tty: docker pull prints one line per layer status change
+    return exec_cmd_output_lines(cmd, output, loglvl=loglvl)
+
+
+def pull_image(docker, image, pull_args=(), dry_run=False,
+               loglvl=logging.INFO, output=None, max_age=0):
+    """Pulls image (single-flight).
+
+    The pull is skipped if a concurrent pull of image finished while waiting
+    for it or if image was pulled less than max_age seconds ago (for implicit
+    pulls, see PULL_FRESHNESS).
+
+    pull_args are further args of docker pull. Exits with docker pull's return
+    code if it fails (see exec_cmd), unless output is given: then docker pull's
+    output lines are passed to output(line) and its return code is returned.
+    """
+    cmd = [docker, 'pull'] + list(pull_args) + ['--', image]
+    if dry_run:
+        return exec_cmd(cmd, dry_run=True, loglvl=loglvl)
+    key = pull_key(image, pull_args)
+    requested = time.time()
+    with pull_lock(key):
+        record = last_pull(key)
+        if record:
+            age = time.time() - record['time']
+            if record['time'] >= requested or 0 <= age < max_age:
+                logger.log(
+                    loglvl, 'pulled %s (%s) %.0fs ago, not pulling again',
+                    key, record['digest'] or record['id'], age)
+                return 0
+        ret = _run_pull(cmd, loglvl, output)
+        if ret == 0:
+            _record_pull(docker, image, key)
+        return ret
+
+
+def pull_images(docker, images, pull_args=(), dry_run=False,
+                concurrency=PULL_CONCURRENCY):
+    """Pulls images with up to concurrency pulls at a time.
+
+    Output lines of each pull are prefixed with its image. Returns
+    {image: return code of its pull}.
+    """
+    images = list(dict.fromkeys(images))
+    width = max(len(image) for image in images)
+    print_lock = threading.Lock()
+
+    def pull(image):
+        def output(line):
+            with print_lock:
+                print('%-*s | %s' % (width, image, line), flush=True)
+        try:
+            return pull_image(docker, image, pull_args, dry_run,
+                              output=output)
+        except (UserDockerException, OSError) as e:
+            output('ERROR: %s' % e)
+            return 1
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return dict(zip(images, executor.map(pull, images)))
+
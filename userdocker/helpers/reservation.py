@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Node local GPU reservation ledger.
+
+Between selecting GPUs and the container showing up in docker ps, concurrent
+runs (e.g., slurm tasks started at the same time) would see the same GPUs as
+available. GPU selection and reservation hence happen under a node local lock
+(gpu_reservation_lock) and reservations are recorded in a ledger that is
+considered as long as one of the reserving processes is alive (with exec, that
+is the docker client of the container) or NV_RESERVATION_TIMEOUT is reached.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import time
+
+from ..config import NV_RESERVATION_TIMEOUT
+from ..config import RUNTIME_DIR
+from ..config import uid
+from ..config import user_name
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .logger import logger
+
+
+LEDGER_FN = RUNTIME_DIR + 'gpu_reservations.json'
+LOCK_FN = RUNTIME_DIR + 'gpu_reservations.lock'
+
+
+@contextmanager
+def gpu_reservation_lock():
+    """Node local lock to make GPU selection and reservation atomic."""
+    try:
+        os.makedirs(RUNTIME_DIR, mode=0o755, exist_ok=True)
+        fd = os.open(LOCK_FN, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        logger.warning('GPU reservation lock unavailable: %s', e)
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _is_live(reservation, now):
+    return (
+        0 <= now - reservation['time'] < NV_RESERVATION_TIMEOUT
+        and any(_pid_alive(pid) for pid in reservation['pids'])
+    )
+
+
+def load_reservations():
+    """Returns the live reservations of the ledger."""
+    try:
+        if not is_trusted(LEDGER_FN):
+            logger.warning('ignoring untrusted GPU reservations %s', LEDGER_FN)
+            return []
+        with open(LEDGER_FN) as f:
+            reservations = json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logger.warning('ignoring broken GPU reservations: %s', e)
+        return []
+    now = time.time()
+    return [r for r in reservations if _is_live(r, now)]
+
+
+def reserved_gpus(key):
+    """Returns the GPUs of the live reservation with key or None."""
+    for r in load_reservations():
+        if r['key'] == key:
+            return r['gpus']
+    return None
+
+
+def reserve_gpus(key, gpus, name_prefix):
+    """Records a reservation of gpus for containers starting with name_prefix.
+
+    Must be called with gpu_reservation_lock held. If a live reservation with
+    key already exists (e.g., for a slurm job), the current process is added to
+    it. Stale reservations are pruned.
+    """
+    reservations = load_reservations()
+    for r in reservations:
+        if r['key'] == key:
+            r['pids'].append(os.getpid())
+            r['time'] = time.time()
+            break
+    else:
+        reservations.append({
+            'key': key,
+            'gpus': gpus,
+            'name_prefix': name_prefix,
+            'user': user_name,
+            'uid': uid,
+            'pids': [os.getpid()],
+            'time': time.time(),
+        })
+    logger.debug('GPU reservations: %r', reservations)
+    try:
+        write_atomic(LEDGER_FN, json.dumps(reservations).encode())
+    except OSError as e:
+        logger.warning('could not record GPU reservation: %s', e)
+
+
+def add_reservations_to_gpus_used(gpus_used_by_containers):
+    """Adds pending reservations to gpus_used_by_containers (in place).
+
+    Reserved GPUs already used by one of the reservation's containers aren't
+    added twice.
+    """
+    for r in load_reservations():
+        for gpu in r['gpus']:
+            info = gpus_used_by_containers[gpu]
+            if any(i[1].lstrip('/').startswith(r['name_prefix'])
+                   for i in info):
+                continue
+            info.append(('', r['name_prefix'] + '*', r['user'], r['uid']))
+    return gpus_used_by_containers
+
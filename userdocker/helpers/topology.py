@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Topology aware selection of multiple GPUs.
+
+Multi GPU containers (e.g., NCCL all-reduce) are only as fast as the slowest
+link between their GPUs, so out of the available GPUs the best connected
+subset is selected: maximal weakest link, then maximal sum of all links, then
+the order of the available GPUs (memory used, reservations).
+
+The interconnect topology (see gpu_query.py) doesn't change while the node is
+up, so it's cached in RUNTIME_DIR.
+"""
+
+from itertools import combinations
+import json
+
+from ..config import NVIDIA_SMI
+from ..config import NV_GPU_QUERY_BACKEND
+from ..config import RUNTIME_DIR
+from ..config.cache import is_trusted
+from ..config.cache import write_atomic
+from .gpu_query import query_gpu_topology
+from .logger import logger
+
+
+GPU_TOPOLOGY_FN = RUNTIME_DIR + 'gpu_topology.json'
+
+# nvidia-smi topo -m links from worst to best, NV# is scored by its link count
+LINK_SCORES = {
+    'SYS': 1,
+    'SOC': 1,  # old name of SYS
+    'NODE': 2,
+    'PHB': 3,
+    'PXB': 4,
+    'PIX': 5,
+}
+NVLINK_SCORE = 10
+
+# above this number of candidate subsets, they're built greedily
+MAX_SUBSETS = 5000
+
+
+def link_score(link):
+    if link.startswith('NV'):
+        try:
+            return NVLINK_SCORE + int(link[2:])
+        except ValueError:
+            pass
+    return LINK_SCORES.get(link, 0)
+
+
+def cached_gpu_info(fn, query, nvidia_smi=NVIDIA_SMI):
+    """Returns {gpu: info} from query(nvidia_smi), cached as json in fn.
+
+    Only for static info (cleared with RUNTIME_DIR on reboot). Not cached with
+    the fake backend.
+    """
+    if NV_GPU_QUERY_BACKEND == 'fake':
+        return query(nvidia_smi)
+    try:
+        if is_trusted(fn):
+            with open(fn) as f:
+                return {int(gpu): info for gpu, info in json.load(f).items()}
+    except (OSError, ValueError, AttributeError) as e:
+        logger.debug('ignoring cached GPU info %s: %s', fn, e)
+    gpu_info = query(nvidia_smi)
+    try:
+        write_atomic(fn, json.dumps(gpu_info).encode())
+    except OSError as e:
+        logger.debug('could not cache GPU info %s: %s', fn, e)
+    return gpu_info
+
+
+def gpu_topology(nvidia_smi=NVIDIA_SMI):
+    """Returns the (cached) topology {gpu: {other gpu: link}}."""
+    topology = cached_gpu_info(GPU_TOPOLOGY_FN, query_gpu_topology, nvidia_smi)
+    return {
+        gpu: {int(o): link for o, link in links.items()}
+        for gpu, links in topology.items()
+    }
+
+
+def _subset_key(subset, topology, rank):
+    scores = [
+        link_score(topology.get(a, {}).get(b, ''))
+        for a, b in combinations(subset, 2)
+    ]
+    return (
+        min(scores, default=0),
+        sum(scores),
+        -sum(rank[g] for g in subset),
+    )
+
+
+def _greedy_subsets(gpus, count, topology, rank):
+    """Yields one subset per GPU, grown by adding the best connected GPU."""
+    for start in gpus:
+        subset = [start]
+        while len(subset) < count:
+            subset.append(max(
+                (g for g in gpus if g not in subset),
+                key=lambda g: _subset_key(subset + [g], topology, rank),
+            ))
+        yield subset
+
+
+def select_best_connected(gpus, count, topology):
+    """Returns the best connected count GPUs of gpus (in order of gpus).
+
+    gpus should be in order of preference, e.g., as returned by
+    nvidia_get_available_gpus. GPUs missing in topology are regarded as
+    unconnected.
+    """
+    if count <= 1 or len(gpus) <= count:
+        return gpus[:count]
+    rank = {g: i for i, g in enumerate(gpus)}
+    n_subsets = 1
+    for i in range(count):
+        n_subsets = n_subsets * (len(gpus) - i) // (i + 1)
+    if n_subsets <= MAX_SUBSETS:
+        subsets = combinations(gpus, count)
+    else:
+        subsets = _greedy_subsets(gpus, count, topology, rank)
+    best = max(subsets, key=lambda s: _subset_key(s, topology, rank))
+    return sorted(best, key=rank.get)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Client for the optional node-local userdockerd daemon (see userdockerd.py).
+
+The protocol is a single json line request / response per connection via the
+root owned unix socket USERDOCKERD_SOCKET.
+"""
+
+import json
+import os
+import socket
+
+from ..config import USERDOCKERD_SOCKET
+from ..config.cache import is_trusted
+from .logger import logger
+
+
+DAEMON_TIMEOUT = 5
+
+
+class DaemonUnavailable(Exception):
+    """Raised if userdockerd can't be used (triggers local fallback)."""
+    pass
+
+
+def daemon_query(query, socket_path=USERDOCKERD_SOCKET, **params):
+    """Sends query with params to userdockerd and returns its result.
+
+    Raises DaemonUnavailable if the daemon isn't running or fails.
+    """
+    if not socket_path or not os.path.exists(socket_path):
+        raise DaemonUnavailable(socket_path)
+    if not is_trusted(socket_path):
+        logger.warning('ignoring untrusted userdockerd socket %s', socket_path)
+        raise DaemonUnavailable(socket_path)
+
+    request = dict(params, query=query)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DAEMON_TIMEOUT)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                response = json.loads(f.readline().decode())
+    except (OSError, ValueError) as e:
+        logger.debug('userdockerd unavailable, falling back: %s', e)
+        raise DaemonUnavailable(socket_path) from e
+    if 'error' in response:
+        logger.debug('userdockerd error, falling back: %s', response['error'])
+        raise DaemonUnavailable(response['error'])
+    logger.debug('userdockerd query %r answered', request)
+    return response['result']
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+"""
+Command line parser, only building the parser of the requested subcommand.
+"""
 
 import argparse
 import logging
@@ -13,10 +16,32 @@ from .config import LOGLVL
 from .helpers.parser import init_subcommand_parser
 
 # dispatch specific specific_parsers to those defined in subcommands package
-from .subcommands import specific_parsers
+from .subcommands import specific_parser
 
 
-def parse_args():
+def requested_subcommand(argv):
+    """Returns the (allowed) subcommand in argv, None if there is none.
+
+    Also returns None if help is requested before a subcommand.
+    """
+    argv = iter(argv)
+    for arg in argv:
+        if arg in ('-h', '--help'):
+            return None
+        if arg == '--executor':
+            # skip its value
+            next(argv, None)
+            continue
+        if arg.startswith('-'):
+            continue
+        return arg if arg in ALLOWED_SUBCOMMANDS else None
+    return None
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
     parser = argparse.ArgumentParser(
         description=__doc__.strip(),
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -63,13 +88,16 @@ def parse_args():
     subparsers = parser.add_subparsers(dest="subcommand")
     subparsers.required = True
 
-    for scmd in ALLOWED_SUBCOMMANDS:
-        specific_parser = specific_parsers.get(scmd)
-        if specific_parser:
-            specific_parser(subparsers)
+    # only build the parser of the requested subcommand, all for help / errors
+    requested = requested_subcommand(argv)
+    for scmd in [requested] if requested else ALLOWED_SUBCOMMANDS:
+        scmd_parser = specific_parser(scmd)
+        if scmd_parser:
+            scmd_parser(subparsers)
         else:
             init_subcommand_parser(subparsers, scmd)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args.executor_path = EXECUTORS[args.executor]
     return args
+
@@ -1,26 +1,43 @@
 # -*- coding: utf-8 -*-
+"""
+Registry of subcommands with specific parsers and / or executors.
 
-from .attach import *
-from .dockviz import *
-from .images import *
-from .ps import *
-from .pull import *
-from .run import *
-from .network import *
-from .version import *
+Subcommand modules are only imported on demand, so invoking one subcommand
+doesn't import the (potentially heavy) dependencies of all others.
+"""
 
-SPECIFIC_PARSER_PREFIX = 'parser_'
-specific_parsers = {
-    _var.split(SPECIFIC_PARSER_PREFIX)[1]: _val
-    for _var, _val in globals().items()
-    if _var.startswith(SPECIFIC_PARSER_PREFIX)
-}
+from importlib import import_module
+
+# modules in this package defining parser_<scmd> and / or exec_cmd_<scmd>
+SPECIFIC_SUBCOMMANDS = (
+    'attach',
+    'dockviz',
+    'images',
+    'load',
+    'network',
+    'ps',
+    'pull',
+    'run',
+    'version',
+)
 
+SPECIFIC_PARSER_PREFIX = 'parser_'
 SPECIFIC_CMD_EXECUTOR_PREFIX = 'exec_cmd_'
-specific_command_executors = {
-    _var.split(SPECIFIC_CMD_EXECUTOR_PREFIX)[1]: _val
-    for _var, _val in globals().items()
-    if _var.startswith(SPECIFIC_CMD_EXECUTOR_PREFIX)
-}
 
-__all__ = [specific_parsers, specific_command_executors]
+
+def _specific(scmd, prefix):
+    if scmd not in SPECIFIC_SUBCOMMANDS:
+        return None
+    module = import_module('.' + scmd, __name__)
+    return getattr(module, prefix + scmd, None)
+
+
+def specific_parser(scmd):
+    return _specific(scmd, SPECIFIC_PARSER_PREFIX)
+
+
+def specific_command_executor(scmd):
+    return _specific(scmd, SPECIFIC_CMD_EXECUTOR_PREFIX)
+
+
+__all__ = ['specific_parser', 'specific_command_executor']
@@ -1,13 +1,12 @@
 # -*- coding: utf-8 -*-
 
-import json
-import logging
-
 from ..config import uid
 from ..helpers.cmd import init_cmd
 from ..helpers.exceptions import UserDockerException
-from ..helpers.execute import exec_cmd
+from ..helpers.dockerapi import close_connections
+from ..helpers.dockerapi import container_inspect
 from ..helpers.execute import exit_exec_cmd
+from ..helpers.labels import container_owner
 from ..helpers.logger import logger
 from ..helpers.parser import init_subcommand_parser
 
@@ -36,29 +35,17 @@ def exec_cmd_attach(args):
     cmd += [container]
 
     # check if we're allowed to attach to container (if it's ours)
-    container_env = exec_cmd(
-        [
-            args.executor_path, 'inspect',
-            '--format', '{{json .Config.Env}}',
-            container
-        ],
-        return_status=False,
-        loglvl=logging.DEBUG,
-    )
-    if not container_env:
+    container_details = container_inspect(args.executor_path, container)
+    if not container_details:
         raise UserDockerException(
             'ERROR: could not find container %s' % container
         )
-    userdocker_uid_env = [
-        env for env in json.loads(container_env)
-        if env.startswith('USERDOCKER_UID')
-    ]
-    if not userdocker_uid_env:
+    _, userdocker_uid, _ = container_owner(container_details)
+    if userdocker_uid is None:
         raise UserDockerException(
-            'ERROR: could not find USERDOCKER_UID env var in container %s'
-            % container
+            'ERROR: could not find userdocker.uid label or USERDOCKER_UID env '
+            'var in container %s' % container
         )
-    userdocker_uid = int(userdocker_uid_env[0].split('USERDOCKER_UID=')[1])
     logger.debug(
         "Container %s was started by user id %d", container, userdocker_uid)
     if uid != userdocker_uid:
@@ -67,4 +54,5 @@ def exec_cmd_attach(args):
             'Permission denied!' % (container, userdocker_uid, uid)
         )
 
-    exit_exec_cmd(cmd, dry_run=args.dry_run)
+    close_connections()
+    exit_exec_cmd(cmd, dry_run=args.dry_run, replace_process=True)
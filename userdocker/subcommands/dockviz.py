@@ -1,13 +1,41 @@
 # -*- coding: utf-8 -*-
 
-from ..helpers.execute import exit_exec_cmd
+from ..helpers.exceptions import UserDockerException
+from ..helpers.image_tree import build_tree
+from ..helpers.image_tree import dumps_tree_json
+from ..helpers.image_tree import find_image
+from ..helpers.image_tree import list_images
+from ..helpers.image_tree import render_tree
+from ..helpers.parser import init_subcommand_parser
+
+
+def parser_dockviz(parser):
+    sub_parser = init_subcommand_parser(parser, 'dockviz')
+
+    sub_parser.add_argument(
+        "image",
+        help="only show the subtree of this image (tag or ID)",
+        nargs='?',
+    )
+    sub_parser.add_argument(
+        "--json",
+        help="print the tree as json",
+        action="store_true",
+    )
 
 
 def exec_cmd_dockviz(args):
-    # just run dockviz
-    cmd = [
-        args.executor_path, "run", "-it", "--rm",
-        "-v", "/var/run/docker.sock:/var/run/docker.sock",
-        "nate/dockviz", "images", "--tree"
-    ]
-    exit_exec_cmd(cmd, dry_run=args.dry_run)
+    # tree of images like dockviz images --tree (without running dockviz)
+    images = list_images(args.executor_path)
+    roots = build_tree(images)
+    if args.image:
+        image = find_image(images, args.image)
+        if image is None:
+            raise UserDockerException(
+                "ERROR: image %s not found locally" % args.image)
+        roots = [image]
+    if args.json:
+        print(dumps_tree_json(roots))
+    else:
+        for line in render_tree(roots):
+            print(line)
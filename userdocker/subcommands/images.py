@@ -20,4 +20,4 @@ def exec_cmd_images(args):
     if args.repo_tag:
         cmd.append("--")
         cmd.append(args.repo_tag)
-    exit_exec_cmd(cmd, dry_run=args.dry_run)
+    exit_exec_cmd(cmd, dry_run=args.dry_run, replace_process=True)
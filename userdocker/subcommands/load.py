@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+from ..helpers.cmd import init_cmd
+from ..helpers.exceptions import UserDockerException
+from ..helpers.execute import exec_cmd_input
+from ..helpers.execute import exit_exec_cmd
+from ..helpers.image_archive import validated_chunks
+from ..helpers.policy import policy
+
+
+def exec_cmd_load(args):
+    cmd = init_cmd(args)
+    if not policy().images:
+        # all images allowed, nothing to validate
+        exit_exec_cmd(cmd, dry_run=args.dry_run, replace_process=True)
+    if sys.stdin.isatty():
+        raise UserDockerException(
+            "ERROR: load reads an image archive from stdin, e.g.: "
+            "userdocker load < image.tar")
+    # the archive is validated while it's streamed to docker load
+    sys.exit(exec_cmd_input(
+        cmd, validated_chunks(sys.stdin.buffer), dry_run=args.dry_run))
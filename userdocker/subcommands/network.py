@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
 import argparse
 from functools import partial
-import json
 import sys
 
 from ..helpers.cmd import init_cmd
-from ..helpers.execute import exec_cmd
+from ..helpers.dockerapi import network_inspect
 from ..helpers.execute import exit_exec_cmd
 from ..helpers.parser import init_subcommand_parser
 from ..helpers.exceptions import UserDockerException
@@ -52,11 +51,7 @@ def parser_network(parser):
 
 
 def inspect_network(network):
-    cmd = [EXECUTORS["docker"], "network", "inspect", network]
-    jsontext = exec_cmd(cmd, return_status=False)
-    for details in json.loads(jsontext):
-        if details["Name"] == network:
-            return details
+    return network_inspect(EXECUTORS["docker"], network)
 
 
 def exec_cmd_network(args):
@@ -80,4 +75,4 @@ def exec_cmd_network(args):
               "USERDOCKER_NETWORK_SUBNET=%s" % subnet)
         sys.exit(0)
 
-    exit_exec_cmd(cmd, dry_run=args.dry_run)
+    exit_exec_cmd(cmd, dry_run=args.dry_run, replace_process=True)
@@ -1,15 +1,43 @@
 # -*- coding: utf-8 -*-
+import json
+import sys
+import time
+
+from ..config import uid
 from ..helpers.cmd import init_cmd
+from ..helpers.exceptions import UserDockerException
 from ..helpers.execute import exit_exec_cmd
+from ..helpers.labels import LABEL_UID
+from ..helpers.nvidia import GPUSnapshots
 from ..helpers.nvidia import nvidia_get_available_gpus
-from ..helpers.nvidia import nvidia_get_gpus_used_by_containers
 from ..helpers.parser import init_subcommand_parser
 
 
+# (key, tsv header) of --gpu-used and --gpu-status rows
+GPU_USED_COLUMNS = (
+    ('gpu', 'GPU'), ('container', 'Container'), ('name', 'ContainerName'),
+    ('user', 'User'),
+)
+GPU_STATUS_COLUMNS = (
+    ('gpu', 'GPU'), ('memory_used', 'MemoryUsedMiB'),
+    ('utilization', 'Utilization'), ('container', 'Container'),
+    ('name', 'ContainerName'), ('user', 'User'), ('uptime', 'Uptime'),
+)
+
+# watch mode prefixes of added / removed / changed rows
+WATCH_CHANGES = (('added', '+'), ('removed', '-'), ('changed', '~'))
+
+
 def parser_ps(parser):
     sub_parser = init_subcommand_parser(parser, 'ps')
 
     arg_group = sub_parser.add_mutually_exclusive_group()
+    arg_group.add_argument(
+        "--mine",
+        help="show only your containers (labeled by userdocker run)",
+        action="store_true",
+    )
+
     arg_group.add_argument(
         "--gpu-used",
         help="show GPUs used by nvidia-docker containers",
@@ -24,27 +52,174 @@ def parser_ps(parser):
 
     arg_group.add_argument(
         "--gpu-free",
-        help="show allowed and free GPUs (asc by MB mem used)",
+        help="show allowed and free GPUs (asc by MB mem used, utilization)",
         action="store_true",
     )
 
+    arg_group.add_argument(
+        "--gpu-status",
+        help="show memory used, utilization and containers (user, uptime) of "
+             "all GPUs",
+        action="store_true",
+    )
+
+    sub_parser.add_argument(
+        "--format",
+        help="output format of the --gpu-* options (default: tsv)",
+        choices=("tsv", "json"),
+        default="tsv",
+    )
+
+    sub_parser.add_argument(
+        "--watch",
+        help="refresh --gpu-used / --gpu-status every N seconds, printing "
+             "only rows that were added (+), removed (-) or changed (~)",
+        metavar="N",
+        type=float,
+    )
+
+
+def _gpu_rows(snapshot, status=False):
+    """Returns the rows of --gpu-used (--gpu-status) of a GPUSnapshots
+    snapshot, keyed by (gpu, container).
+
+    --gpu-status rows have the start time instead of the uptime (see
+    _format_row) so they only change with the state.
+    """
+    used = snapshot['used']
+    gpus = set(used)
+    if status:
+        gpus.update(snapshot['gpus'])
+    rows = {}
+    for gpu in sorted(gpus):
+        containers = sorted(used.get(gpu, []))
+        if status and not containers:
+            containers = [(None, None, None, None)]
+        for container, name, user, _ in containers:
+            row = {'gpu': gpu, 'container': container, 'name': name,
+                   'user': user}
+            if status:
+                mem, util = snapshot['gpus'].get(gpu, (None, None))
+                row['memory_used'], row['utilization'] = mem, util
+                row['started'] = snapshot['started'].get(container)
+            rows[gpu, container] = row
+    return rows
+
+
+def _format_uptime(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    for unit, size, sub_unit, sub_size in (
+            ('d', 86400, 'h', 3600), ('h', 3600, 'm', 60), ('m', 60, 's', 1)):
+        if seconds >= size:
+            return '%d%s%02d%s' % (
+                seconds // size, unit, seconds % size // sub_size, sub_unit)
+    return '%ds' % seconds
+
+
+def _format_row(row, snapshot, columns, fmt):
+    row = dict(row)
+    if 'started' in row:
+        started = row.pop('started')
+        row['uptime'] = None if started is None \
+            else max(0, int(snapshot['time'] - started))
+    if fmt == 'json':
+        return row
+    row['uptime'] = _format_uptime(row.get('uptime'))
+    return '\t'.join(
+        '-' if row[key] is None else str(row[key]) for key, _ in columns)
+
+
+def _print_gpu_rows(rows, snapshot, columns, fmt):
+    formatted = [
+        _format_row(row, snapshot, columns, fmt) for _, row in sorted(
+            rows.items())
+    ]
+    if fmt == 'json':
+        print(json.dumps(formatted))
+        return
+    if formatted:
+        print('\t'.join(header for _, header in columns))
+    for line in formatted:
+        print(line)
+
+
+def _watch_gpu_rows(args, columns, status):
+    """Prints the initial rows and then every args.watch seconds only the
+    difference to the previous snapshot (json: one object per change)."""
+    snapshots = GPUSnapshots(args.executor_path)
+    if args.format == 'tsv':
+        print('\t'.join(('Change',) + tuple(h for _, h in columns)))
+    previous = {}
+    try:
+        while True:
+            start = time.time()
+            snapshot = snapshots.take()
+            rows = _gpu_rows(snapshot, status)
+            changes = {
+                'added': sorted(rows.keys() - previous.keys()),
+                'removed': sorted(previous.keys() - rows.keys()),
+                'changed': sorted(
+                    k for k in rows.keys() & previous.keys()
+                    if rows[k] != previous[k]),
+            }
+            if any(changes.values()):
+                if args.format == 'json':
+                    change = {'time': snapshot['time']}
+                    for kind, _ in WATCH_CHANGES:
+                        change[kind] = [
+                            _format_row((previous if kind == 'removed'
+                                         else rows)[k], snapshot, columns,
+                                        args.format)
+                            for k in changes[kind]
+                        ]
+                    print(json.dumps(change))
+                else:
+                    for kind, prefix in WATCH_CHANGES:
+                        for k in changes[kind]:
+                            print(prefix + '\t' + _format_row(
+                                (previous if kind == 'removed' else rows)[k],
+                                snapshot, columns, args.format))
+                sys.stdout.flush()
+            previous = rows
+            time.sleep(max(0., args.watch - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+
 
 def exec_cmd_ps(args):
-    if not args.gpu_used and not args.gpu_free and not args.gpu_used_mine:
-        exit_exec_cmd(init_cmd(args), dry_run=args.dry_run)
-
-    if args.gpu_used:
-        gpus_used = nvidia_get_gpus_used_by_containers(args.executor_path)
-        if gpus_used:
-            print("\t".join(("GPU", "Container", "ContainerName", "User")))
-        for i, l in sorted(gpus_used.items()):
-            for container, container_name, user, _ in sorted(l):
-                print("\t".join((str(i), container, container_name, user)))
-    elif args.gpu_used_mine:
-        available_gpus, own_gpus = nvidia_get_available_gpus(args.executor_path)
-        for gpu in own_gpus:
-            print(gpu)
-    elif args.gpu_free:
+    if args.mine:
+        cmd = init_cmd(args) + ['--filter', 'label=%s=%d' % (LABEL_UID, uid)]
+        exit_exec_cmd(cmd, dry_run=args.dry_run, replace_process=True)
+
+    gpu_rows = args.gpu_used or args.gpu_status
+    if args.watch is not None:
+        if not gpu_rows:
+            raise UserDockerException(
+                "ERROR: --watch needs --gpu-used or --gpu-status")
+        if args.watch <= 0:
+            raise UserDockerException(
+                "ERROR: --watch needs a positive interval")
+
+    if not gpu_rows and not args.gpu_free and not args.gpu_used_mine:
+        exit_exec_cmd(
+            init_cmd(args), dry_run=args.dry_run, replace_process=True)
+
+    if gpu_rows:
+        columns = GPU_STATUS_COLUMNS if args.gpu_status else GPU_USED_COLUMNS
+        if args.watch is not None:
+            _watch_gpu_rows(args, columns, args.gpu_status)
+            return
+        snapshot = GPUSnapshots(args.executor_path).take()
+        _print_gpu_rows(
+            _gpu_rows(snapshot, args.gpu_status), snapshot, columns,
+            args.format)
+    else:
         available_gpus, own_gpus = nvidia_get_available_gpus(args.executor_path)
-        for gpu in available_gpus:
-            print(gpu)
+        gpus = own_gpus if args.gpu_used_mine else available_gpus
+        if args.format == 'json':
+            print(json.dumps(gpus))
+        else:
+            for gpu in gpus:
+                print(gpu)
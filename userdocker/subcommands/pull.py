@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import sys
+
+from ..config import PULL_CONCURRENCY
 from ..helpers.cmd import init_cmd
-from ..helpers.execute import exit_exec_cmd
 from ..helpers.parser import init_subcommand_parser
+from ..helpers.policy import policy
+from ..helpers.pulls import pull_image
+from ..helpers.pulls import pull_images
 
 
 def parser_pull(parser):
@@ -10,13 +15,34 @@ def parser_pull(parser):
 
     sub_parser.add_argument(
         "name_tag_digest",
-        help="NAME[:TAG|@DIGEST] to pull",
+        nargs='+',
+        help="NAME[:TAG|@DIGEST] to pull (several are pulled concurrently, "
+             "at most %d at a time)" % PULL_CONCURRENCY,
     )
 
 
 def exec_cmd_pull(args):
-    cmd = init_cmd(args)
-    if args.name_tag_digest:
-        cmd.append("--")
-        cmd.append(args.name_tag_digest)
-    exit_exec_cmd(cmd, dry_run=args.dry_run)
+    pull_args = init_cmd(args)[2:]
+    all_tags = bool({'-a', '--all-tags'} & set(pull_args))
+    images = []
+    for image in args.name_tag_digest:
+        if all_tags:
+            # docker pull --all-tags doesn't accept a tag, any tag is pulled
+            images.append(policy().authorize_all_tags(image))
+        else:
+            images.append(policy().authorize_image(image))
+
+    # coalesced with concurrent pulls of the same images on this node, so
+    # docker pull runs as a child even for one image (no replace_process)
+    if len(images) == 1:
+        sys.exit(pull_image(
+            args.executor_path, images[0], pull_args, dry_run=args.dry_run))
+
+    statuses = pull_images(
+        args.executor_path, images, pull_args, dry_run=args.dry_run)
+    failed = [image for image, ret in statuses.items() if ret]
+    for image, ret in statuses.items():
+        print('%s: %s' % (image, 'failed (%d)' % ret if ret else 'ok'))
+    if failed:
+        print('%d of %d pulls failed' % (len(failed), len(statuses)))
+    sys.exit(statuses[failed[0]] if failed else 0)
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import functools
 import logging
 import os
-import re
 import ipaddress
 import time
 import signal
@@ -20,13 +20,16 @@ from ..config import ENV_VARS
 from ..config import ENV_VARS_EXT
 from ..config import NV_ALLOW_OWN_GPU_REUSE
 from ..config import NV_ALLOWED_GPUS
+from ..config import NV_CPU_NUMA_PINNING
 from ..config import NV_DEFAULT_GPU_COUNT_RESERVATION
 from ..config import NV_MAX_GPU_COUNT_RESERVATION
 from ..config import NV_USE_CUDA_VISIBLE_DEVICES
+from ..config import PULL_FRESHNESS
 from ..config import SLURM_BIND_GPU
 from ..config import SLURM_NETWORK_ADDRESS_OFFSET
-from ..config import PROBE_USED_MOUNTS
+from ..config import SLURM_PIN_IMAGE_DIGEST
 from ..config import RUN_PULL
+from ..config import RUN_STOP_CONTAINER_ON_SIGNAL
 from ..config import USER_IN_CONTAINER
 from ..config import VOLUME_MOUNTS_ALWAYS
 from ..config import VOLUME_MOUNTS_AVAILABLE
@@ -36,12 +39,25 @@ from ..config import gid
 from ..config import uid
 from ..config import user_name
 from ..helpers.cmd import init_cmd
+from ..helpers.cpuset import nvidia_cpuset_args
+from ..helpers.dockerapi import close_connections
+from ..helpers.exceptions import GPUsUnavailable
 from ..helpers.exceptions import UserDockerException
-from ..helpers.execute import exec_cmd
 from ..helpers.execute import exit_exec_cmd
+from ..helpers.gpu_queue import wait_for_gpus
+from ..helpers.image_index import local_image_exists
+from ..helpers.labels import userdocker_labels
 from ..helpers.logger import logger
+from ..helpers.mounts import probe_mounts
 from ..helpers.nvidia import nvidia_get_available_gpus
+from ..helpers.nvidia import nvidia_select_gpus
+from ..helpers.pinning import pin_job_image
+from ..helpers.policy import policy
+from ..helpers.pulls import pull_image
 from ..helpers.parser import init_subcommand_parser
+from ..helpers.reservation import gpu_reservation_lock
+from ..helpers.reservation import reserve_gpus
+from ..helpers.reservation import reserved_gpus
 from ..helpers.logger import logger
 from .network import prefixed_string
 
@@ -92,6 +108,20 @@ def parser_run(parser):
             default=[],
         )
 
+    sub_parser.add_argument(
+        "--wait",
+        help="if not enough GPUs are available, wait for them in a node local "
+             "queue (fair across users) instead of failing",
+        action="store_true",
+    )
+
+    sub_parser.add_argument(
+        "--wait-timeout",
+        help="like --wait, but fail after waiting SECONDS",
+        metavar="SECONDS",
+        type=float,
+    )
+
     sub_parser.add_argument(
         "image",
         help="the image to run. Allowed: " + ', '.join(ALLOWED_IMAGE_REGEXPS),
@@ -118,6 +148,68 @@ def is_slurm_job():
     return 'SLURM_JOBID' in os.environ and 'SLURM_TASK_PID' in os.environ
 
 
+def select_and_reserve_gpus(args, nv_gpus):
+    """Checks user specified nv_gpus or selects default GPUs and reserves them.
+
+    Must be called with gpu_reservation_lock held. All tasks of a slurm job on
+    this node share the GPUs selected by the first one (for SLURM_BIND_GPU).
+    """
+    if SLURM_BIND_GPU and is_slurm_job():
+        jobid = getenv_raise('SLURM_JOBID')
+        key = 'slurm_job:%s' % jobid
+        name_prefix = '%s_%s_' % (user_name, jobid)
+        job_gpus = reserved_gpus(key)
+        if job_gpus:
+            logger.debug('using GPUs %r reserved for job %s', job_gpus, jobid)
+            reserve_gpus(key, job_gpus, name_prefix)
+            return job_gpus
+    else:
+        key = 'pid:%d' % os.getpid()
+        name_prefix = os.environ["USERDOCKER_CONTAINER_NAME"]
+
+    if nv_gpus:
+        # check if available
+        gpus_available, own_gpus = nvidia_get_available_gpus(args.executor_path)
+        if NV_ALLOW_OWN_GPU_REUSE:
+            gpus_available.extend(own_gpus)
+        for g in nv_gpus:
+            if g not in gpus_available:
+                msg = (
+                    'ERROR: GPU %d is currently not available!\nUse:\n'
+                    '"sudo userdocker ps --gpu-free" to find available GPUs.\n'
+                    '"sudo userdocker ps --gpu-used" and "nvidia-smi" to see '
+                    'status.' % g
+                )
+                if NV_ALLOW_OWN_GPU_REUSE and own_gpus:
+                    msg += '\n"sudo userdocker ps --gpu-used-mine to show own' \
+                           '(reusable) GPUs.'
+                raise GPUsUnavailable(msg)
+    else:
+        # NV_GPU wasn't set, use admin defaults, tell user
+        gpu_default = NV_DEFAULT_GPU_COUNT_RESERVATION
+        logger.info(
+            "NV_GPU environment variable not set, trying to acquire admin "
+            "default of %d GPUs" % gpu_default
+        )
+        gpus_available, own_gpus = nvidia_get_available_gpus(args.executor_path)
+        nv_gpus = nvidia_select_gpus(gpus_available, gpu_default)
+        if len(nv_gpus) < gpu_default:
+            msg = (
+                'Could not find %d available GPU(s)!\nUse:\n'
+                '"sudo userdocker ps --gpu-used" and "nvidia-smi" to see '
+                'status.' % gpu_default
+            )
+            if NV_ALLOW_OWN_GPU_REUSE and own_gpus:
+                msg += '\n You can set NV_GPU to reuse a GPU you have already' \
+                       ' reserved.'
+            raise GPUsUnavailable(msg)
+        gpu_env = ",".join([str(g) for g in nv_gpus])
+        logger.info("Setting NV_GPU=%s" % gpu_env)
+
+    reserve_gpus(key, nv_gpus, name_prefix)
+    return nv_gpus
+
+
 def prepare_nvidia_docker_run(args):
     # mainly handles GPU arbitration via ENV var for nvidia-docker
     # note that these are ENV vars for the command, not the container
@@ -138,7 +230,7 @@ def prepare_nvidia_docker_run(args):
     # then NV_GPU (normal nvidia-docker env var)
     nv_gpus = os.getenv('NV_GPU', nv_gpus)
     if nv_gpus:
-        # the user has set NV_GPU, just check if it's ok
+        # the user has set NV_GPU, check if it's allowed
         nv_gpus = [g.strip() for g in nv_gpus.split(',')]
         try:
             nv_gpus = [int(gpu) for gpu in nv_gpus]
@@ -162,43 +254,22 @@ def prepare_nvidia_docker_run(args):
                     NV_MAX_GPU_COUNT_RESERVATION,)
             )
 
-        # check if available
-        gpus_available, own_gpus = nvidia_get_available_gpus(args.executor_path)
-        if NV_ALLOW_OWN_GPU_REUSE:
-            gpus_available.extend(own_gpus)
-        for g in nv_gpus:
-            if g not in gpus_available:
-                msg = (
-                    'ERROR: GPU %d is currently not available!\nUse:\n'
-                    '"sudo userdocker ps --gpu-free" to find available GPUs.\n'
-                    '"sudo userdocker ps --gpu-used" and "nvidia-smi" to see '
-                    'status.' % g
-                )
-                if NV_ALLOW_OWN_GPU_REUSE and own_gpus:
-                    msg += '\n"sudo userdocker ps --gpu-used-mine to show own' \
-                           '(reusable) GPUs.'
-                raise UserDockerException(msg)
+    def reserve():
+        # select / check and reserve GPUs atomically wrt. concurrent runs
+        with gpu_reservation_lock():
+            return select_and_reserve_gpus(args, nv_gpus)
+
+    wait = args.wait or args.wait_timeout is not None
+    if wait and SLURM_BIND_GPU and is_slurm_job() and reserved_gpus(
+            'slurm_job:%s' % getenv_raise('SLURM_JOBID')):
+        # the first task of the job already waited for its GPUs
+        wait = False
+    if wait:
+        nv_gpus = wait_for_gpus(
+            reserve, len(nv_gpus) or NV_DEFAULT_GPU_COUNT_RESERVATION,
+            -1 if args.wait_timeout is None else args.wait_timeout)
     else:
-        # NV_GPU wasn't set, use admin defaults, tell user
-        gpu_default = NV_DEFAULT_GPU_COUNT_RESERVATION
-        logger.info(
-            "NV_GPU environment variable not set, trying to acquire admin "
-            "default of %d GPUs" % gpu_default
-        )
-        gpus_available, own_gpus = nvidia_get_available_gpus(args.executor_path)
-        nv_gpus = gpus_available[:gpu_default]
-        if len(nv_gpus) < gpu_default:
-            msg = (
-                'Could not find %d available GPU(s)!\nUse:\n'
-                '"sudo userdocker ps --gpu-used" and "nvidia-smi" to see '
-                'status.' % gpu_default
-            )
-            if NV_ALLOW_OWN_GPU_REUSE and own_gpus:
-                msg += '\n You can set NV_GPU to reuse a GPU you have already' \
-                       ' reserved.'
-            raise UserDockerException(msg)
-        gpu_env = ",".join([str(g) for g in nv_gpus])
-        logger.info("Setting NV_GPU=%s" % gpu_env)
+        nv_gpus = reserve()
 
     # for slurm jobs distribute nv_gpus to tasks on this node
     if SLURM_BIND_GPU and is_slurm_job():
@@ -283,66 +354,14 @@ def exec_cmd_run(args):
     # add additional args first
     cmd.extend(ADDITIONAL_ARGS)
 
-    # check port mappings
-    for pm in getattr(args, 'port_mappings', []):
-        for pm_pattern in ALLOWED_PORT_MAPPINGS:
-            if re.match(pm_pattern, pm):
-                cmd += ['-p', pm]
-                break
-        else:
-            raise UserDockerException(
-                "ERROR: given port mapping not allowed: %s" % pm
-            )
-
-    # check mounts
-    mounts = []
-    mounts_available = \
-        VOLUME_MOUNTS_ALWAYS + VOLUME_MOUNTS_DEFAULT + VOLUME_MOUNTS_AVAILABLE
-
-    mounts += VOLUME_MOUNTS_ALWAYS
-
-    if not args.no_default_mounts:
-        mounts += VOLUME_MOUNTS_DEFAULT
-
-    for user_mount in getattr(args, 'volumes', []):
-        if user_mount in mounts:
-            continue
-        if user_mount in mounts_available:
-            mounts += [user_mount]
-            continue
-
-        # literal matches didn't work, check if the user appended a 'ro' flag
-        if len(user_mount.split(':')) == 3:
-            host_path, container_path, flag = user_mount.split(':')
-            if flag == 'ro':
-                st = ':'.join([host_path, container_path])
-                if st in mounts:
-                    # upgrade mount to include ro flag
-                    idx = mounts.index(st)
-                    mounts[idx] = user_mount
-                    continue
-                if st in mounts_available:
-                    mounts += [user_mount]
-                    continue
-
-        # allow potential unspecified container_path mounts
-        host_path = user_mount.split(':')[0] + ':'
-        if host_path in mounts_available:
-            mounts += [user_mount]
-            continue
+    # check image, port mappings and mounts
+    img, port_mappings, mounts = policy().authorize_run(args)
 
-        raise UserDockerException(
-            "ERROR: given mount not allowed: %s" % user_mount
-        )
+    for pm in port_mappings:
+        cmd += ['-p', pm]
 
     mount_host_paths = [m.split(':')[0] for m in mounts]
-    for ms in mount_host_paths:
-        if not os.path.exists(ms):
-            raise UserDockerException(
-                "ERROR: mount can't be found: %s" % ms
-            )
-        if PROBE_USED_MOUNTS and os.path.isdir(ms):
-            os.listdir(ms)
+    probe_mounts(mount_host_paths)
 
     for mount in mounts:
         if ':' not in mount:
@@ -354,6 +373,11 @@ def exec_cmd_run(args):
     # setup environment with nvidia-specific options
     if args.executor == 'nvidia-docker':
         prepare_nvidia_docker_run(args)
+        # pin to the CPUs / NUMA nodes of the GPUs unless set explicitly
+        if NV_CPU_NUMA_PINNING and os.environ['NV_GPU'] and not any(
+                a.startswith('--cpuset-') for a in cmd):
+            cmd += nvidia_cpuset_args(
+                [int(g) for g in os.environ['NV_GPU'].split(',')])
 
     # userdocker environment
     env_vars = ENV_VARS + ENV_VARS_EXT.get(args.executor, [])
@@ -369,6 +393,12 @@ def exec_cmd_run(args):
         ]
     for env_var in env_vars:
         cmd += ['-e', env_var]
+    # same as labels, so the daemon can filter containers by owner / GPUs
+    labels = userdocker_labels(
+        user_name, uid,
+        os.environ['NV_GPU'] if args.executor == 'nvidia-docker' else None)
+    for label in sorted(labels.items()):
+        cmd += ['--label', '%s=%s' % label]
 
     # slurm env vars & communication
     if is_slurm_job():
@@ -403,39 +433,21 @@ def exec_cmd_run(args):
     # unability to handle this
     # cmd.append("--")
 
-    img = args.image
-    if ":" not in img and "@" not in img:
-        # user didn't explicitly set a tag or digest, append ":latest"
-        img += ":latest"
-
-    if ALLOWED_IMAGE_REGEXPS:
-        for air in ALLOWED_IMAGE_REGEXPS:
-            if re.match(air, img):
-                break
-        else:
-            raise UserDockerException(
-                "ERROR: image %s not in allowed image regexps: %s" % (
-                    img, ALLOWED_IMAGE_REGEXPS))
-
     # pull image?
     if RUN_PULL == "default":
         # just let `docker run` do its thing
         pass
     elif RUN_PULL == "always":
         # pull image
-        exec_cmd(
-            [args.executor_path, 'pull', img],
+        pull_image(
+            args.executor_path, img,
             dry_run=args.dry_run,
             loglvl=logging.DEBUG,
+            max_age=PULL_FRESHNESS,
         )
     elif RUN_PULL == "never":
         # check if image is available locally
-        tmp = exec_cmd(
-            [args.executor_path, 'images', '-q', img],
-            return_status=False,
-            loglvl=logging.DEBUG,
-        )
-        if not tmp:
+        if not local_image_exists(args.executor_path, img):
             raise UserDockerException(
                 "ERROR: you can only use locally available images, but %s could"
                 " not be found locally" % img
@@ -445,11 +457,28 @@ def exec_cmd_run(args):
             "ERROR: RUN_PULL config variable not expected range, contact admin"
         )
 
+    if SLURM_PIN_IMAGE_DIGEST and is_slurm_job() and not args.dry_run:
+        # all tasks of the job run the digest resolved by the first one
+        pull = None if RUN_PULL == "never" else functools.partial(
+            pull_image, args.executor_path, loglvl=logging.DEBUG,
+            max_age=PULL_FRESHNESS)
+        img = pin_job_image(
+            args.executor_path, getenv_raise('SLURM_JOBID'), img, pull,
+            procid=os.getenv('SLURM_PROCID'))
+
     cmd.append(img)
     cmd.extend(args.image_args)
 
-    # install SIGINT and SIGTERM handlers to stop the container
-    signal.signal(signal.SIGINT, handle_signal_docker_stop)
-    signal.signal(signal.SIGTERM, handle_signal_docker_stop)
-
-    exit_exec_cmd(cmd, dry_run=args.dry_run)
+    stop_on_signal = RUN_STOP_CONTAINER_ON_SIGNAL is True or (
+        RUN_STOP_CONTAINER_ON_SIGNAL == 'slurm' and is_slurm_job())
+    if stop_on_signal:
+        # install SIGINT and SIGTERM handlers to stop the container
+        signal.signal(signal.SIGINT, handle_signal_docker_stop)
+        signal.signal(signal.SIGTERM, handle_signal_docker_stop)
+
+    # without handlers there's no need to keep the python process around (GPU
+    # reservation and pull locks are released already, the reservation lives
+    # on with the pid)
+    close_connections()
+    exit_exec_cmd(
+        cmd, dry_run=args.dry_run, replace_process=not stop_on_signal)
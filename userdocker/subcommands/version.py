@@ -7,4 +7,5 @@ from ..helpers.execute import exit_exec_cmd
 
 def exec_cmd_version(args):
     print("Userdocker Version: %s\n" % __version__)
-    exit_exec_cmd(init_cmd(args), dry_run=args.dry_run)
+    exit_exec_cmd(
+        init_cmd(args), dry_run=args.dry_run, replace_process=True)
@@ -11,7 +11,7 @@ from .helpers.cmd import init_cmd
 from .helpers.exceptions import UserDockerException
 from .helpers.execute import exit_exec_cmd
 from .parser import parse_args
-from .subcommands import specific_command_executors
+from .subcommands import specific_command_executor
 
 
 if not os.getenv('SUDO_UID'):
@@ -20,11 +20,12 @@ if not os.getenv('SUDO_UID'):
 
 
 def prepare_and_exec_cmd(args):
-    scmd = args.subcommand
-    if scmd in specific_command_executors:
-        specific_command_executors[scmd](args)
+    executor = specific_command_executor(args.subcommand)
+    if executor:
+        executor(args)
     else:
-        exit_exec_cmd(init_cmd(args), dry_run=args.dry_run)
+        exit_exec_cmd(
+            init_cmd(args), dry_run=args.dry_run, replace_process=True)
 
 
 def parse_and_exec_cmd():
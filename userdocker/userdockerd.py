@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+userdockerd is an optional node local daemon for userdocker.
+
+It keeps the GPU usage state (memory used per GPU and the GPU -> container
+map) in memory and answers queries of userdocker invocations via a root owned
+unix socket, so they don't have to run nvidia-smi and docker queries
+themselves. GPU stats are the peak values of the last USERDOCKERD_GPU_HISTORY
+refreshes. With NV_CONTAINER_GPU_INDEX, the GPU -> container map follows the
+docker events stream. With IMAGE_INDEX, it keeps the image index current.
+
+Each connection sends a single json line request and receives a single json
+line response ({"result": ...} or {"error": ...}). Supported queries:
+- {"query": "state"}: {"time": ..., "gpus": {gpu: [MiB used, % util]},
+  "used": {...}, "started": {container: start time}}
+- {"query": "used"}: {gpu: [[container, name, user, uid], ...]}
+- {"query": "mine", "uid": uid}: sorted GPUs used by containers of uid
+
+Available GPUs depend on the (group / user specific) config of the caller, so
+they're computed by userdocker from the state.
+"""
+
+import argparse
+from collections import deque
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+from . import __version__
+from .config import EXECUTORS
+from .config import EXECUTOR_DEFAULT
+from .config import IMAGE_INDEX
+from .config import NVIDIA_SMI
+from .config import NV_CONTAINER_GPU_INDEX
+from .config import USERDOCKERD_GPU_HISTORY
+from .config import USERDOCKERD_REFRESH_INTERVAL
+from .config import USERDOCKERD_SOCKET
+from .helpers.dockerapi import reset_api
+from .helpers.gpu_index import ContainerGPUIndex
+from .helpers.gpu_query import aggregate_gpu_stats
+from .helpers.gpu_query import query_gpu_stats
+from .helpers.image_index import ImageIndex
+from .helpers.logger import logger
+
+
+class GPUState:
+    """GPU usage state, refreshed by refresh_forever in the background."""
+
+    def __init__(self, docker, nvidia_smi, interval):
+        self.docker = docker
+        self.nvidia_smi = nvidia_smi
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.time = 0
+        self.gpus = {}
+        self.used = {}
+        self.started = {}
+        # GPU stats of the last USERDOCKERD_GPU_HISTORY refreshes
+        self.history = deque(maxlen=max(1, USERDOCKERD_GPU_HISTORY))
+        self.index = ContainerGPUIndex.load() if NV_CONTAINER_GPU_INDEX \
+            else None
+
+    def refresh(self):
+        self.history.append(query_gpu_stats(self.nvidia_smi))
+        gpus = aggregate_gpu_stats(self.history)
+        if self.index is not None:
+            used = dict(self.index.gpus_used())
+            started = self.index.started_times()
+        else:
+            index = ContainerGPUIndex()
+            index.rebuild(self.docker)
+            used, started = dict(index.gpus_used()), index.started_times()
+        with self._lock:
+            self.gpus, self.used, self.started = gpus, used, started
+            self.time = time.time()
+        logger.debug('refreshed GPU state: %r, used: %r', gpus, used)
+
+    def refresh_forever(self):
+        while True:
+            start = time.time()
+            # the API latch is per invocation, retry after dockerd restarts
+            reset_api()
+            try:
+                self.refresh()
+            except (Exception, SystemExit):
+                # keep refreshing, clients fall back to collecting state
+                # themselves once ours is older than USERDOCKERD_MAX_STATE_AGE
+                # (exec_cmd exits if nvidia-smi fails)
+                logger.exception('refreshing GPU state failed')
+            time.sleep(max(0., self.interval - (time.time() - start)))
+
+    def follow_events_forever(self):
+        while True:
+            reset_api()
+            try:
+                self.index.catch_up(self.docker)
+                self.index.save()
+                self.index.follow(self.docker)
+            except (Exception, SystemExit):
+                logger.exception('following docker events failed')
+            # stream ended (e.g., docker restart) or failed: catch up again
+            time.sleep(self.interval)
+
+    def follow_image_events_forever(self):
+        image_index = ImageIndex.load()
+        while True:
+            reset_api()
+            try:
+                if not image_index.is_current():
+                    image_index.refresh(self.docker)
+                    image_index.save()
+                image_index.follow(self.docker)
+            except (Exception, SystemExit):
+                logger.exception('following docker image events failed')
+            time.sleep(self.interval)
+
+    def query(self, request):
+        query = request.get('query')
+        with self._lock:
+            if query == 'state':
+                return {
+                    'time': self.time, 'gpus': self.gpus, 'used': self.used,
+                    'started': self.started,
+                }
+            if query == 'used':
+                return self.used
+            if query == 'mine':
+                uid = int(request['uid'])
+                return sorted(
+                    gpu for gpu, info in self.used.items()
+                    if any(i[3] == uid for i in info)
+                )
+        raise ValueError('unknown query: %r' % query)
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            response = {'result': self.server.state.query(request)}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            response = {'error': repr(e)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, state):
+        os.makedirs(os.path.dirname(socket_path), mode=0o755, exist_ok=True)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # socket only accessible by root
+        umask = os.umask(0o077)
+        try:
+            super(QueryServer, self).__init__(socket_path, QueryHandler)
+        finally:
+            os.umask(umask)
+        self.state = state
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--version",
+        action="version",
+        version='%(prog)s ' + __version__
+    )
+    parser.add_argument(
+        "--debug",
+        help="debug output",
+        action="store_const",
+        dest="loglvl",
+        const=logging.DEBUG,
+        default=logging.INFO,
+    )
+    parser.add_argument(
+        "--socket",
+        help="unix socket to listen on",
+        default=USERDOCKERD_SOCKET,
+    )
+    parser.add_argument(
+        "--interval",
+        help="seconds between GPU state refreshes",
+        type=float,
+        default=USERDOCKERD_REFRESH_INTERVAL,
+    )
+    # allow testing with fake executables
+    parser.add_argument(
+        "--docker",
+        help="docker executable (CLI fallback if the docker socket fails)",
+        default=EXECUTORS[EXECUTOR_DEFAULT],
+    )
+    parser.add_argument(
+        "--nvidia-smi",
+        help="nvidia-smi executable",
+        default=NVIDIA_SMI,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig()
+    logging.root.setLevel(args.loglvl)
+    if not args.socket:
+        logger.error('USERDOCKERD_SOCKET disabled in config, exiting')
+        return
+
+    state = GPUState(args.docker, args.nvidia_smi, args.interval)
+    if state.index is not None:
+        # don't serve a stale GPU -> container map from an old snapshot
+        state.index.catch_up(args.docker)
+        threading.Thread(
+            target=state.follow_events_forever, daemon=True).start()
+    if IMAGE_INDEX:
+        threading.Thread(
+            target=state.follow_image_events_forever, daemon=True).start()
+    threading.Thread(target=state.refresh_forever, daemon=True).start()
+    server = QueryServer(args.socket, state)
+    logger.info('userdockerd listening on %s', args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()